@@ -1,14 +1,46 @@
 import csv
 import os
-from flask import Flask, request, jsonify, render_template
+import sqlite3
+from flask import Flask, request, jsonify, render_template, Response, make_response, g, has_request_context, abort, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from datetime import datetime, timedelta
 from flask_sqlalchemy import SQLAlchemy
 import locale
 import urllib.parse
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask_jwt_extended import create_access_token, get_jwt_identity, jwt_required, JWTManager
+from flask_jwt_extended import create_access_token, jwt_required, JWTManager, current_user
 import json
+import re
+import hashlib
+import threading
+import queue
+import time
+import bisect
+import random
+import click
+import base64
+import zlib
+import gzip
+from collections import deque, OrderedDict, namedtuple
+from functools import wraps
+from contextlib import contextmanager
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import sqlite as dialeto_sqlite, postgresql as dialeto_postgresql
+try:
+    import zstandard # Opcional: sem ele os blocos de backup são comprimidos com zlib
+except ImportError:
+    zstandard = None
+try:
+    import orjson # Opcional: serialização JSON mais rápida (ver ProvedorJSON)
+except ImportError:
+    orjson = None
+try:
+    import brotli # Opcional: sem ele as respostas grandes vão só em gzip
+except ImportError:
+    brotli = None
 
 # --- Configuração ---
 try:
@@ -24,17 +56,115 @@ origins = [
 CORS(app, origins=origins, supports_credentials=True)
 
 base_dir = os.path.abspath(os.path.dirname(__file__))
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(base_dir, 'kaibora.db')
+# --- PERFIL DO BANCO DE DADOS ---
+# Padrão: SQLite local (kaibora.db). DATABASE_URL (ex.: Postgres do Render) troca o banco sem mudar os modelos.
+database_url = os.environ.get('DATABASE_URL', 'sqlite:///' + os.path.join(base_dir, 'kaibora.db'))
+if database_url.startswith('postgres://'):
+    database_url = 'postgresql://' + database_url[len('postgres://'):] # O SQLAlchemy só aceita "postgresql://"
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+if database_url.startswith('sqlite'):
+    # Aplicados em toda conexão nova (ver configurar_conexao_sqlite). WAL deixa leitores e o escritor
+    # trabalharem juntos entre os workers do gunicorn; busy_timeout espera a trava em vez de "database is locked".
+    app.config['SQLITE_PRAGMAS'] = {
+        "journal_mode": os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+        "synchronous": os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        "busy_timeout": int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', '5000')),
+        "cache_size": -int(os.environ.get('SQLITE_CACHE_KB', '20000')), # Negativo = KiB
+        "mmap_size": int(os.environ.get('SQLITE_MMAP_BYTES', str(128 * 1024 * 1024))),
+        "temp_store": 'MEMORY',
+    }
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        # Um pool pequeno por worker; as threads (SSE, escritor de informes) também pegam conexões dele
+        "pool_size": int(os.environ.get('DB_POOL_SIZE', '5')),
+        "max_overflow": int(os.environ.get('DB_MAX_OVERFLOW', '10')),
+        "connect_args": {"check_same_thread": False, "timeout": app.config['SQLITE_PRAGMAS']["busy_timeout"] / 1000},
+    }
+else:
+    app.config['SQLITE_PRAGMAS'] = {}
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        "pool_size": int(os.environ.get('DB_POOL_SIZE', '5')),
+        "max_overflow": int(os.environ.get('DB_MAX_OVERFLOW', '10')),
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+    }
 app.config["JWT_SECRET_KEY"] = "SUA-CHAVE-SECRETA-MUITO-FORTE" 
+# Token só no cabeçalho Authorization. Exceção: o /api/stream (EventSource não envia cabeçalhos) aceita também
+# ?jwt=... na própria rota; em qualquer outra, o token na URL iria parar em logs e no histórico.
+app.config["JWT_TOKEN_LOCATION"] = ["headers"]
+# Intervalo (s) em que cada worker lê a tabela de eventos escritos pelos outros workers
+app.config["EVENTOS_TAIL_INTERVALO"] = float(os.environ.get("EVENTOS_TAIL_INTERVALO", "1.0"))
+# Por quanto tempo (s) os eventos ficam na tabela compartilhada antes de serem podados (a poda roda na escrita)
+app.config["EVENTOS_RETENCAO"] = int(os.environ.get("EVENTOS_RETENCAO", "3600"))
+# Conexões SSE + long-polls do chat que cada worker segura ao mesmo tempo. Cada uma ocupa uma thread do worker
+# (gthread, ver gunicorn.conf.py): mantenha abaixo de GUNICORN_THREADS para sobrar thread às requisições comuns.
+# Acima do limite o SSE responde 503 e o long-poll responde na hora; o cliente volta ao polling do /api/sync.
+app.config["STREAM_MAX_CONEXOES"] = int(os.environ.get("STREAM_MAX_CONEXOES", "48"))
+# Informes: por padrão entram no mesmo commit do handler. Com INFORMES_ASSINCRONOS=1, depois do commit vão para
+# uma thread que junta os informes de várias requisições num único INSERT a cada INFORMES_LOTE_INTERVALO segundos.
+app.config["INFORMES_ASSINCRONOS"] = os.environ.get("INFORMES_ASSINCRONOS", "0") == "1"
+app.config["INFORMES_LOTE_INTERVALO"] = float(os.environ.get("INFORMES_LOTE_INTERVALO", "0.25"))
+# Com INICIALIZAR_BANCO=1 (padrão) o app cria/migra o banco ao ser importado (flask run, python app.py, benchmark).
+# Sob o gunicorn, gunicorn.conf.py roda "flask --app app inicializar-banco" uma vez no processo mestre e os
+# workers herdam INICIALIZAR_BANCO=0: as migrações não rodam em paralelo em cada worker.
+app.config["INICIALIZAR_BANCO"] = os.environ.get("INICIALIZAR_BANCO", "1") == "1"
+# VERIFICAR_PLANOS=1: na inicialização, roda EXPLAIN QUERY PLAN nas consultas quentes e avisa sobre varreduras completas
+app.config["VERIFICAR_PLANOS"] = os.environ.get("VERIFICAR_PLANOS", "0") == "1"
+# Por quanto tempo (s) cada worker confia no id -> nome do aventureiro em cache antes de reler do banco
+app.config["IDENTIDADE_CACHE_TTL"] = float(os.environ.get("IDENTIDADE_CACHE_TTL", "60"))
+# Agendador de cronogramas: cada worker confere a cada CRONOGRAMA_INTERVALO segundos se algum evento chegou na hora
+# e o dispara uma única vez (a tabela disparo_cronograma impede que dois workers disparem o mesmo evento).
+# O mesmo laço executa as reposições automáticas da loja (ver executar_reposicoes).
+app.config["AGENDADOR_CRONOGRAMA"] = os.environ.get("AGENDADOR_CRONOGRAMA", "1") == "1"
+app.config["CRONOGRAMA_INTERVALO"] = float(os.environ.get("CRONOGRAMA_INTERVALO", "5"))
+app.config["LOJA_MAX_QUANTIDADE"] = int(os.environ.get("LOJA_MAX_QUANTIDADE", "99")) # Por linha de compra
+# Validade padrão (s) de um alerta global; o POST do GM pode mandar "ttl" próprio (0 = não expira)
+app.config["ALERTAS_TTL"] = int(os.environ.get("ALERTAS_TTL", str(24 * 3600)))
+# Validade (s) do alerta de um evento do cronograma: refeições e turnos não devem tirar da lista os alertas do GM
+app.config["CRONOGRAMA_ALERTA_TTL"] = int(os.environ.get("CRONOGRAMA_ALERTA_TTL", "600"))
+# Tamanho aproximado (bytes) dos blocos em que o backup dos arquivos do jogador é dividido, comprimido e deduplicado
+app.config["BACKUP_BLOCO_BYTES"] = int(os.environ.get("BACKUP_BLOCO_BYTES", str(16 * 1024)))
+# Respostas a partir deste tamanho (bytes) são comprimidas quando o cliente aceita br/gzip
+app.config["COMPRESSAO_MIN_BYTES"] = int(os.environ.get("COMPRESSAO_MIN_BYTES", "1024"))
+app.config["COMPRESSAO_NIVEL_GZIP"] = int(os.environ.get("COMPRESSAO_NIVEL_GZIP", "6"))
+app.config["COMPRESSAO_NIVEL_BROTLI"] = int(os.environ.get("COMPRESSAO_NIVEL_BROTLI", "5"))
+# Simulação do Habitat: com HABITAT_SIMULACAO=1 o desgaste e as falhas dos sistemas avançam sozinhos a cada
+# HABITAT_TICK_INTERVALO segundos. HABITAT_ACELERACAO multiplica o tempo (ex.: 60 = uma hora simulada por minuto real).
+app.config["HABITAT_SIMULACAO"] = os.environ.get("HABITAT_SIMULACAO", "0") == "1"
+app.config["HABITAT_TICK_INTERVALO"] = float(os.environ.get("HABITAT_TICK_INTERVALO", "30"))
+app.config["HABITAT_ACELERACAO"] = float(os.environ.get("HABITAT_ACELERACAO", "1"))
+# Chance de a falha de um sistema danificar também cada sistema que depende dele (senão ele só fica INOPERANTE)
+app.config["HABITAT_PROB_CASCATA"] = float(os.environ.get("HABITAT_PROB_CASCATA", "0.25"))
+# Curva de XP: CSV "nivel,xp" (XP para passar daquele nível ao próximo). Vazio = regra de calcular_xp_necessario().
+app.config["XP_CURVA_ARQUIVO"] = os.environ.get("XP_CURVA_ARQUIVO", "")
+
+# --- JSON ---
+# Com o orjson instalado o jsonify usa ele; a saída continua igual à do provedor padrão (chaves ordenadas,
+# datas e demais tipos pelo default do Flask). Sem orjson, ou com indentação (modo debug), cai no padrão.
+class ProvedorJSON(DefaultJSONProvider):
+    OPCOES_ORJSON = (orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME) if orjson else 0
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs.get('indent'):
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self.OPCOES_ORJSON).decode('utf-8')
+    def loads(self, s, **kwargs):
+        if orjson is None:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+    def response(self, *args, **kwargs):
+        if orjson is None or (self.compact is None and self._app.debug) or self.compact is False:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default, option=self.OPCOES_ORJSON) + b"\n", mimetype=self.mimetype)
+app.json = ProvedorJSON(app)
+
 jwt = JWTManager(app)
 db = SQLAlchemy(app)
 
-# --- DADOS EM MEMÓRIA (Temporários) ---
-ALERTAS_DB = [] 
-
 # --- MODELOS DE BANCO DE DADOS ---
 class Aventureiro(db.Model):
+    # XP fica sempre abaixo do custo do nível (ver verificar_level_up): (nivel, xp) ordena pelo XP total acumulado
+    __table_args__ = (db.Index('ix_aventureiro_nivel_xp', 'nivel', 'xp'),)
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     password_hash = db.Column(db.String(256), nullable=False)
@@ -43,12 +173,22 @@ class Aventureiro(db.Model):
     classe_origem = db.Column(db.String(100), nullable=True)
     motivacao = db.Column(db.Text, nullable=True)
     xp = db.Column(db.Integer, default=0)
-    kaicons = db.Column(db.Integer, default=50)
+    kaicons = db.Column(db.Integer, default=50, index=True) # Índice: ranking por KÇ
     nivel = db.Column(db.Integer, default=1)
     habilidades = db.Column(db.Text, nullable=True, default='')
-    backup_arquivos = db.Column(db.Text, nullable=True, default='{}') 
+    # LEGADO: o backup agora fica no armazém de blocos (ver BackupManifesto). Coluna mantida vazia ('{}').
+    backup_arquivos = db.Column(db.Text, nullable=True, default='{}')
+    backup_hash = db.Column(db.String(64), nullable=True, index=True) # BackupManifesto.hash do backup atual
+    backup_tamanho = db.Column(db.Integer, nullable=True)
+    # LEGADO: o inventário agora fica em InventarioItem (ver migrar_inventarios). Coluna mantida vazia ('{}').
     inventario = db.Column(db.Text, nullable=True, default='{}')
     localizacao_atual = db.Column(db.String(100), nullable=True, default='Desconhecido')
+    setor_id = db.Column(db.Integer, db.ForeignKey('setor.id'), nullable=True, index=True) # Mesmo local, normalizado
+    itens = db.relationship('InventarioItem', backref='aventureiro', lazy='select', cascade='all, delete-orphan')
+    pedidos_tarefa = db.relationship('TarefaClaim', backref='aventureiro', lazy='select', cascade='all, delete-orphan')
+    estatisticas = db.relationship('EstatisticaJogador', lazy='select', uselist=False, cascade='all, delete-orphan')
+    def inventario_dict(self):
+        return {i.item_norm: i.quantidade for i in sorted(self.itens, key=lambda i: i.id) if i.quantidade > 0}
     def set_password(self, password): self.password_hash = generate_password_hash(password)
     def check_password(self, password): return check_password_hash(self.password_hash, password)
     def to_dict(self):
@@ -56,19 +196,32 @@ class Aventureiro(db.Model):
             "id": self.id, "username": self.username, "nome_aventureiro": self.nome_aventureiro,
             "nome_jogador": self.nome_jogador, "classe_origem": self.classe_origem,
             "motivacao": self.motivacao, "xp": self.xp, "kaicons": self.kaicons,
-            "nivel": self.nivel, "habilidades": self.habilidades,
-            "backup_arquivos": self.backup_arquivos, "inventario": self.inventario,
-            "localizacao_atual": self.localizacao_atual
+            "nivel": self.nivel, "habilidades": self.habilidades, "xp_total": CURVA_XP.xp_total(self.nivel, self.xp),
+            # Mesmo formato de antes para os clientes: string JSON {"item": quantidade}
+            "backup_hash": self.backup_hash, "backup_tamanho": self.backup_tamanho,
+            "inventario": json.dumps(self.inventario_dict()),
+            "localizacao_atual": self.localizacao_atual, "setor_id": self.setor_id
         }
 
+class InventarioItem(db.Model):
+    # Uma linha por (aventureiro, item): permite UPDATE atômico e consultas do tipo "quem tem X?"
+    __table_args__ = (db.UniqueConstraint('aventureiro_id', 'item_norm', name='uq_inventario_aventureiro_item'),)
+    id = db.Column(db.Integer, primary_key=True)
+    aventureiro_id = db.Column(db.Integer, db.ForeignKey('aventureiro.id', ondelete='CASCADE'), nullable=False)
+    item_norm = db.Column(db.String(100), nullable=False, index=True)
+    quantidade = db.Column(db.Integer, nullable=False, default=0)
+    def to_dict(self):
+        return {"aventureiro_id": self.aventureiro_id, "item": self.item_norm, "quantidade": self.quantidade}
+
 # MODELO TAREFA (ATUALIZADO)
 class Tarefa(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     texto = db.Column(db.String(200), nullable=False)
     xp_reward = db.Column(db.Integer, default=10)
     kc_reward = db.Column(db.Integer, default=5)
-    # NOVO: Status da Tarefa (ATIVA, PENDENTE, CONCLUIDA)
-    status = db.Column(db.String(50), nullable=False, default='ATIVA')
+    # NOVO: Status da Tarefa (ATIVA, PENDENTE, CONCLUIDA). PENDENTE é legado: agora cada jogador tem o seu TarefaClaim.
+    status = db.Column(db.String(50), nullable=False, default='ATIVA', index=True)
+    pedidos = db.relationship('TarefaClaim', backref='tarefa', lazy='select', cascade='all, delete-orphan')
     
     def to_dict(self):
         return {
@@ -77,7 +230,24 @@ class Tarefa(db.Model):
             "status": self.status # NOVO
         }
 
+class TarefaClaim(db.Model):
+    # Pedido de conclusão de um jogador: várias pessoas podem pedir a mesma tarefa, uma vez cada.
+    # PENDENTE -> APROVADA | RECUSADA (o GM decide) | CANCELADA (a tarefa foi encerrada); RECUSADA -> PENDENTE (pede de novo)
+    __table_args__ = (db.UniqueConstraint('tarefa_id', 'aventureiro_id', name='uq_claim_tarefa_aventureiro'),
+                      db.Index('ix_claim_estado_criado', 'estado', 'criado_em', 'id'), # Fila do GM, em ordem de chegada
+                      db.Index('ix_claim_aventureiro_estado', 'aventureiro_id', 'estado'))
+    id = db.Column(db.Integer, primary_key=True)
+    tarefa_id = db.Column(db.Integer, db.ForeignKey('tarefa.id', ondelete='CASCADE'), nullable=False)
+    aventureiro_id = db.Column(db.Integer, db.ForeignKey('aventureiro.id', ondelete='CASCADE'), nullable=False)
+    estado = db.Column(db.String(20), nullable=False, default='PENDENTE')
+    criado_em = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    decidido_em = db.Column(db.DateTime, nullable=True)
+    def to_dict(self):
+        return {"id": self.id, "tarefa_id": self.tarefa_id, "aventureiro_id": self.aventureiro_id, "estado": self.estado,
+                "criado_em": self.criado_em.isoformat(timespec='seconds'),
+                "decidido_em": self.decidido_em.isoformat(timespec='seconds') if self.decidido_em else None}
 class Cronograma(db.Model):
+    __table_args__ = (db.Index('ix_cronograma_hora_minuto', 'hora', 'minuto'),)
     id = db.Column(db.Integer, primary_key=True)
     hora = db.Column(db.Integer, nullable=False)
     minuto = db.Column(db.Integer, nullable=False)
@@ -89,14 +259,27 @@ class Rodizio(db.Model):
     descricao = db.Column(db.String(250), nullable=False)
     def to_dict(self): return {"id": self.id, "nome_tarefa": self.nome_tarefa, "descricao": self.descricao}
 class RegistroInformes(db.Model):
+    __table_args__ = (db.Index('ix_informes_categoria_timestamp', 'categoria', 'timestamp'),)
     id = db.Column(db.Integer, primary_key=True)
-    timestamp = db.Column(db.DateTime, default=datetime.now)
+    timestamp = db.Column(db.DateTime, default=datetime.now, index=True)
     texto = db.Column(db.String(500), nullable=False)
+    # Antes só existiam como prefixo no texto ("[LOJA] ..."); ver classificar_informe()
+    categoria = db.Column(db.String(30), nullable=True)
+    ator = db.Column(db.String(100), nullable=True, index=True)
     def to_dict(self):
-        return {"id": self.id, "timestamp": self.timestamp.strftime("%d/%m %H:%M"), "texto": self.texto}
+        return {"id": self.id, "timestamp": self.timestamp.strftime("%d/%m %H:%M"), "texto": self.texto, "categoria": self.categoria, "ator": self.ator}
+class Alerta(db.Model):
+    # Alertas globais do GM, compartilhados por todos os workers
+    id = db.Column(db.Integer, primary_key=True)
+    criado_em = db.Column(db.DateTime, default=datetime.now)
+    expira_em = db.Column(db.DateTime, nullable=True, index=True) # None = não expira
+    texto = db.Column(db.String(500), nullable=False)
+    def to_dict(self):
+        return {"id": self.id, "timestamp": self.criado_em.strftime("%d/%m %H:%M"), "texto": self.texto,
+                "expira_em": self.expira_em.isoformat(timespec='seconds') if self.expira_em else None}
 class ChatMensagem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    timestamp = db.Column(db.DateTime, default=datetime.now)
+    timestamp = db.Column(db.DateTime, default=datetime.now, index=True)
     nome_autor = db.Column(db.String(100), nullable=False)
     texto = db.Column(db.String(500), nullable=False)
     def to_dict(self):
@@ -107,18 +290,73 @@ class LojaItem(db.Model):
     descricao = db.Column(db.String(500), nullable=False)
     preco = db.Column(db.Integer, nullable=False)
     estoque = db.Column(db.Integer, default=0)
+    reposicoes = db.relationship('ReposicaoLoja', backref='item', lazy='select', cascade='all, delete-orphan')
     def to_dict(self):
         return {"id": self.id, "nome": self.nome, "descricao": self.descricao, "preco": self.preco, "estoque": self.estoque}
+class LojaVenda(db.Model):
+    # Uma linha por item de cada compra. Sem FK (como o ledger): o histórico sobrevive à remoção do item ou do jogador.
+    __table_args__ = (db.Index('ix_loja_venda_item_timestamp', 'loja_item_id', 'timestamp'),)
+    id = db.Column(db.Integer, primary_key=True)
+    timestamp = db.Column(db.DateTime, default=datetime.now, index=True)
+    loja_item_id = db.Column(db.Integer, nullable=True)
+    item_nome = db.Column(db.String(100), nullable=False)
+    aventureiro_id = db.Column(db.Integer, nullable=True)
+    aventureiro_nome = db.Column(db.String(100), nullable=False)
+    quantidade = db.Column(db.Integer, nullable=False, default=1)
+    preco_unitario = db.Column(db.Integer, nullable=False)
+    total = db.Column(db.Integer, nullable=False)
+    def texto(self):
+        if self.quantidade == 1: return f"[LOJA] {self.aventureiro_nome} comprou '{self.item_nome}' por {self.total} KÇ."
+        return f"[LOJA] {self.aventureiro_nome} comprou {self.quantidade}x '{self.item_nome}' por {self.total} KÇ."
+    def to_dict(self):
+        # Mesmo formato dos informes (o log do GM continua lendo timestamp/texto) mais os campos da venda
+        return {
+            "id": self.id, "timestamp": self.timestamp.strftime("%d/%m %H:%M"), "texto": self.texto(), "categoria": "LOJA",
+            "ator": self.aventureiro_nome, "loja_item_id": self.loja_item_id, "item": self.item_nome, "aventureiro_id": self.aventureiro_id,
+            "quantidade": self.quantidade, "preco_unitario": self.preco_unitario, "total": self.total
+        }
+class ReposicaoLoja(db.Model):
+    # Reposição automática: a cada intervalo soma 'quantidade' ao estoque, sem passar de 'maximo' (se definido)
+    id = db.Column(db.Integer, primary_key=True)
+    loja_item_id = db.Column(db.Integer, db.ForeignKey('loja_item.id'), nullable=False, index=True)
+    quantidade = db.Column(db.Integer, nullable=False)
+    intervalo_minutos = db.Column(db.Integer, nullable=False)
+    maximo = db.Column(db.Integer, nullable=True)
+    proxima_em = db.Column(db.DateTime, nullable=False, index=True)
+    def to_dict(self):
+        return {
+            "id": self.id, "loja_item_id": self.loja_item_id, "item": self.item.nome if self.item else None, "quantidade": self.quantidade,
+            "intervalo_minutos": self.intervalo_minutos, "maximo": self.maximo, "proxima_em": self.proxima_em.strftime("%d/%m %H:%M")
+        }
 class HabitatSistema(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nome = db.Column(db.String(100), nullable=False)
     setor = db.Column(db.String(100), nullable=False)
+    # FUNCIONAL, DANIFICADO ou INOPERANTE (sem falha própria, mas depende de um sistema parado)
     status = db.Column(db.String(50), nullable=False, default='FUNCIONAL')
+    desgaste = db.Column(db.Float, nullable=True, default=0.0) # 0 (novo) a 1 (no limite)
+    taxa_desgaste = db.Column(db.Float, nullable=True, default=0.002) # Desgaste por hora funcionando
+    prob_falha = db.Column(db.Float, nullable=True, default=0.001) # Chance de falha por hora sem desgaste
+    tarefa_reparo_id = db.Column(db.Integer, db.ForeignKey('tarefa.id', ondelete='SET NULL'), nullable=True, index=True)
+    dependencias = db.relationship('HabitatSistema', secondary='habitat_dependencia', lazy='selectin',
+                                   primaryjoin='HabitatSistema.id == HabitatDependencia.sistema_id',
+                                   secondaryjoin='HabitatSistema.id == HabitatDependencia.depende_de_id')
     def to_dict(self):
-        return {"id": self.id, "nome": self.nome, "setor": self.setor, "status": self.status}
+        return {"id": self.id, "nome": self.nome, "setor": self.setor, "status": self.status,
+                "desgaste": round(self.desgaste or 0.0, 3), "taxa_desgaste": self.taxa_desgaste, "prob_falha": self.prob_falha,
+                "tarefa_reparo_id": self.tarefa_reparo_id, "depende_de": sorted(d.id for d in self.dependencias)}
+class HabitatDependencia(db.Model):
+    # sistema_id só funciona com depende_de_id FUNCIONAL (ex.: a Rede de Comunicação depende do Sistema Elétrico)
+    sistema_id = db.Column(db.Integer, db.ForeignKey('habitat_sistema.id', ondelete='CASCADE'), primary_key=True)
+    depende_de_id = db.Column(db.Integer, db.ForeignKey('habitat_sistema.id', ondelete='CASCADE'), primary_key=True, index=True)
+class HabitatRelogio(db.Model):
+    # Uma linha só: até onde a simulação já avançou. O UPDATE condicional em avancar_habitat() garante
+    # que cada intervalo seja simulado por um único worker.
+    id = db.Column(db.Integer, primary_key=True)
+    simulado_ate = db.Column(db.DateTime, nullable=False)
 class EsbocoMapa(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    timestamp = db.Column(db.DateTime, default=datetime.now)
+    timestamp = db.Column(db.DateTime, default=datetime.now, index=True)
     nome_autor = db.Column(db.String(100), nullable=False)
     nome_setor = db.Column(db.String(100), nullable=False)
     notas = db.Column(db.Text, nullable=True)
@@ -127,15 +365,35 @@ class EsbocoMapa(db.Model):
             "id": self.id, "timestamp": self.timestamp.strftime("%d/%m %H:%M"),
             "nome_autor": self.nome_autor, "nome_setor": self.nome_setor, "notas": self.notas
         }
+class Setor(db.Model):
+    # Locais do mapa. localizacao_atual continua texto livre para os clientes; setor_id aponta para cá.
+    id = db.Column(db.Integer, primary_key=True)
+    nome = db.Column(db.String(100), unique=True, nullable=False)
+    def to_dict(self): return {"id": self.id, "nome": self.nome}
+class MovimentoHistorico(db.Model):
+    # Só de inserção: cada troca de setor de um jogador/NPC (e entrada/saída do mapa, setor None).
+    # Também serve de log para os índices de ocupantes dos outros workers (ver IndiceOcupantes).
+    __table_args__ = (db.Index('ix_movimento_entidade_timestamp', 'tipo', 'entidade_id', 'timestamp'),)
+    id = db.Column(db.Integer, primary_key=True)
+    timestamp = db.Column(db.DateTime, default=datetime.now, index=True)
+    tipo = db.Column(db.String(10), nullable=False) # 'jogador' ou 'npc'
+    entidade_id = db.Column(db.Integer, nullable=False)
+    nome = db.Column(db.String(100), nullable=False)
+    setor_id = db.Column(db.Integer, nullable=True)
+    setor_anterior_id = db.Column(db.Integer, nullable=True)
+    def to_dict(self):
+        return {"id": self.id, "timestamp": self.timestamp.isoformat(timespec='seconds'), "tipo": self.tipo,
+                "entidade_id": self.entidade_id, "nome": self.nome, "setor_id": self.setor_id, "setor_anterior_id": self.setor_anterior_id}
 class NPC(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nome = db.Column(db.String(100), unique=True, nullable=False)
     descricao = db.Column(db.Text, nullable=True)
     localizacao_atual = db.Column(db.String(100), nullable=True, default='Germinal')
+    setor_id = db.Column(db.Integer, db.ForeignKey('setor.id'), nullable=True, index=True)
     def to_dict(self):
         return {
             "id": self.id, "nome": self.nome, "descricao": self.descricao,
-            "localizacao_atual": self.localizacao_atual
+            "localizacao_atual": self.localizacao_atual, "setor_id": self.setor_id
         }
 class Receita(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -149,11 +407,83 @@ class Receita(db.Model):
             "ingredientes_json": self.ingredientes_json
         }
 
+class EventoStream(db.Model):
+    # Fila compartilhada entre workers do gunicorn: cada worker "segue" esta tabela e repassa ao seu hub SSE
+    id = db.Column(db.Integer, primary_key=True)
+    timestamp = db.Column(db.DateTime, default=datetime.now, index=True)
+    tipo = db.Column(db.String(50), nullable=False)
+    dados = db.Column(db.Text, nullable=False, default='{}')
+    def to_dict(self):
+        return {"id": self.id, "tipo": self.tipo, "dados": json.loads(self.dados)}
+class DisparoCronograma(db.Model):
+    # Um registro por evento disparado em cada horário; a restrição única é o "só uma vez" entre workers
+    __table_args__ = (db.UniqueConstraint('cronograma_id', 'momento', name='uq_disparo_cronograma_momento'),)
+    id = db.Column(db.Integer, primary_key=True)
+    cronograma_id = db.Column(db.Integer, nullable=False)
+    momento = db.Column(db.DateTime, nullable=False, index=True) # Minuto agendado (segundos zerados)
+    disparado_em = db.Column(db.DateTime, default=datetime.now)
+class BackupBloco(db.Model):
+    # Pedaço do backup endereçado pelo sha256 do conteúdo original: blocos iguais (entre versões e entre
+    # jogadores) são guardados uma única vez
+    hash = db.Column(db.String(64), primary_key=True)
+    compressao = db.Column(db.String(10), nullable=False) # 'zlib' ou 'zstd'
+    tamanho = db.Column(db.Integer, nullable=False) # Bytes antes da compressão
+    dados = db.Column(db.LargeBinary, nullable=False)
+    criado_em = db.Column(db.DateTime, default=datetime.now, index=True)
+class BackupManifesto(db.Model):
+    # Um backup = lista ordenada de blocos. O hash é o sha256 da lista de hashes dos blocos.
+    hash = db.Column(db.String(64), primary_key=True)
+    tamanho = db.Column(db.Integer, nullable=False)
+    criado_em = db.Column(db.DateTime, default=datetime.now)
+class BackupManifestoBloco(db.Model):
+    manifesto_hash = db.Column(db.String(64), primary_key=True)
+    posicao = db.Column(db.Integer, primary_key=True)
+    bloco_hash = db.Column(db.String(64), nullable=False, index=True)
+class LedgerEntry(db.Model):
+    # Livro-razão só de inserção: toda variação de kaicons, itens de inventário e estoque da loja.
+    # SUM(delta) por (aventureiro, recurso) reconstrói o saldo. Sem FK para sobreviver à remoção do jogador.
+    __table_args__ = (db.Index('ix_ledger_aventureiro_recurso', 'aventureiro_id', 'recurso', 'id'),)
+    id = db.Column(db.Integer, primary_key=True)
+    timestamp = db.Column(db.DateTime, default=datetime.now, index=True)
+    aventureiro_id = db.Column(db.Integer, nullable=True)
+    loja_item_id = db.Column(db.Integer, nullable=True, index=True)
+    recurso = db.Column(db.String(120), nullable=False) # 'kaicons', 'item:<nome normalizado>' ou 'estoque'
+    delta = db.Column(db.Integer, nullable=False)
+    motivo = db.Column(db.String(200), nullable=False)
+    def to_dict(self):
+        return {
+            "id": self.id, "timestamp": self.timestamp.strftime("%d/%m %H:%M:%S"), "aventureiro_id": self.aventureiro_id,
+            "loja_item_id": self.loja_item_id, "recurso": self.recurso, "delta": self.delta, "motivo": self.motivo
+        }
+# Agregados mantidos pelas próprias escritas, no mesmo commit (ver somar_estatistica_*): rankings e
+# estatísticas leem só o topo destes índices, sem varrer informes nem carregar todos os aventureiros.
+class EstatisticaJogador(db.Model):
+    __table_args__ = (db.Index('ix_estatistica_jogador_tarefas', 'tarefas_concluidas'),
+                      db.Index('ix_estatistica_jogador_producao', 'itens_produzidos'))
+    aventureiro_id = db.Column(db.Integer, db.ForeignKey('aventureiro.id', ondelete='CASCADE'), primary_key=True)
+    tarefas_concluidas = db.Column(db.Integer, nullable=False, default=0)
+    itens_produzidos = db.Column(db.Integer, nullable=False, default=0)
+    compras_loja = db.Column(db.Integer, nullable=False, default=0)
+    kaicons_gastos_loja = db.Column(db.Integer, nullable=False, default=0)
+class EstatisticaGlobal(db.Model):
+    # Totais da campanha por chave (ex.: 'kaicons_em_circulacao', 'tarefas_concluidas')
+    chave = db.Column(db.String(60), primary_key=True)
+    valor = db.Column(db.BigInteger, nullable=False, default=0)
+class EstatisticaItemLoja(db.Model):
+    # Vendas por item, pelo nome: sobrevive à remoção e recriação do item na loja
+    __table_args__ = (db.Index('ix_estatistica_item_loja_quantidade', 'quantidade'),)
+    item = db.Column(db.String(100), primary_key=True)
+    quantidade = db.Column(db.Integer, nullable=False, default=0)
+    receita = db.Column(db.Integer, nullable=False, default=0)
+class VersaoTabela(db.Model):
+    # Contador por tabela, incrementado na mesma transação de qualquer escrita (ver contar_alteracoes)
+    nome = db.Column(db.String(100), primary_key=True)
+    versao = db.Column(db.Integer, nullable=False, default=0)
+
 # --- FUNÇÕES HELPER ---
 def get_lista_nomes_jogadores():
     try:
-        aventureiros = Aventureiro.query.all()
-        return [a.nome_aventureiro for a in aventureiros]
+        return [nome for (nome,) in db.session.query(Aventureiro.nome_aventureiro).order_by(Aventureiro.id)]
     except Exception as e:
         print(f"Erro ao buscar jogadores do DB: {e}")
         return []
@@ -170,33 +500,1139 @@ def calcular_atribuicao(dia, jogadores, tarefas):
             "descricao": tarefa.descricao, "atribuido_a": jogador_designado
         })
     return atribuicoes
-def adicionar_informe(texto):
-    try:
-        novo_informe = RegistroInformes(texto=texto)
-        db.session.add(novo_informe)
+# --- ESCALA DO RODÍZIO (cache) ---
+# A escala de um dia só muda com a data, a lista de aventureiros ou os tipos de tarefa. Cada worker guarda os
+# dias já calculados, com o índice por jogador, chaveados por (dia, versão da lista, versão do rodízio).
+TarefaRodizio = namedtuple('TarefaRodizio', ['id', 'nome_tarefa', 'descricao'])
+TABELAS_ESCALA = ('lista_aventureiros', 'rodizio')
+class CacheEscala:
+    def __init__(self, maximo_dias=400):
+        self.maximo_dias = maximo_dias
+        self.lock = threading.Lock()
+        self.base = (None, [], []) # (versões, nomes dos jogadores, tarefas do rodízio)
+        self.dias = OrderedDict() # (dia, versões) -> {"atribuicoes": [...], "por_jogador": {nome: [...]}}
+    def carregar_base(self):
+        versoes = tuple(versoes_tabelas(TABELAS_ESCALA))
+        with self.lock:
+            if self.base[0] == versoes: return self.base
+        jogadores = get_lista_nomes_jogadores()
+        tarefas = [TarefaRodizio(t.id, t.nome_tarefa, t.descricao) for t in Rodizio.query.order_by(Rodizio.id)]
+        with self.lock:
+            self.base = (versoes, jogadores, tarefas)
+            return self.base
+    def tarefas(self):
+        return self.carregar_base()[2]
+    def dia(self, data):
+        versoes, jogadores, tarefas = self.carregar_base()
+        chave = (data, versoes)
+        with self.lock:
+            escala = self.dias.get(chave)
+            if escala:
+                self.dias.move_to_end(chave)
+                return escala
+        atribuicoes = calcular_atribuicao(data, jogadores, tarefas)
+        por_jogador = {}
+        for atribuicao in atribuicoes:
+            por_jogador.setdefault(atribuicao['atribuido_a'], []).append(atribuicao)
+        escala = {"atribuicoes": atribuicoes, "por_jogador": por_jogador}
+        with self.lock:
+            self.dias[chave] = escala
+            while len(self.dias) > self.maximo_dias: self.dias.popitem(last=False)
+        return escala
+ESCALA_RODIZIO = CacheEscala()
+# "[LOJA] Fulano comprou ..." -> categoria LOJA, ator Fulano. Textos sem prefixo ficam como GERAL.
+REGEX_PREFIXO_INFORME = re.compile(r'^\[([^\]]+)\]\s*(.*)$', re.DOTALL)
+REGEX_ATOR_INFORME = re.compile(r"^(?:'([^']+)'|(.+?))(?: \(Lvl \d+\))? (?:comprou|marcou|produziu|enviou|avançou|juntou-se|foi removido)\b")
+def classificar_informe(texto):
+    categoria = 'GERAL'; resto = texto
+    casamento = REGEX_PREFIXO_INFORME.match(texto)
+    if casamento:
+        categoria = casamento.group(1).strip().upper()[:30]; resto = casamento.group(2)
+    if categoria == 'GM':
+        return categoria, 'GM'
+    if resto.startswith('Aventureiro '): resto = resto[len('Aventureiro '):]
+    if resto.startswith('BKP do Kaipora de '): resto = resto[len('BKP do Kaipora de '):].replace(' sincronizado', ' enviou', 1)
+    casamento = REGEX_ATOR_INFORME.match(resto)
+    return categoria, ((casamento.group(1) or casamento.group(2))[:100] if casamento else None)
+def classificar_informes_antigos(lote=500):
+    # Preenche categoria/ator das linhas gravadas antes das colunas existirem (idempotente)
+    total = 0
+    while True:
+        pendentes = RegistroInformes.query.filter(RegistroInformes.categoria.is_(None)).limit(lote).all()
+        if not pendentes: break
+        for informe in pendentes:
+            informe.categoria, informe.ator = classificar_informe(informe.texto)
         db.session.commit()
-    except Exception as e:
-        print(f"Erro ao adicionar informe ao log: {e}")
-        db.session.rollback()
+        total += len(pendentes)
+    if total:
+        print(f"Informes antigos classificados: {total}")
+def adicionar_informe(texto, categoria=None, ator=None):
+    # Não faz commit: o informe fica no buffer da sessão (um por requisição/contexto) e é gravado
+    # no próximo commit de quem chamou, junto com a alteração que ele descreve. Rollback descarta o buffer.
+    categoria_texto, ator_texto = classificar_informe(texto)
+    db.session.info.setdefault('informes_pendentes', []).append({
+        "timestamp": datetime.now(), "texto": texto,
+        "categoria": categoria or categoria_texto, "ator": ator or ator_texto
+    })
+def gravar_informes(conexao, linhas, session=None):
+    # INSERT de várias linhas de uma vez (informes + eventos SSE correspondentes).
+    # Com session (commit do handler) as versões entram no UPDATE único do commit; na thread de informes saem já.
+    for inicio in range(0, len(linhas), 200):
+        parte = linhas[inicio:inicio + 200]
+        conexao.execute(db.insert(RegistroInformes).values(parte))
+        conexao.execute(db.insert(EventoStream).values([{
+            "timestamp": linha["timestamp"], "tipo": 'informe',
+            "dados": json.dumps({
+                "texto": linha["texto"], "categoria": linha["categoria"], "ator": linha["ator"],
+                "timestamp": linha["timestamp"].strftime("%d/%m %H:%M")
+            }, ensure_ascii=False)
+        } for linha in parte]))
+    podar_eventos(conexao)
+    marcar_alterado('registro_informes', 'evento_stream', session=session, conexao=None if session else conexao)
+@event.listens_for(db.session, 'before_commit')
+def gravar_informes_pendentes(session):
+    linhas = session.info.pop('informes_pendentes', None)
+    if not linhas: return
+    if app.config["INFORMES_ASSINCRONOS"]:
+        session.info['informes_pos_commit'] = linhas
+        return
+    gravar_informes(session.connection(), linhas, session=session)
+    session.info['eventos_pendentes'] = True
+@event.listens_for(db.session, 'after_commit')
+def enfileirar_informes_assincronos(session):
+    linhas = session.info.pop('informes_pos_commit', None)
+    if linhas: ESCRITOR_INFORMES.enfileirar(linhas)
+@event.listens_for(db.session, 'after_rollback')
+def descartar_informes_pendentes(session):
+    session.info.pop('informes_pendentes', None)
+    session.info.pop('informes_pos_commit', None)
+class EscritorInformes:
+    # Thread opcional (INFORMES_ASSINCRONOS): junta informes já confirmados de várias requisições
+    # e grava tudo num único INSERT multi-linha por intervalo.
+    def __init__(self):
+        self.fila = queue.Queue()
+        self.iniciado = False
+        self.trava = threading.Lock()
+    def enfileirar(self, linhas):
+        with self.trava:
+            if not self.iniciado:
+                self.iniciado = True
+                threading.Thread(target=self.loop, name='escritor-informes', daemon=True).start()
+        self.fila.put(linhas)
+    def loop(self):
+        intervalo = app.config["INFORMES_LOTE_INTERVALO"]
+        with app.app_context():
+            while True:
+                lote = list(self.fila.get())
+                time.sleep(intervalo)
+                while not self.fila.empty():
+                    lote.extend(self.fila.get_nowait())
+                try:
+                    with db.engine.begin() as conexao:
+                        gravar_informes(conexao, lote)
+                    EVENTOS_HUB.sinal_tail.set()
+                except Exception as e:
+                    print(f"Erro ao gravar lote de {len(lote)} informes: {e}")
+ESCRITOR_INFORMES = EscritorInformes()
 def calcular_xp_necessario(nivel):
     return nivel * 100
+class CurvaXP:
+    # custos[n - 1] = XP para passar do nível n ao n + 1; acumulado[n] = XP total para chegar ao nível n (acumulado[1] = 0).
+    # Com regra, a tabela cresce sob demanda até NIVEIS_MAXIMOS; depois do fim da tabela cada nível custa como o último.
+    NIVEIS_MAXIMOS = 1_000_000
+    def __init__(self, custos=(), regra=None):
+        self.lock = threading.Lock()
+        self.regra = regra
+        self.custos = []; self.acumulado = [0, 0]
+        self._acrescentar(list(custos) or [regra(n) for n in range(1, 101)])
+    @classmethod
+    def do_arquivo(cls, caminho):
+        with open(caminho, newline='', encoding='utf-8') as arquivo:
+            linhas = sorted((int(nivel), int(xp)) for nivel, xp in (l[:2] for l in csv.reader(arquivo) if l and l[0].strip().isdigit()))
+        if not linhas or [nivel for nivel, _ in linhas] != list(range(1, len(linhas) + 1)):
+            raise ValueError(f"Curva de XP em '{caminho}' precisa listar os níveis 1, 2, 3... sem buracos.")
+        return cls([xp for _, xp in linhas])
+    def _acrescentar(self, custos):
+        if any(custo <= 0 for custo in custos): raise ValueError("Todo nível da curva de XP precisa custar mais que 0.")
+        for custo in custos: # acumulado antes: quem lê sem a trava sempre acha acumulado[len(custos) + 1]
+            self.acumulado.append(self.acumulado[-1] + custo); self.custos.append(custo)
+    def _curta(self, nivel, total):
+        return len(self.custos) < self.NIVEIS_MAXIMOS and ((nivel is not None and nivel > len(self.custos)) or
+                                                           (total is not None and total >= self.acumulado[-1]))
+    def _garantir(self, nivel=None, total=None):
+        # Só a curva por regra cresce (dobrando), e só até NIVEIS_MAXIMOS
+        if self.regra is None or not self._curta(nivel, total): return
+        with self.lock:
+            while self._curta(nivel, total):
+                inicio = len(self.custos) + 1
+                fim = min(inicio + len(self.custos), self.NIVEIS_MAXIMOS + 1)
+                self._acrescentar([self.regra(n) for n in range(inicio, fim)])
+    def custo(self, nivel):
+        nivel = max(nivel, 1); self._garantir(nivel=nivel)
+        return self.custos[min(nivel, len(self.custos)) - 1]
+    def xp_total(self, nivel, xp):
+        # XP acumulado na vida do personagem: o que gastou para chegar ao nível + o que tem agora
+        nivel = max(nivel or 1, 1); self._garantir(nivel=nivel)
+        ultimo = len(self.custos) + 1
+        if nivel <= ultimo: return self.acumulado[nivel] + (xp or 0)
+        return self.acumulado[ultimo] + (nivel - ultimo) * self.custos[-1] + (xp or 0)
+    def nivel_para(self, total):
+        # (nível, XP que sobra dentro dele) para um XP total: busca binária nas somas prefixadas
+        self._garantir(total=total)
+        ultimo = len(self.custos) + 1
+        if total >= self.acumulado[ultimo]:
+            excedente = total - self.acumulado[ultimo]
+            return ultimo + excedente // self.custos[-1], excedente % self.custos[-1]
+        nivel = bisect.bisect_right(self.acumulado, total, 1) - 1
+        return nivel, total - self.acumulado[nivel]
+CURVA_XP = CurvaXP.do_arquivo(app.config["XP_CURVA_ARQUIVO"]) if app.config["XP_CURVA_ARQUIVO"] else CurvaXP(regra=calcular_xp_necessario)
 def verificar_level_up(aventureiro):
-    xp_necessario = calcular_xp_necessario(aventureiro.nivel)
-    upou = False
-    while aventureiro.xp >= xp_necessario:
-        aventureiro.xp -= xp_necessario
-        aventureiro.nivel += 1
-        upou = True
-        log_msg = f"[NÍVEL] {aventureiro.nome_aventureiro} avançou para o Nível {aventureiro.nivel}!"
-        adicionar_informe(log_msg)
-        print(log_msg)
-        xp_necessario = calcular_xp_necessario(aventureiro.nivel)
-    return upou
-def adicionar_alerta_global(texto):
-    global ALERTAS_DB
-    ALERTAS_DB.insert(0, texto)
-    if len(ALERTAS_DB) > 5:
-        ALERTAS_DB.pop()
+    # Vai direto ao nível final (sem laço por nível) e escreve um único informe, por maior que seja o ganho de XP.
+    # Nunca rebaixa: XP negativo ou nível ajustado à mão acima da curva ficam como estão.
+    anterior = aventureiro.nivel or 1
+    nivel, resto = CURVA_XP.nivel_para(CURVA_XP.xp_total(anterior, aventureiro.xp))
+    if nivel <= anterior: return False
+    aventureiro.nivel, aventureiro.xp = nivel, resto
+    if nivel == anterior + 1:
+        log_msg = f"[NÍVEL] {aventureiro.nome_aventureiro} avançou para o Nível {nivel}!"
+    else:
+        log_msg = f"[NÍVEL] {aventureiro.nome_aventureiro} avançou {nivel - anterior} níveis, do {anterior} para o Nível {nivel}!"
+    adicionar_informe(log_msg, categoria='NÍVEL', ator=aventureiro.nome_aventureiro)
+    print(log_msg)
+    return True
+def adicionar_alerta_global(texto, ttl=None):
+    # Entra na transação de quem chamou (o chamador faz o commit)
+    ttl = app.config["ALERTAS_TTL"] if ttl is None else ttl
+    agora = datetime.now()
+    alerta = Alerta(texto=texto, criado_em=agora, expira_em=agora + timedelta(seconds=ttl) if ttl else None)
+    db.session.add(alerta)
+    Alerta.query.filter(Alerta.expira_em < agora).delete() # Poda os vencidos
+    db.session.flush()
+    publicar_evento('alerta', alerta.to_dict())
+    return alerta
+# Cada worker guarda os alertas vigentes carimbados com a versão da tabela 'alerta'; só relê quando a versão
+# muda ou quando o próximo alerta da lista vence.
+class CacheAlertas:
+    def __init__(self, limite=5):
+        self.limite = limite
+        self.lock = threading.Lock()
+        self.versao = None
+        self.vigentes = [] # Mais recentes primeiro
+        self.proxima_expiracao = None
+    def listar(self):
+        versao = versoes_tabelas(('alerta',))[0]
+        agora = datetime.now()
+        with self.lock:
+            if versao == self.versao and (self.proxima_expiracao is None or agora < self.proxima_expiracao):
+                return self.vigentes
+        alertas = Alerta.query.filter(db.or_(Alerta.expira_em.is_(None), Alerta.expira_em > agora)).order_by(Alerta.id.desc()).limit(self.limite).all()
+        vigentes = [a.to_dict() for a in alertas]
+        expiracoes = [a.expira_em for a in alertas if a.expira_em]
+        with self.lock:
+            self.versao, self.vigentes = versao, vigentes
+            self.proxima_expiracao = min(expiracoes) if expiracoes else None
+            return vigentes
+ALERTAS_CACHE = CacheAlertas()
+
+# --- TRANSAÇÕES ECONÔMICAS (kaicons, estoque, ledger) ---
+# No SQLite o pysqlite abre transações por conta própria; desligamos isso e emitimos o BEGIN nós mesmos,
+# para poder pedir BEGIN IMMEDIATE (trava de escrita já no início) nas operações disputadas.
+TRANSACAO_LOCAL = threading.local()
+@event.listens_for(Engine, 'connect')
+def configurar_conexao_sqlite(conexao_dbapi, registro):
+    if isinstance(conexao_dbapi, sqlite3.Connection):
+        conexao_dbapi.isolation_level = None
+        cursor = conexao_dbapi.cursor()
+        for pragma, valor in app.config.get('SQLITE_PRAGMAS', {}).items():
+            cursor.execute(f"PRAGMA {pragma} = {valor}")
+        cursor.close()
+@event.listens_for(Engine, 'begin')
+def iniciar_transacao_sqlite(conexao):
+    if conexao.dialect.name == 'sqlite':
+        conexao.exec_driver_sql("BEGIN IMMEDIATE" if getattr(TRANSACAO_LOCAL, 'imediata', False) else "BEGIN")
+class OperacaoRecusada(Exception):
+    # Regra de negócio violada dentro de transacao_imediata(): desfaz tudo e vira um 400 na rota
+    pass
+@contextmanager
+def transacao_imediata():
+    db.session.commit() # Fecha a transação de leitura aberta pelos lookups anteriores
+    TRANSACAO_LOCAL.imediata = True
+    try:
+        db.session.connection()
+    finally:
+        TRANSACAO_LOCAL.imediata = False
+    try:
+        yield
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+def registrar_ledger(recurso, delta, motivo, aventureiro_id=None, loja_item_id=None):
+    db.session.add(LedgerEntry(recurso=recurso, delta=delta, motivo=motivo[:200], aventureiro_id=aventureiro_id, loja_item_id=loja_item_id))
+    if recurso == 'kaicons' and aventureiro_id is not None: somar_estatistica_global(kaicons_em_circulacao=delta)
+
+# --- ESTATÍSTICAS (agregados incrementais) ---
+# Como os informes: os incrementos ficam no buffer da sessão e viram um UPSERT por linha no before_commit,
+# na mesma transação da escrita que os gerou. Rollback descarta o buffer.
+CAMPOS_ESTATISTICA_JOGADOR = ('tarefas_concluidas', 'itens_produzidos', 'compras_loja', 'kaicons_gastos_loja')
+def _acumular_estatistica(tipo, chave, deltas):
+    alvo = db.session.info.setdefault('estatisticas_pendentes', {}).setdefault(tipo, {}).setdefault(chave, {})
+    for campo, delta in deltas.items():
+        if delta: alvo[campo] = alvo.get(campo, 0) + delta
+def somar_estatistica_global(**deltas):
+    for chave, delta in deltas.items(): _acumular_estatistica('global', chave, {"valor": delta})
+def somar_estatistica_jogador(aventureiro_id, **deltas):
+    _acumular_estatistica('jogador', aventureiro_id, deltas)
+def somar_venda_item(item, quantidade, receita):
+    _acumular_estatistica('item', item, {"quantidade": quantidade, "receita": receita})
+def contar_tarefa_concluida(aventureiro, tarefa):
+    somar_estatistica_jogador(aventureiro.id, tarefas_concluidas=1)
+    somar_estatistica_global(tarefas_concluidas=1, xp_recompensas=tarefa.xp_reward, kaicons_recompensas=tarefa.kc_reward)
+def upsert_somando(conexao, modelo, chave, linhas):
+    # linhas: {valor da chave: {campo: delta}} -> INSERT ... ON CONFLICT DO UPDATE campo = campo + delta
+    tabela = modelo.__table__
+    for valor_chave, deltas in linhas.items():
+        if not deltas: continue
+        stmt = insert_com_conflito(modelo).values({chave: valor_chave, **deltas})
+        conexao.execute(stmt.on_conflict_do_update(
+            index_elements=[chave], set_={campo: tabela.c[campo] + stmt.excluded[campo] for campo in deltas}))
+@event.listens_for(db.session, 'before_commit')
+def gravar_estatisticas_pendentes(session):
+    pendentes = session.info.pop('estatisticas_pendentes', None)
+    if not pendentes: return
+    conexao = session.connection()
+    upsert_somando(conexao, EstatisticaGlobal, 'chave', pendentes.get('global', {}))
+    upsert_somando(conexao, EstatisticaJogador, 'aventureiro_id', pendentes.get('jogador', {}))
+    upsert_somando(conexao, EstatisticaItemLoja, 'item', pendentes.get('item', {}))
+    marcar_alterado(*[nome for tipo, nome in (('global', 'estatistica_global'), ('jogador', 'estatistica_jogador'),
+                                              ('item', 'estatistica_item_loja')) if pendentes.get(tipo)], session=session)
+@event.listens_for(db.session, 'after_rollback')
+def descartar_estatisticas_pendentes(session):
+    session.info.pop('estatisticas_pendentes', None)
+REGEX_INFORME_COMPRA = re.compile(r"^\[LOJA\] (.+) comprou (?:(\d+)x )?'(.+)' por (\d+) KÇ\.$") # Total da linha; sem "Nx" = 1 unidade
+REGEX_INFORME_PRODUCAO = re.compile(r"^\[OFICINA\] (.+) produziu (\d+)x '(.+)'\.$")
+REGEX_INFORME_TAREFA = re.compile(r"^\[GM\] aprovou a tarefa '.*' para (.+) \(\+(-?\d+) XP, \+(-?\d+) KÇ\)\.$")
+def migrar_estatisticas(lote=1000):
+    # Primeira vez: reconstrói os agregados a partir dos saldos atuais e do histórico de informes (uma varredura só)
+    if db.session.get(EstatisticaGlobal, 'jogadores') is not None: return
+    db.session.query(EstatisticaGlobal).delete(); db.session.query(EstatisticaJogador).delete(); db.session.query(EstatisticaItemLoja).delete()
+    ids = dict(db.session.query(Aventureiro.nome_aventureiro, Aventureiro.id))
+    totais = {"jogadores": len(ids), "kaicons_em_circulacao": db.session.query(db.func.coalesce(db.func.sum(Aventureiro.kaicons), 0)).scalar(),
+              "tarefas_concluidas": 0, "xp_recompensas": 0, "kaicons_recompensas": 0, "itens_produzidos": 0, "vendas_loja": 0, "kaicons_gastos_loja": 0}
+    jogadores = {}; itens = {}
+    consulta = db.session.query(RegistroInformes.texto).filter(db.or_(
+        RegistroInformes.texto.like('[LOJA]%'), RegistroInformes.texto.like('[OFICINA]%'), RegistroInformes.texto.like('[GM] aprovou a tarefa%')))
+    for (texto,) in consulta.yield_per(lote):
+        if (casamento := REGEX_INFORME_COMPRA.match(texto)):
+            nome, quantidade, item, total = casamento.group(1), int(casamento.group(2) or 1), casamento.group(3), int(casamento.group(4))
+            totais["vendas_loja"] += quantidade; totais["kaicons_gastos_loja"] += total
+            venda = itens.setdefault(item[:100], {"quantidade": 0, "receita": 0}); venda["quantidade"] += quantidade; venda["receita"] += total
+            campos = {"compras_loja": quantidade, "kaicons_gastos_loja": total}
+        elif (casamento := REGEX_INFORME_PRODUCAO.match(texto)):
+            nome, quantidade = casamento.group(1), int(casamento.group(2))
+            totais["itens_produzidos"] += quantidade
+            campos = {"itens_produzidos": quantidade}
+        elif (casamento := REGEX_INFORME_TAREFA.match(texto)):
+            nome = casamento.group(1)
+            totais["tarefas_concluidas"] += 1; totais["xp_recompensas"] += int(casamento.group(2)); totais["kaicons_recompensas"] += int(casamento.group(3))
+            campos = {"tarefas_concluidas": 1}
+        else: continue
+        if nome in ids: # Jogadores removidos contam só nos totais
+            linha = jogadores.setdefault(ids[nome], dict.fromkeys(CAMPOS_ESTATISTICA_JOGADOR, 0))
+            for campo, valor in campos.items(): linha[campo] += valor
+    db.session.add_all([EstatisticaGlobal(chave=chave, valor=valor) for chave, valor in totais.items()])
+    db.session.add_all([EstatisticaJogador(aventureiro_id=aventureiro_id, **campos) for aventureiro_id, campos in jogadores.items()])
+    db.session.add_all([EstatisticaItemLoja(item=item, **venda) for item, venda in itens.items()])
+    db.session.info.pop('estatisticas_pendentes', None) # Os valores acima já são absolutos
+    db.session.commit()
+    print(f"Estatísticas reconstruídas: {len(jogadores)} jogadores, {len(itens)} itens da loja")
+
+# --- VENDAS DA LOJA ---
+def vender_itens(comprador, pedidos):
+    # pedidos: [(loja_item_id, quantidade)]. Chamar dentro de transacao_imediata(): o carrinho é tudo ou nada.
+    # O estoque sai por UPDATE condicional (mover_estoque), então dois jogadores nunca levam a última unidade.
+    quantidades = {}
+    for item_id, quantidade in pedidos: quantidades[item_id] = quantidades.get(item_id, 0) + quantidade
+    itens = {item.id: item for item in LojaItem.query.filter(LojaItem.id.in_(list(quantidades)))}
+    faltando = sorted(set(quantidades) - set(itens))
+    if faltando:
+        raise OperacaoRecusada(f"Item não encontrado na loja: {', '.join(map(str, faltando))}.")
+    nome = comprador.nome_aventureiro
+    agora = datetime.now(); vendas = []
+    for item_id, quantidade in sorted(quantidades.items()): # Ordem fixa de UPDATEs entre carrinhos concorrentes
+        item = itens[item_id]
+        if not mover_estoque(item, -quantidade, f"venda para {nome}"):
+            raise OperacaoRecusada("Item fora de estoque." if quantidade == 1 else f"Estoque insuficiente de '{item.nome}' para {quantidade} unidades.")
+        inventario_somar(comprador, normalizar_item(item.nome), quantidade, f"compra na loja (item {item.id})")
+        venda = LojaVenda(timestamp=agora, loja_item_id=item.id, item_nome=item.nome, aventureiro_id=comprador.id, aventureiro_nome=nome,
+                          quantidade=quantidade, preco_unitario=item.preco, total=item.preco * quantidade)
+        db.session.add(venda); vendas.append(venda)
+        somar_venda_item(item.nome, quantidade, venda.total)
+        adicionar_informe(venda.texto(), categoria='LOJA', ator=nome)
+    total = sum(v.total for v in vendas); unidades = sum(v.quantidade for v in vendas)
+    motivo = f"compra de '{vendas[0].item_nome}'" if len(vendas) == 1 else f"compra na loja ({len(vendas)} itens)"
+    if not mover_kaicons(comprador, -total, motivo):
+        raise OperacaoRecusada("Kaicons insuficientes.")
+    somar_estatistica_jogador(comprador.id, compras_loja=unidades, kaicons_gastos_loja=total)
+    somar_estatistica_global(vendas_loja=unidades, kaicons_gastos_loja=total)
+    return vendas
+def proxima_reposicao(reposicao, agora):
+    # Mantém a cadência; vencimentos perdidos (servidor parado) não se acumulam
+    proxima = reposicao.proxima_em + timedelta(minutes=reposicao.intervalo_minutos)
+    return proxima if proxima > agora else agora + timedelta(minutes=reposicao.intervalo_minutos)
+def executar_reposicoes(agora):
+    # Chamada pelo agendador de cada worker. O UPDATE condicional em proxima_em reserva o vencimento:
+    # só um worker repõe, mesmo que vários vejam a mesma reposição vencida.
+    vencidas = [r for (r,) in db.session.query(ReposicaoLoja.id).filter(ReposicaoLoja.proxima_em <= agora)]
+    repostas = 0
+    for reposicao_id in vencidas:
+        with transacao_imediata():
+            reposicao = db.session.get(ReposicaoLoja, reposicao_id)
+            if reposicao is None or reposicao.proxima_em > agora: continue
+            reservada = db.session.execute(db.update(ReposicaoLoja).where(
+                ReposicaoLoja.id == reposicao.id, ReposicaoLoja.proxima_em == reposicao.proxima_em
+            ).values(proxima_em=proxima_reposicao(reposicao, agora))).rowcount
+            if reservada != 1: continue
+            marcar_alterado('reposicao_loja') # proxima_em mudou mesmo que não haja nada a repor (delta 0)
+            db.session.expire(reposicao, ['proxima_em'])
+            item = reposicao.item
+            delta = reposicao.quantidade if reposicao.maximo is None else max(0, min(reposicao.quantidade, reposicao.maximo - item.estoque))
+            if delta:
+                mover_estoque(item, delta, "reposição automática")
+                adicionar_informe(f"[LOJA] Reposição automática: +{delta} '{item.nome}' (Estoque: {item.estoque}).")
+                repostas += 1
+    return repostas
+def migrar_vendas_loja(lote=1000):
+    # Bancos anteriores à tabela loja_venda: recria as vendas a partir dos informes da loja (uma vez)
+    if db.session.query(LojaVenda.id).first() is not None: return
+    itens = dict(db.session.query(LojaItem.nome, LojaItem.id)); ids = dict(db.session.query(Aventureiro.nome_aventureiro, Aventureiro.id))
+    linhas = []
+    consulta = db.session.query(RegistroInformes.timestamp, RegistroInformes.texto).filter(
+        RegistroInformes.categoria == 'LOJA', RegistroInformes.texto.like('[LOJA]%comprou%'))
+    for timestamp, texto in consulta.yield_per(lote):
+        if not (casamento := REGEX_INFORME_COMPRA.match(texto)): continue
+        nome, quantidade, item, total = casamento.group(1), int(casamento.group(2) or 1), casamento.group(3), int(casamento.group(4))
+        linhas.append({"timestamp": timestamp, "loja_item_id": itens.get(item), "item_nome": item[:100], "aventureiro_id": ids.get(nome),
+                       "aventureiro_nome": nome[:100], "quantidade": quantidade, "preco_unitario": total // quantidade, "total": total})
+    if not linhas: return
+    db.session.execute(db.insert(LojaVenda), linhas)
+    marcar_alterado('loja_venda')
+    db.session.commit()
+    print(f"Vendas da loja migradas dos informes: {len(linhas)}")
+def mover_kaicons(aventureiro, delta, motivo):
+    # UPDATE condicional: nunca deixa o saldo negativo, mesmo com requisições concorrentes
+    if delta == 0: return True
+    condicoes = [Aventureiro.id == aventureiro.id]
+    if delta < 0: condicoes.append(Aventureiro.kaicons >= -delta)
+    resultado = db.session.execute(db.update(Aventureiro).where(*condicoes).values(kaicons=Aventureiro.kaicons + delta))
+    if resultado.rowcount != 1: return False
+    registrar_ledger('kaicons', delta, motivo, aventureiro_id=aventureiro.id)
+    marcar_alterado('aventureiro')
+    anotar_aventureiros_alterados(aventureiro.id)
+    db.session.expire(aventureiro, ['kaicons'])
+    return True
+def mover_estoque(item, delta, motivo):
+    if delta == 0: return True
+    condicoes = [LojaItem.id == item.id]
+    if delta < 0: condicoes.append(LojaItem.estoque >= -delta)
+    resultado = db.session.execute(db.update(LojaItem).where(*condicoes).values(estoque=LojaItem.estoque + delta))
+    if resultado.rowcount != 1: return False
+    registrar_ledger('estoque', delta, motivo, loja_item_id=item.id)
+    marcar_alterado('loja_item')
+    db.session.expire(item, ['estoque'])
+    return True
+def saldos_pelo_ledger(recurso='kaicons'):
+    linhas = db.session.query(LedgerEntry.aventureiro_id, db.func.sum(LedgerEntry.delta)).filter(
+        LedgerEntry.recurso == recurso, LedgerEntry.aventureiro_id.isnot(None)
+    ).group_by(LedgerEntry.aventureiro_id).all()
+    return {aventureiro_id: total for aventureiro_id, total in linhas}
+def abrir_ledger_existente():
+    # Bancos anteriores ao ledger: lança o saldo atual de cada conta como entrada de abertura (idempotente)
+    com_ledger = {i for (i,) in db.session.query(LedgerEntry.aventureiro_id).filter(LedgerEntry.aventureiro_id.isnot(None)).distinct()}
+    for aventureiro in Aventureiro.query.filter(Aventureiro.id.notin_(com_ledger)).all():
+        registrar_ledger('kaicons', aventureiro.kaicons or 0, 'saldo de abertura (migração)', aventureiro_id=aventureiro.id)
+        for item in aventureiro.itens:
+            registrar_ledger(f'item:{item.item_norm}', item.quantidade, 'saldo de abertura (migração)', aventureiro_id=aventureiro.id)
+    itens_com_ledger = {i for (i,) in db.session.query(LedgerEntry.loja_item_id).filter(LedgerEntry.loja_item_id.isnot(None)).distinct()}
+    for item in LojaItem.query.filter(LojaItem.id.notin_(itens_com_ledger)).all():
+        registrar_ledger('estoque', item.estoque or 0, 'estoque de abertura (migração)', loja_item_id=item.id)
+    db.session.commit()
+
+# --- INVENTÁRIO (InventarioItem) ---
+# Alterações são UPDATEs atômicos (quantidade = quantidade ± n), nunca ler-modificar-gravar em Python.
+def normalizar_item(nome):
+    return nome.strip().lower()
+def insert_com_conflito(modelo):
+    # INSERT ... ON CONFLICT do dialeto em uso (SQLite ou Postgres)
+    if db.engine.dialect.name == 'postgresql':
+        return dialeto_postgresql.insert(modelo)
+    return dialeto_sqlite.insert(modelo)
+def inventario_somar(aventureiro, item_norm, quantia, motivo='ajuste'):
+    stmt = insert_com_conflito(InventarioItem).values(aventureiro_id=aventureiro.id, item_norm=item_norm, quantidade=quantia)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['aventureiro_id', 'item_norm'],
+        set_={"quantidade": InventarioItem.__table__.c.quantidade + stmt.excluded.quantidade}
+    )
+    db.session.execute(stmt)
+    registrar_ledger(f'item:{item_norm}', quantia, motivo, aventureiro_id=aventureiro.id)
+    marcar_alterado('inventario_item')
+    db.session.expire(aventureiro, ['itens'])
+def inventario_retirar(aventureiro, item_norm, quantia, motivo='ajuste'):
+    # Só retira se houver o suficiente; devolve False (sem alterar nada) caso contrário
+    resultado = db.session.execute(
+        db.update(InventarioItem)
+        .where(InventarioItem.aventureiro_id == aventureiro.id, InventarioItem.item_norm == item_norm, InventarioItem.quantidade >= quantia)
+        .values(quantidade=InventarioItem.quantidade - quantia)
+    )
+    if resultado.rowcount != 1: return False
+    db.session.execute(
+        db.delete(InventarioItem).where(InventarioItem.aventureiro_id == aventureiro.id, InventarioItem.item_norm == item_norm, InventarioItem.quantidade <= 0)
+    )
+    registrar_ledger(f'item:{item_norm}', -quantia, motivo, aventureiro_id=aventureiro.id)
+    marcar_alterado('inventario_item')
+    db.session.expire(aventureiro, ['itens'])
+    return True
+def inventario_quantia(aventureiro, item_norm):
+    quantia = db.session.query(InventarioItem.quantidade).filter_by(aventureiro_id=aventureiro.id, item_norm=item_norm).scalar()
+    return quantia or 0
+def migrar_inventarios():
+    # Converte os blobs JSON antigos de Aventureiro.inventario em linhas de InventarioItem (idempotente)
+    pendentes = Aventureiro.query.filter(Aventureiro.inventario.isnot(None), Aventureiro.inventario.notin_(['', '{}'])).all()
+    for aventureiro in pendentes:
+        try:
+            inventario = json.loads(aventureiro.inventario)
+        except json.JSONDecodeError:
+            print(f"Inventário ilegível de '{aventureiro.nome_aventureiro}', ignorado na migração.")
+            inventario = {}
+        for item, quantia in inventario.items():
+            if int(quantia) > 0:
+                inventario_somar(aventureiro, normalizar_item(item), int(quantia), 'migração do inventário JSON')
+        aventureiro.inventario = '{}'
+    if pendentes:
+        print(f"Inventários migrados para a tabela inventario_item: {len(pendentes)}")
+    db.session.commit()
+
+# --- BACKUP DOS ARQUIVOS (armazém de blocos) ---
+# O backup é dividido em blocos de ~BACKUP_BLOCO_BYTES com fronteiras definidas pelo conteúdo, cada bloco comprimido
+# e guardado pelo sha256 do seu conteúdo. Trocar o backup só grava os blocos que ainda não existem; o status leva
+# apenas hash e tamanho.
+def hash_bloco(dados):
+    return hashlib.sha256(dados).hexdigest()
+def hash_manifesto(hashes):
+    return hashlib.sha256('\n'.join(hashes).encode('ascii')).hexdigest()
+def comprimir_bloco(dados):
+    if zstandard: return 'zstd', zstandard.ZstdCompressor(level=3).compress(dados)
+    return 'zlib', zlib.compress(dados, 6)
+def descomprimir_bloco(compressao, dados):
+    if compressao == 'zstd':
+        if not zstandard: raise RuntimeError("Bloco de backup em zstd, mas o pacote 'zstandard' não está instalado.")
+        return zstandard.ZstdDecompressor().decompress(dados)
+    return zlib.decompress(dados)
+# Gear hash rolante (como no FastCDC): 256 inteiros de 64 bits tirados do sha256 de cada byte, para que um cliente
+# do upload incremental consiga reproduzir as mesmas fronteiras (parâmetros em GET /api/aventureiro/backup/manifesto)
+GEAR_BACKUP = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'big') for i in range(256)]
+def parametros_divisao():
+    medio = app.config["BACKUP_BLOCO_BYTES"]
+    return {"algoritmo": "gear-sha256", "minimo": max(medio // 4, 64), "maximo": medio * 4, "bits": max(medio.bit_length() - 1, 1)}
+def dividir_em_blocos(conteudo):
+    # Corta onde os `bits` mais altos do hash zeram: a fronteira depende só dos últimos 64 bytes, então um byte
+    # inserido ou removido muda apenas os blocos em volta dele e o resto do backup continua deduplicando.
+    # O hash só começa depois do mínimo do bloco; sem corte até o máximo, corta no máximo.
+    parametros = parametros_divisao()
+    minimo, maximo, limiar = parametros["minimo"], parametros["maximo"], 1 << (64 - parametros["bits"])
+    blocos = []; inicio = 0; total = len(conteudo)
+    while inicio < total:
+        fim = corte = min(inicio + maximo, total)
+        h = 0
+        for i in range(inicio + minimo, fim):
+            h = ((h << 1) + GEAR_BACKUP[conteudo[i]]) & 0xFFFFFFFFFFFFFFFF
+            if h < limiar:
+                corte = i + 1; break
+        blocos.append(conteudo[inicio:corte]); inicio = corte
+    return blocos
+def blocos_existentes(hashes):
+    existentes = set()
+    hashes = list(set(hashes))
+    for i in range(0, len(hashes), 500): # Fica abaixo do limite de parâmetros do SQLite
+        existentes.update(h for (h,) in db.session.query(BackupBloco.hash).filter(BackupBloco.hash.in_(hashes[i:i + 500])))
+    return existentes
+def guardar_blocos(blocos):
+    # blocos: {hash: bytes originais}. Só comprime e insere os que faltam no armazém.
+    novos = [h for h in blocos if h not in blocos_existentes(blocos)]
+    linhas = []
+    for h in novos:
+        compressao, dados = comprimir_bloco(blocos[h])
+        linhas.append({"hash": h, "compressao": compressao, "tamanho": len(blocos[h]), "dados": dados, "criado_em": datetime.now()})
+    if linhas: # DO NOTHING: outro jogador pode ter gravado o mesmo bloco ao mesmo tempo
+        db.session.execute(insert_com_conflito(BackupBloco).on_conflict_do_nothing(index_elements=['hash']), linhas)
+    return len(linhas)
+def apontar_backup(aventureiro, hashes):
+    # Cria o manifesto (se for novo) e faz o aventureiro apontar para ele. Todos os blocos já devem existir.
+    manifesto_hash = hash_manifesto(hashes)
+    manifesto = db.session.get(BackupManifesto, manifesto_hash)
+    if not manifesto:
+        tamanhos = dict(db.session.query(BackupBloco.hash, BackupBloco.tamanho).filter(BackupBloco.hash.in_(set(hashes)))) if hashes else {}
+        manifesto = BackupManifesto(hash=manifesto_hash, tamanho=sum(tamanhos[h] for h in hashes))
+        db.session.add(manifesto)
+        if hashes:
+            db.session.execute(db.insert(BackupManifestoBloco), [
+                {"manifesto_hash": manifesto_hash, "posicao": posicao, "bloco_hash": h} for posicao, h in enumerate(hashes)
+            ])
+    aventureiro.backup_hash = manifesto.hash
+    aventureiro.backup_tamanho = manifesto.tamanho
+    return manifesto
+def gravar_backup_texto(aventureiro, texto):
+    blocos = {}; hashes = []
+    for bloco in dividir_em_blocos(texto.encode('utf-8')):
+        h = hash_bloco(bloco); blocos[h] = bloco; hashes.append(h)
+    guardar_blocos(blocos)
+    return apontar_backup(aventureiro, hashes)
+def podar_backups_orfaos(manifestos=None):
+    # Com manifestos (o backup que acabou de ser trocado ou o do jogador removido): apaga os que ficaram sem aventureiro
+    # e os blocos só deles, pelos índices. Sem argumento (comando 'podar-backups'): varre o armazém inteiro, o que
+    # também pega blocos de uploads incrementais abandonados. Blocos recentes ficam: podem ser de um upload em andamento.
+    em_uso = db.session.query(Aventureiro.backup_hash).filter(Aventureiro.backup_hash.isnot(None))
+    consulta = db.session.query(BackupManifesto.hash).filter(BackupManifesto.hash.notin_(em_uso))
+    if manifestos is not None:
+        manifestos = [h for h in set(manifestos) if h]
+        if not manifestos: return 0
+        consulta = consulta.filter(BackupManifesto.hash.in_(manifestos))
+    orfaos = [h for (h,) in consulta]
+    recentes = datetime.now() - timedelta(hours=1)
+    if manifestos is None:
+        if orfaos:
+            db.session.execute(db.delete(BackupManifestoBloco).where(BackupManifestoBloco.manifesto_hash.in_(orfaos)))
+            db.session.execute(db.delete(BackupManifesto).where(BackupManifesto.hash.in_(orfaos)))
+        return db.session.execute(db.delete(BackupBloco).where(
+            BackupBloco.criado_em < recentes,
+            BackupBloco.hash.notin_(db.session.query(BackupManifestoBloco.bloco_hash))
+        )).rowcount
+    if not orfaos: return 0
+    candidatos = list({h for (h,) in db.session.query(BackupManifestoBloco.bloco_hash).filter(BackupManifestoBloco.manifesto_hash.in_(orfaos))})
+    db.session.execute(db.delete(BackupManifestoBloco).where(BackupManifestoBloco.manifesto_hash.in_(orfaos)))
+    db.session.execute(db.delete(BackupManifesto).where(BackupManifesto.hash.in_(orfaos)))
+    apagados = 0
+    for i in range(0, len(candidatos), 500): # Fica abaixo do limite de parâmetros do SQLite
+        parte = candidatos[i:i + 500]
+        apagados += db.session.execute(db.delete(BackupBloco).where(
+            BackupBloco.hash.in_(parte), BackupBloco.criado_em < recentes,
+            BackupBloco.hash.notin_(db.session.query(BackupManifestoBloco.bloco_hash).filter(BackupManifestoBloco.bloco_hash.in_(parte)))
+        )).rowcount
+    return apagados
+def migrar_backups():
+    # Move os backups antigos (texto inteiro em Aventureiro.backup_arquivos) para o armazém de blocos (idempotente)
+    pendentes = Aventureiro.query.filter(Aventureiro.backup_arquivos.isnot(None), Aventureiro.backup_arquivos.notin_(['', '{}'])).all()
+    for aventureiro in pendentes:
+        gravar_backup_texto(aventureiro, aventureiro.backup_arquivos)
+        aventureiro.backup_arquivos = '{}'
+    if pendentes:
+        print(f"Backups migrados para o armazém de blocos: {len(pendentes)}")
+    db.session.commit()
+
+# --- OFICINA: GRAFO DE RECEITAS ---
+# As receitas são compiladas uma vez (JSON lido, nomes normalizados) num grafo em memória:
+# item final -> receitas que o produzem e ingrediente -> receitas que o usam. É refeito só quando a versão
+# da tabela 'receita' muda (add/delete), em qualquer worker.
+ReceitaCompilada = namedtuple('ReceitaCompilada', ['id', 'item_final', 'quantia_produzida', 'ingredientes'])
+def ler_ingredientes(texto):
+    # '{"Sucata": 2, "fio": 1}' -> (('sucata', 2), ('fio', 1)); ValueError se o formato não servir
+    bruto = json.loads(texto)
+    if not isinstance(bruto, dict) or not bruto: raise ValueError("Ingredientes devem ser um objeto não vazio.")
+    ingredientes = {}
+    for item, quantia in bruto.items():
+        if isinstance(quantia, bool) or int(quantia) != quantia or int(quantia) <= 0:
+            raise ValueError(f"Quantia inválida para '{item}'.")
+        item_norm = normalizar_item(item)
+        ingredientes[item_norm] = ingredientes.get(item_norm, 0) + int(quantia)
+    return tuple(ingredientes.items())
+class GrafoReceitas:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.versao = None
+        self.receitas = {} # id -> ReceitaCompilada
+        self.produzem = {} # item final -> [ids]
+        self.usam = {} # ingrediente -> [ids]
+    def atualizar(self):
+        versao = versoes_tabelas(('receita',))[0]
+        with self.lock:
+            if versao == self.versao: return
+        receitas = {}; produzem = {}; usam = {}
+        for receita in Receita.query.order_by(Receita.nome_item_final, Receita.id):
+            try:
+                ingredientes = ler_ingredientes(receita.ingredientes_json)
+            except (ValueError, TypeError) as e:
+                print(f"Receita {receita.id} ignorada: ingredientes ilegíveis ({e}).")
+                continue
+            compilada = ReceitaCompilada(receita.id, normalizar_item(receita.nome_item_final), receita.quantia_produzida, ingredientes)
+            receitas[receita.id] = compilada
+            produzem.setdefault(compilada.item_final, []).append(receita.id)
+            for item_norm, _ in ingredientes:
+                usam.setdefault(item_norm, []).append(receita.id)
+        with self.lock:
+            self.versao, self.receitas, self.produzem, self.usam = versao, receitas, produzem, usam
+    def receita(self, id_receita):
+        self.atualizar()
+        return self.receitas.get(id_receita)
+    def que_usam(self, item_norm):
+        self.atualizar()
+        return [self.receitas[i] for i in self.usam.get(item_norm, [])]
+    def possiveis(self, inventario):
+        # Uma passada por todas as receitas: quantas vezes cada uma pode ser feita com o inventário dado
+        self.atualizar()
+        resultado = []
+        for receita in self.receitas.values():
+            vezes = min(inventario.get(item, 0) // quantia for item, quantia in receita.ingredientes)
+            faltam = {item: quantia - inventario.get(item, 0) for item, quantia in receita.ingredientes if inventario.get(item, 0) < quantia}
+            resultado.append((receita, vezes, faltam))
+        return resultado
+GRAFO_RECEITAS = GrafoReceitas()
+
+# --- MAPA: SETORES E OCUPANTES ---
+# Cada worker mantém setor -> ocupantes em memória. Mudanças de local gravam um MovimentoHistorico; antes de
+# responder, o índice aplica os movimentos com id > último aplicado (consulta pela chave primária, quase sempre vazia).
+SETORES_PADRAO = ["Setor 1 (Germinal)", "Setor 2 (Elétrico)", "Setor 3 (Hidropônicos)", "Setor 4 (Refeitório)",
+                  "Setor 5 (Dormitórios)", "Setor 6 (Oficinas)", "Área Externa (Norte)", "Área Externa (Sul)", "Desconhecido"]
+def obter_setor(nome, criar=False):
+    # Resolve o nome para um setor existente (None se não houver). Só o GM, a migração e o cadastro
+    # (local inicial fixo do servidor) passam criar=True; o jogador não cria setores com texto livre.
+    nome = (nome or 'Desconhecido').strip()[:100] or 'Desconhecido'
+    setor = Setor.query.filter_by(nome=nome).first()
+    if not setor and criar:
+        setor = Setor(nome=nome)
+        db.session.add(setor); db.session.flush()
+    return setor
+def registrar_movimento(tipo, entidade, setor):
+    # Move jogador/NPC para o setor (None = saiu do mapa). Não grava nada se ele já estava lá.
+    anterior = entidade.setor_id
+    novo = setor.id if setor else None
+    if setor: entidade.localizacao_atual = setor.nome
+    if anterior == novo and anterior is not None: return False
+    entidade.setor_id = novo
+    if entidade.id is None: db.session.flush()
+    nome = entidade.nome_aventureiro if tipo == 'jogador' else entidade.nome
+    db.session.add(MovimentoHistorico(tipo=tipo, entidade_id=entidade.id, nome=nome, setor_id=novo, setor_anterior_id=anterior))
+    return True
+class IndiceOcupantes:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ultimo_movimento = None # None = ainda não montado
+        self.posicoes = {} # (tipo, id) -> (setor_id, nome)
+        self.ocupantes = {} # setor_id -> {(tipo, id): nome}
+    def _mover(self, chave, setor_id, nome):
+        anterior = self.posicoes.pop(chave, None)
+        if anterior: self.ocupantes.get(anterior[0], {}).pop(chave, None)
+        if setor_id is not None:
+            self.posicoes[chave] = (setor_id, nome)
+            self.ocupantes.setdefault(setor_id, {})[chave] = nome
+    def atualizar(self):
+        with self.lock:
+            if self.ultimo_movimento is None:
+                # Lê o cursor antes das tabelas: movimentos concorrentes são reaplicados depois (aplicar é idempotente)
+                self.ultimo_movimento = db.session.query(db.func.max(MovimentoHistorico.id)).scalar() or 0
+                self.posicoes = {}; self.ocupantes = {}
+                for id_, nome, setor_id in db.session.query(Aventureiro.id, Aventureiro.nome_aventureiro, Aventureiro.setor_id):
+                    self._mover(('jogador', id_), setor_id, nome)
+                for id_, nome, setor_id in db.session.query(NPC.id, NPC.nome, NPC.setor_id):
+                    self._mover(('npc', id_), setor_id, nome)
+            movimentos = db.session.query(MovimentoHistorico.id, MovimentoHistorico.tipo, MovimentoHistorico.entidade_id,
+                                          MovimentoHistorico.nome, MovimentoHistorico.setor_id).filter(
+                MovimentoHistorico.id > self.ultimo_movimento).order_by(MovimentoHistorico.id).all()
+            for id_, tipo, entidade_id, nome, setor_id in movimentos:
+                self._mover((tipo, entidade_id), setor_id, nome)
+                self.ultimo_movimento = id_
+    def no_setor(self, setor_id):
+        self.atualizar()
+        with self.lock:
+            return [{"tipo": tipo, "id": id_, "nome": nome} for (tipo, id_), nome in sorted(self.ocupantes.get(setor_id, {}).items(), key=lambda x: x[1])]
+    def todos(self):
+        self.atualizar()
+        with self.lock:
+            return [(tipo, id_, setor_id, nome) for (tipo, id_), (setor_id, nome) in self.posicoes.items()]
+    def reiniciar(self):
+        with self.lock: self.ultimo_movimento = None
+INDICE_OCUPANTES = IndiceOcupantes()
+def migrar_setores():
+    # Cria os setores do mapa e liga jogadores/NPCs antigos (texto em localizacao_atual) ao setor correspondente
+    if not Setor.query.first():
+        for nome in SETORES_PADRAO: db.session.add(Setor(nome=nome))
+        db.session.flush()
+    pendentes = Aventureiro.query.filter(Aventureiro.setor_id.is_(None)).all() + NPC.query.filter(NPC.setor_id.is_(None)).all()
+    for entidade in pendentes:
+        entidade.setor_id = obter_setor(entidade.localizacao_atual, criar=True).id
+    if pendentes:
+        print(f"Locais ligados à tabela de setores: {len(pendentes)}")
+    db.session.commit()
+    INDICE_OCUPANTES.reiniciar()
+
+# --- CANAL DE EVENTOS (SSE) ---
+# Escrita: publicar_evento() grava um EventoStream na mesma transação de quem chamou; quem escreve também poda
+# os eventos vencidos (podar_eventos), então a tabela não cresce mesmo sem nenhuma conexão SSE aberta.
+# Leitura: uma thread por worker segue a tabela (id > cursor) e entrega os eventos ao hub local,
+# que acorda as conexões SSE. Cada conexão ociosa guarda só o seu cursor (sem fila própria).
+class HubEventos:
+    def __init__(self, capacidade=500):
+        self.condicao = threading.Condition()
+        self.recentes = deque(maxlen=capacidade)
+        self.ultimo_id = 0
+        self.ultimo_chat_id = 0 # Marca d'água do chat: polls sem mensagem nova não tocam no banco
+        self.sinal_tail = threading.Event()
+        self.tail_iniciado = False
+        self.conexoes = 0 # SSE + long-polls esperando neste worker
+    def ocupar(self):
+        with self.condicao:
+            if self.conexoes >= app.config["STREAM_MAX_CONEXOES"]: return False
+            self.conexoes += 1
+            return True
+    def liberar(self):
+        with self.condicao:
+            self.conexoes -= 1
+    def publicar_lote(self, eventos):
+        if not eventos: return
+        with self.condicao:
+            for evento in eventos:
+                self.recentes.append(evento)
+                self.ultimo_id = evento["id"]
+                if evento["tipo"] == 'chat':
+                    self.ultimo_chat_id = max(self.ultimo_chat_id, evento["dados"]["id"])
+            self.condicao.notify_all()
+    def marcar_chat(self, mensagem_id):
+        with self.condicao:
+            if mensagem_id > self.ultimo_chat_id:
+                self.ultimo_chat_id = mensagem_id
+                self.condicao.notify_all()
+    def esperar_chat(self, apos_id, timeout):
+        # Long-poll do chat: volta assim que a marca d'água passar de apos_id (ou no timeout)
+        with self.condicao:
+            return self.condicao.wait_for(lambda: self.ultimo_chat_id > apos_id, timeout)
+    def esperar(self, apos_id, timeout):
+        # Devolve os eventos com id > apos_id; bloqueia até 'timeout' segundos se não houver nenhum
+        with self.condicao:
+            if self.ultimo_id <= apos_id:
+                self.condicao.wait(timeout)
+            return [e for e in self.recentes if e["id"] > apos_id]
+    def id_mais_antigo(self):
+        with self.condicao:
+            return self.recentes[0]["id"] if self.recentes else self.ultimo_id + 1
+EVENTOS_HUB = HubEventos()
+
+def publicar_evento(tipo, dados):
+    # O evento só fica visível para os outros workers depois do commit de quem chamou
+    db.session.add(EventoStream(tipo=tipo, dados=json.dumps(dados, ensure_ascii=False, default=str)))
+    db.session.info['eventos_pendentes'] = True
+PODA_EVENTOS = {"proxima": 0.0, "lock": threading.Lock()}
+def podar_eventos(conexao, lote=1000):
+    # No máximo um DELETE limitado por minuto em cada worker, na transação de quem publicou.
+    # Se o lote veio cheio ainda há vencidos: a próxima escrita poda de novo sem esperar.
+    agora = time.monotonic()
+    with PODA_EVENTOS["lock"]:
+        if agora < PODA_EVENTOS["proxima"]: return
+        PODA_EVENTOS["proxima"] = agora + 60
+    limite = datetime.now() - timedelta(seconds=app.config["EVENTOS_RETENCAO"])
+    vencidos = db.select(EventoStream.id).where(EventoStream.timestamp < limite).order_by(EventoStream.id).limit(lote)
+    if conexao.execute(db.delete(EventoStream).where(EventoStream.id.in_(vencidos.scalar_subquery()))).rowcount >= lote:
+        PODA_EVENTOS["proxima"] = 0.0
+@event.listens_for(db.session, 'before_commit')
+def podar_eventos_publicados(session):
+    if session.info.get('eventos_pendentes'): podar_eventos(session.connection())
+@event.listens_for(db.session, 'after_commit')
+def acordar_tail_eventos(session):
+    if session.info.pop('eventos_pendentes', False):
+        EVENTOS_HUB.sinal_tail.set()
+def loop_tail_eventos():
+    intervalo = app.config["EVENTOS_TAIL_INTERVALO"]
+    with app.app_context():
+        while True:
+            EVENTOS_HUB.sinal_tail.wait(intervalo)
+            EVENTOS_HUB.sinal_tail.clear()
+            try:
+                novos = EventoStream.query.filter(EventoStream.id > EVENTOS_HUB.ultimo_id).order_by(EventoStream.id).limit(500).all()
+                EVENTOS_HUB.publicar_lote([e.to_dict() for e in novos])
+            except Exception as e:
+                print(f"Erro ao ler a fila de eventos: {e}")
+                db.session.rollback()
+            finally:
+                db.session.remove()
+def iniciar_tail_eventos():
+    # Iniciada sob demanda pela primeira conexão SSE deste worker
+    with EVENTOS_HUB.condicao:
+        if EVENTOS_HUB.tail_iniciado: return
+        EVENTOS_HUB.tail_iniciado = True
+        ultimo = db.session.query(db.func.max(EventoStream.id)).scalar() or 0
+        EVENTOS_HUB.ultimo_id = ultimo
+        EVENTOS_HUB.ultimo_chat_id = db.session.query(db.func.max(ChatMensagem.id)).scalar() or 0
+    threading.Thread(target=loop_tail_eventos, name='tail-eventos', daemon=True).start()
+
+# --- CRONOGRAMA: ÍNDICE POR MINUTO E AGENDADOR ---
+# Os cronogramas ficam num índice minuto-do-dia (0..1439) -> eventos, refeito só quando a versão da tabela
+# muda (add/delete). Rotas e agendador consultam o índice em vez de ir ao banco a cada poll.
+class IndiceCronograma:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.versao = None
+        self.por_minuto = {}
+        self.minutos = [] # Chaves de por_minuto em ordem, para o bisect
+    def atualizar(self):
+        versao = versoes_tabelas(('cronograma',))[0]
+        with self.lock:
+            if versao == self.versao: return
+        por_minuto = {}
+        for crono in Cronograma.query.order_by(Cronograma.hora, Cronograma.minuto, Cronograma.id):
+            por_minuto.setdefault(crono.hora * 60 + crono.minuto, []).append(crono.to_dict())
+        with self.lock:
+            self.versao, self.por_minuto, self.minutos = versao, por_minuto, sorted(por_minuto)
+    def no_minuto(self, minuto_do_dia):
+        self.atualizar()
+        return list(self.por_minuto.get(minuto_do_dia, []))
+    def proximos(self, minuto_do_dia, quantidade):
+        # Eventos estritamente depois de minuto_do_dia, dando a volta na meia-noite (cada evento aparece uma vez)
+        self.atualizar()
+        with self.lock:
+            minutos, por_minuto = self.minutos, self.por_minuto
+        inicio = bisect.bisect_right(minutos, minuto_do_dia)
+        resultado = []
+        for minuto in minutos[inicio:] + minutos[:inicio]:
+            em_minutos = (minuto - minuto_do_dia) % 1440 or 1440
+            for evento in por_minuto[minuto]:
+                resultado.append(dict(evento, em_minutos=em_minutos))
+                if len(resultado) >= quantidade: return resultado
+        return resultado
+INDICE_CRONOGRAMA = IndiceCronograma()
+
+def disparar_cronogramas(momento):
+    # Dispara os eventos do minuto 'momento'. O INSERT em disparo_cronograma falha (restrição única) se outro
+    # worker já disparou o mesmo evento; nesse caso só desfaz e segue.
+    disparados = 0
+    for evento in INDICE_CRONOGRAMA.no_minuto(momento.hour * 60 + momento.minute):
+        try:
+            db.session.add(DisparoCronograma(cronograma_id=evento['id'], momento=momento))
+            db.session.flush()
+            adicionar_alerta_global(f"[{momento.strftime('%H:%M')}] {evento['texto']}", ttl=app.config["CRONOGRAMA_ALERTA_TTL"])
+            db.session.commit()
+            disparados += 1
+        except IntegrityError:
+            db.session.rollback()
+    return disparados
+def loop_agendador_cronograma():
+    intervalo = app.config["CRONOGRAMA_INTERVALO"]
+    ultimo = datetime.now().replace(second=0, microsecond=0) - timedelta(minutes=1)
+    proxima_poda = datetime.now()
+    with app.app_context():
+        while True:
+            try:
+                agora = datetime.now().replace(second=0, microsecond=0)
+                # Depois de uma pausa longa (suspensão, relógio ajustado) não despeja o dia inteiro de uma vez
+                ultimo = max(ultimo, agora - timedelta(minutes=10))
+                while ultimo < agora:
+                    ultimo += timedelta(minutes=1)
+                    disparar_cronogramas(ultimo)
+                executar_reposicoes(datetime.now())
+                if agora >= proxima_poda:
+                    DisparoCronograma.query.filter(DisparoCronograma.momento < agora - timedelta(days=2)).delete()
+                    db.session.commit()
+                    proxima_poda = agora + timedelta(hours=1)
+            except Exception as e:
+                print(f"Erro no agendador de cronogramas: {e}")
+                db.session.rollback()
+            finally:
+                db.session.remove()
+            time.sleep(intervalo)
+AGENDADOR_INICIADO = threading.Event()
+@app.before_request
+def iniciar_agendador_cronograma():
+    # Sobe na primeira requisição de cada worker (no import ainda pode ser o processo mestre do gunicorn)
+    if AGENDADOR_INICIADO.is_set() or not app.config["AGENDADOR_CRONOGRAMA"]: return
+    with EVENTOS_HUB.condicao:
+        if AGENDADOR_INICIADO.is_set(): return
+        AGENDADOR_INICIADO.set()
+    threading.Thread(target=loop_agendador_cronograma, name='agendador-cronograma', daemon=True).start()
+
+# --- VERSÕES DE TABELA E RESPOSTAS CONDICIONAIS (ETag) ---
+# Cada flush anota as tabelas tocadas na sessão; o incremento das versões sai uma vez por commit, num UPDATE só
+# no fim da transação (a linha de versao_tabela fica travada só durante o commit, não desde o primeiro flush).
+# UPDATE/DELETE em massa (Query.update/delete, SQL direto) não passam pelo flush: chame marcar_alterado().
+def marcar_alterado(*tabelas, session=None, conexao=None):
+    # Sem conexao: anota e o commit da sessão incrementa. Com conexao (listeners de commit, thread de informes): já.
+    if conexao is None:
+        (session or db.session).info.setdefault('tabelas_alteradas', set()).update(tabelas)
+        return
+    conexao.execute(
+        db.update(VersaoTabela).where(VersaoTabela.nome.in_(tabelas)).values(versao=VersaoTabela.versao + 1)
+    )
+    if has_request_context(): g.pop('versoes_tabelas', None)
+@event.listens_for(db.session, 'before_flush')
+def contar_alteracoes(session, flush_context, instances):
+    tabelas = {obj.__table__.name for obj in list(session.new) + list(session.dirty) + list(session.deleted)}
+    tabelas.discard(VersaoTabela.__table__.name)
+    if lista_aventureiros_mudou(session): tabelas.add('lista_aventureiros')
+    if tabelas:
+        marcar_alterado(*tabelas, session=session)
+@event.listens_for(db.session, 'before_commit')
+def gravar_versoes_pendentes(session):
+    # Registrado depois dos outros before_commit (informes, estatísticas, eventos), que também anotam tabelas.
+    # O flush final do commit acontece depois deste hook: força aqui para as últimas alterações entrarem na conta.
+    session.flush()
+    tabelas = session.info.pop('tabelas_alteradas', None)
+    if tabelas:
+        marcar_alterado(*sorted(tabelas), conexao=session.connection())
+@event.listens_for(db.session, 'after_rollback')
+def descartar_versoes_pendentes(session):
+    session.info.pop('tabelas_alteradas', None)
+# Versões que não correspondem a uma tabela inteira. 'lista_aventureiros' só muda quando alguém entra, sai ou
+# troca de nome (o rodízio depende disso, não de cada alteração de XP/KÇ em 'aventureiro').
+VERSOES_DERIVADAS = ('lista_aventureiros',)
+def lista_aventureiros_mudou(session):
+    if any(isinstance(obj, Aventureiro) for obj in list(session.new) + list(session.deleted)): return True
+    return any(isinstance(obj, Aventureiro) and inspect(obj).attrs.nome_aventureiro.history.has_changes() for obj in session.dirty)
+def versoes_tabelas(tabelas):
+    # Uma única leitura da tabela de versões por requisição
+    if not has_request_context() or 'versoes_tabelas' not in g:
+        versoes = {v.nome: v.versao for v in VersaoTabela.query.all()}
+        if not has_request_context(): return [versoes.get(t, 0) for t in tabelas]
+        g.versoes_tabelas = versoes
+    return [g.versoes_tabelas.get(t, 0) for t in tabelas]
+def etag_tabelas(tabelas, *extras):
+    partes = [f"{t}:{v}" for t, v in zip(tabelas, versoes_tabelas(tabelas))] + [str(x) for x in extras]
+    return hashlib.sha1('|'.join(partes).encode('utf-8')).hexdigest()[:20]
+def condicional(*tabelas, por_usuario=False, por_dia=False):
+    # GET com ETag forte derivado das versões das tabelas: se o cliente já tem a versão atual,
+    # devolve 304 sem consultar nem serializar nada. Use abaixo do @jwt_required() quando por_usuario=True.
+    def decorador(view):
+        @wraps(view)
+        def envoltorio(*args, **kwargs):
+            extras = [request.full_path]
+            if por_usuario: extras.append(current_user.id)
+            if por_dia: extras.append(datetime.now().date().isoformat())
+            etag = etag_tabelas(tabelas, *extras)
+            # O cliente pode ter guardado a versão comprimida (ETag com sufixo, ver comprimir_resposta)
+            guardada = next((etag + sufixo for sufixo in SUFIXOS_CODIFICACAO if request.if_none_match.contains(etag + sufixo)), None)
+            if guardada:
+                resposta = Response(status=304)
+                resposta.set_etag(guardada)
+            else:
+                resposta = make_response(view(*args, **kwargs))
+                if resposta.status_code != 200: return resposta
+                resposta.set_etag(etag)
+            resposta.headers['Cache-Control'] = 'no-cache'
+            return resposta
+        return envoltorio
+    return decorador
+def garantir_versoes_tabelas():
+    existentes = {v.nome for v in VersaoTabela.query.all()}
+    nomes = [tabela.name for tabela in db.metadata.sorted_tables if tabela.name != VersaoTabela.__table__.name]
+    for nome in nomes + list(VERSOES_DERIVADAS):
+        if nome not in existentes:
+            db.session.add(VersaoTabela(nome=nome, versao=0))
+    db.session.commit()
+
+@app.after_request
+def gravar_informes_restantes(resposta):
+    # Rede de segurança: informes registrados depois do último commit do handler
+    if db.session.info.get('informes_pendentes'):
+        pendentes = db.session.info['informes_pendentes']
+        try:
+            if db.session.new or db.session.dirty or db.session.deleted:
+                # O handler deixou alterações sem commit: descarta tudo, inclusive os informes que as descrevem
+                db.session.rollback()
+                print(f"Erro: {request.method} {request.path} terminou sem commit; {len(pendentes)} informe(s) descartado(s)")
+                return resposta
+            db.session.commit()
+        except Exception as e:
+            print(f"Erro ao gravar informes pendentes: {e}")
+            db.session.rollback()
+    return resposta
+
+# Compressão negociada pelo Accept-Encoding (br se o pacote brotli existir, senão gzip). Streams (SSE, download do
+# backup) e respostas pequenas passam direto. Codificações diferentes precisam de ETags fortes diferentes (RFC 9110):
+# a versão comprimida leva o sufixo da codificação ("<etag>-gzip"), que o condicional() também aceita.
+SUFIXOS_CODIFICACAO = ('', '-gzip', '-br')
+TIPOS_COMPRIMIVEIS = {'application/json', 'text/html', 'text/css', 'text/plain', 'text/csv', 'application/javascript'}
+@app.after_request
+def comprimir_resposta(resposta):
+    if (resposta.status_code < 200 or resposta.status_code in (204, 304) or resposta.direct_passthrough
+            or resposta.is_streamed or 'Content-Encoding' in resposta.headers or resposta.mimetype not in TIPOS_COMPRIMIVEIS):
+        return resposta
+    resposta.vary.add('Accept-Encoding')
+    if (resposta.content_length or 0) < app.config["COMPRESSAO_MIN_BYTES"]:
+        return resposta
+    codificacao = request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+    if codificacao == 'br':
+        corpo = brotli.compress(resposta.get_data(), quality=app.config["COMPRESSAO_NIVEL_BROTLI"])
+    elif codificacao == 'gzip':
+        corpo = gzip.compress(resposta.get_data(), compresslevel=app.config["COMPRESSAO_NIVEL_GZIP"], mtime=0)
+    else:
+        return resposta
+    resposta.set_data(corpo)
+    resposta.headers['Content-Encoding'] = codificacao
+    etag, fraca = resposta.get_etag()
+    if etag and not fraca: resposta.set_etag(f"{etag}-{codificacao}")
+    return resposta
+
+# --- IDENTIDADE DO JWT ---
+# Tokens novos carregam o id (imutável) do aventureiro; tokens antigos carregam o nome e continuam valendo.
+# Cada worker guarda id -> (id, nome) num cache LRU com validade curta: descobrir quem chamou não custa SELECT.
+IdentidadeAventureiro = namedtuple('IdentidadeAventureiro', ['id', 'nome'])
+class CacheIdentidades:
+    def __init__(self, ttl, maximo=1024):
+        self.ttl = ttl
+        self.maximo = maximo
+        self.lock = threading.Lock()
+        self.itens = OrderedDict() # ('id', 3) ou ('nome', 'Fulano') -> (expira_em, IdentidadeAventureiro)
+    def obter(self, chave):
+        with self.lock:
+            entrada = self.itens.get(chave)
+            if not entrada: return None
+            if entrada[0] < time.monotonic():
+                del self.itens[chave]
+                return None
+            self.itens.move_to_end(chave)
+            return entrada[1]
+    def guardar(self, chave, identidade):
+        with self.lock:
+            self.itens[chave] = (time.monotonic() + self.ttl, identidade)
+            self.itens.move_to_end(chave)
+            while len(self.itens) > self.maximo: self.itens.popitem(last=False)
+    def invalidar(self, *ids):
+        with self.lock:
+            for chave in [c for c, (_, identidade) in self.itens.items() if identidade.id in ids]:
+                del self.itens[chave]
+IDENTIDADES = CacheIdentidades(app.config["IDENTIDADE_CACHE_TTL"])
+
+@jwt.user_lookup_loader
+def carregar_identidade(jwt_header, jwt_data):
+    # Roda uma vez por requisição com @jwt_required(); o resultado fica em current_user
+    if jwt_data.get('ident') == 'id':
+        chave = ('id', int(jwt_data['sub'])); filtro = Aventureiro.id == chave[1]
+    else:
+        chave = ('nome', jwt_data['sub']); filtro = Aventureiro.nome_aventureiro == chave[1]
+    identidade = IDENTIDADES.obter(chave)
+    if identidade: return identidade
+    linha = db.session.query(Aventureiro.id, Aventureiro.nome_aventureiro).filter(filtro).first()
+    if not linha: return None
+    identidade = IdentidadeAventureiro(linha.id, linha.nome_aventureiro)
+    IDENTIDADES.guardar(chave, identidade)
+    return identidade
+@jwt.user_lookup_error_loader
+def identidade_nao_encontrada(jwt_header, jwt_data):
+    return jsonify({"erro": "Aventureiro do token não encontrado. Faça login novamente."}), 401
+def aventureiro_logado():
+    # Linha completa do aventureiro do token, para as rotas que escrevem nele
+    aventureiro = db.session.get(Aventureiro, current_user.id)
+    if not aventureiro: abort(404)
+    return aventureiro
+def anotar_aventureiros_alterados(*ids, session=None):
+    session = session or db.session
+    session.info.setdefault('aventureiros_alterados', set()).update(ids)
+@event.listens_for(db.session, 'before_flush')
+def coletar_aventureiros_alterados(session, flush_context, instances):
+    ids = {obj.id for obj in list(session.dirty) + list(session.deleted) if isinstance(obj, Aventureiro)}
+    if ids: anotar_aventureiros_alterados(*ids, session=session)
+@event.listens_for(db.session, 'after_commit')
+def invalidar_identidades(session):
+    ids = session.info.pop('aventureiros_alterados', None)
+    if ids: IDENTIDADES.invalidar(*ids)
+@event.listens_for(db.session, 'after_rollback')
+def descartar_aventureiros_alterados(session):
+    session.info.pop('aventureiros_alterados', None)
 
 # --- ROTAS DE AUTENTICAÇÃO ---
 @app.route('/api/register', methods=['POST'])
@@ -217,8 +1653,12 @@ def register():
         localizacao_atual='Setor 1 (Germinal)'
     )
     novo_aventureiro.set_password(password)
-    db.session.add(novo_aventureiro); db.session.commit()
-    adicionar_informe(f"Aventureiro '{nome_aventureiro}' (Lvl 1) juntou-se ao Habitat.")
+    db.session.add(novo_aventureiro); db.session.flush()
+    registrar_movimento('jogador', novo_aventureiro, obter_setor(novo_aventureiro.localizacao_atual, criar=True))
+    registrar_ledger('kaicons', novo_aventureiro.kaicons, 'abertura de conta', aventureiro_id=novo_aventureiro.id)
+    somar_estatistica_global(jogadores=1)
+    adicionar_informe(f"Aventureiro '{nome_aventureiro}' (Lvl 1) juntou-se ao Habitat.", ator=nome_aventureiro)
+    db.session.commit()
     return jsonify({"message": "Aventureiro registrado com sucesso! Você pode fazer login."}), 201
 @app.route('/api/login', methods=['POST'])
 def login():
@@ -227,95 +1667,290 @@ def login():
     aventureiro = Aventureiro.query.filter_by(username=username).first()
     if not aventureiro or not aventureiro.check_password(password):
         return jsonify({"erro": "Login ou senha inválidos"}), 401
-    access_token = create_access_token(identity=aventureiro.nome_aventureiro)
+    access_token = create_access_token(identity=str(aventureiro.id), additional_claims={"ident": "id"})
     return jsonify(access_token=access_token)
 
+# --- SEÇÕES DO JOGADOR (usadas pelas rotas individuais e pelo /api/sync) ---
+# Cada seção recebe o nome do aventureiro logado (já extraído do JWT) e devolve dados puros (sem jsonify).
+def secao_tarefas(nome_aventureiro):
+    # Só envia tarefas ATIVAS ou PENDENTES para o jogador (IN usa o índice de status; != não)
+    tarefas = Tarefa.query.filter(Tarefa.status.in_(['ATIVA', 'PENDENTE'])).all()
+    return [tarefa.to_dict() for tarefa in tarefas]
+def secao_alertas(nome_aventureiro):
+    return [alerta['texto'] for alerta in ALERTAS_CACHE.listar()]
+def secao_eventos(nome_aventureiro):
+    agora = datetime.now()
+    return [evento['texto'] for evento in INDICE_CRONOGRAMA.no_minuto(agora.hour * 60 + agora.minute)]
+def secao_tempo(nome_aventureiro):
+    agora = datetime.now()
+    return {"data": agora.strftime("%d/%m"), "hora": agora.hour, "minuto": agora.minute}
+def secao_cronogramas(nome_aventureiro):
+    return [crono.to_dict() for crono in Cronograma.query.order_by(Cronograma.hora, Cronograma.minuto).all()]
+def secao_rodizio(nome_aventureiro):
+    if not ESCALA_RODIZIO.carregar_base()[1]: return {"hoje": [], "amanha": []}
+    hoje_date = datetime.now().date()
+    amanha_date = hoje_date + timedelta(days=1)
+    minhas_tarefas_hoje = ESCALA_RODIZIO.dia(hoje_date)["por_jogador"].get(nome_aventureiro, [])
+    minhas_tarefas_amanha = ESCALA_RODIZIO.dia(amanha_date)["por_jogador"].get(nome_aventureiro, [])
+    dia_semana_hoje = hoje_date.strftime('%A').capitalize()
+    dia_semana_amanha = amanha_date.strftime('%A').capitalize()
+    return {
+        "hoje": {"dia_semana": dia_semana_hoje, "tarefas": minhas_tarefas_hoje},
+        "amanha": {"dia_semana": dia_semana_amanha, "tarefas": minhas_tarefas_amanha}
+    }
+def secao_status(nome_aventureiro):
+    # Pelo id imutável do token, como as outras rotas do jogador (o nome pode ter sido trocado pelo GM)
+    return aventureiro_logado().to_dict()
+def secao_informes(nome_aventureiro):
+    informes_db = RegistroInformes.query.order_by(RegistroInformes.timestamp.desc()).limit(20).all()
+    return [informe.to_dict() for informe in informes_db]
+def secao_rede(nome_aventureiro):
+    nomes = db.session.query(Aventureiro.nome_aventureiro).filter(Aventureiro.nome_aventureiro != nome_aventureiro)
+    return [nome for (nome,) in nomes]
+def secao_chat(nome_aventureiro):
+    mensagens = ChatMensagem.query.order_by(ChatMensagem.timestamp.desc()).limit(50).all()
+    mensagens.reverse()
+    return [msg.to_dict() for msg in mensagens]
+def secao_loja(nome_aventureiro):
+    itens = LojaItem.query.order_by(LojaItem.nome).all()
+    return [item.to_dict() for item in itens]
+
+# Nome da seção no /api/sync -> função que a monta (mesma ordem dos antigos setInterval do kaibora.html)
+SECOES_SYNC = {
+    "chat": secao_chat,
+    "tempo": secao_tempo,
+    "alertas": secao_alertas,
+    "eventos": secao_eventos,
+    "status": secao_status,
+    "rodizio": secao_rodizio,
+    "tarefas": secao_tarefas,
+    "cronogramas": secao_cronogramas,
+    "informes": secao_informes,
+    "rede": secao_rede,
+    "loja": secao_loja,
+}
+# Seções cujo conteúdo depende só destas tabelas: a versão vem dos contadores e a seção nem é montada
+# quando o cliente já está atualizado. As demais (tempo, eventos, rodízio, alertas) usam hash do conteúdo.
+TABELAS_SECAO = {
+    "chat": ("chat_mensagem",),
+    "status": ("aventureiro", "inventario_item"),
+    "tarefas": ("tarefa",),
+    "cronogramas": ("cronograma",),
+    "informes": ("registro_informes",),
+    "rede": ("aventureiro",),
+    "loja": ("loja_item",),
+}
+# Seções que dependem de quem pede (como as rotas com por_usuario=True): a versão também leva o id do jogador
+SECOES_POR_JOGADOR = {"status", "rede"}
+def versao_secao(dados):
+    # Versão = hash curto do conteúdo serializado; muda só quando os dados mudam
+    bruto = json.dumps(dados, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(bruto.encode('utf-8')).hexdigest()[:16]
+def ler_versoes_cliente(texto):
+    # Formato: "chat:abc123,status:def456"
+    versoes = {}
+    for par in (texto or '').split(','):
+        if ':' in par:
+            nome, versao = par.split(':', 1)
+            versoes[nome.strip()] = versao.strip()
+    return versoes
+
 # --- ROTAS DO APP DO JOGADOR (kaibora.html) ---
+@app.route('/api/sync', methods=['GET'])
+@jwt_required()
+def get_sync():
+    # Uma única requisição substitui os vários pollers do app do jogador.
+    # ?secoes=chat,status,... (padrão: todas) & versoes=chat:<v>,status:<v> (seções inalteradas são omitidas)
+    nome_aventureiro = current_user.nome
+    secoes_pedidas = request.args.get('secoes')
+    if secoes_pedidas:
+        nomes = [n.strip() for n in secoes_pedidas.split(',') if n.strip()]
+        desconhecidas = [n for n in nomes if n not in SECOES_SYNC]
+        if desconhecidas:
+            return jsonify({"erro": f"Seções desconhecidas: {', '.join(desconhecidas)}"}), 400
+    else:
+        nomes = list(SECOES_SYNC.keys())
+    versoes_cliente = ler_versoes_cliente(request.args.get('versoes'))
+    versoes = {}; secoes = {}
+    for nome in nomes:
+        if nome in TABELAS_SECAO:
+            extras = (current_user.id,) if nome in SECOES_POR_JOGADOR else ()
+            versao = 't' + etag_tabelas(TABELAS_SECAO[nome], *extras)
+            versoes[nome] = versao
+            if versoes_cliente.get(nome) != versao:
+                secoes[nome] = SECOES_SYNC[nome](nome_aventureiro)
+            continue
+        dados = SECOES_SYNC[nome](nome_aventureiro)
+        versao = versao_secao(dados)
+        versoes[nome] = versao
+        if versoes_cliente.get(nome) != versao:
+            secoes[nome] = dados
+    return jsonify({"versoes": versoes, "secoes": secoes})
+
+@app.route('/api/stream', methods=['GET'])
+@jwt_required(locations=["headers", "query_string"])
+def stream_eventos():
+    # Server-Sent Events: ?tipos=chat,alerta,informe,habitat (padrão: todos). Retoma a partir do Last-Event-ID.
+    iniciar_tail_eventos()
+    tipos = {t.strip() for t in request.args.get('tipos', '').split(',') if t.strip()}
+    try: cursor = int(request.headers.get('Last-Event-ID') or request.args.get('desde') or 0)
+    except ValueError: cursor = 0
+    atrasados = []
+    if cursor and cursor < EVENTOS_HUB.id_mais_antigo():
+        # Cliente voltou de uma queda mais longa que o buffer em memória: completa pelo banco
+        linhas = EventoStream.query.filter(EventoStream.id > cursor, EventoStream.id <= EVENTOS_HUB.ultimo_id).order_by(EventoStream.id).limit(500).all()
+        atrasados = [e.to_dict() for e in linhas]
+    if not cursor:
+        cursor = EVENTOS_HUB.ultimo_id
+    db.session.close() # Não segura conexão do pool enquanto a stream fica aberta
+    if not EVENTOS_HUB.ocupar():
+        resposta = jsonify({"erro": "Canal de eventos lotado neste servidor. Use o polling do /api/sync.", "polling": "/api/sync"})
+        resposta.status_code = 503
+        resposta.headers['Retry-After'] = '30'
+        return resposta
+    def formatar(evento):
+        return f"id: {evento['id']}\nevent: {evento['tipo']}\ndata: {json.dumps(evento['dados'], ensure_ascii=False)}\n\n"
+    def gerar(cursor):
+        yield "retry: 3000\n\n"
+        for evento in atrasados:
+            cursor = max(cursor, evento['id'])
+            if not tipos or evento['tipo'] in tipos: yield formatar(evento)
+        while True:
+            eventos = EVENTOS_HUB.esperar(cursor, timeout=15)
+            if not eventos:
+                cursor = max(cursor, EVENTOS_HUB.ultimo_id)
+                yield ": ping\n\n" # Mantém a conexão viva atrás de proxies
+                continue
+            for evento in eventos:
+                cursor = evento['id']
+                if not tipos or evento['tipo'] in tipos: yield formatar(evento)
+    resposta = Response(gerar(cursor), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    resposta.call_on_close(EVENTOS_HUB.liberar) # Roda quando o servidor fecha a resposta (inclusive cliente que caiu)
+    return resposta
+
 @app.route('/api/tarefas', methods=['GET'])
 @jwt_required()
+@condicional('tarefa')
 def get_tarefas(): 
-    # ATUALIZADO: Só envia tarefas ATIVAS ou PENDENTES para o jogador
-    tarefas = Tarefa.query.filter(Tarefa.status != 'CONCLUIDA').all()
-    return jsonify([tarefa.to_dict() for tarefa in tarefas])
+    return jsonify(secao_tarefas(current_user.nome))
 
 # --- NOVA ROTA: Jogador pede conclusão da tarefa ---
+# Cria (ou reabre, se foi recusado) o pedido do jogador; a tarefa continua aberta para os outros.
 @app.route('/api/tarefas/<int:id>/pedir-conclusao', methods=['POST'])
 @jwt_required()
 def pedir_conclusao_tarefa(id):
-    tarefa = Tarefa.query.get(id)
+    tarefa = db.session.get(Tarefa, id)
     if not tarefa:
         return jsonify({"erro": "Tarefa não encontrada."}), 404
+    if tarefa.status not in TAREFA_ABERTA:
+        return jsonify({"erro": "Esta tarefa já foi concluída."}), 400
     
-    nome_aventureiro = get_jwt_identity()
+    nome_aventureiro = current_user.nome
     
     try:
-        tarefa.status = 'PENDENTE'
-        adicionar_informe(f"[TAREFA] {nome_aventureiro} marcou a tarefa '{tarefa.texto}' como PENDENTE DE APROVAÇÃO.")
+        pedido = TarefaClaim.query.filter_by(tarefa_id=id, aventureiro_id=current_user.id).first()
+        if pedido and pedido.estado in ('PENDENTE', 'APROVADA'):
+            return jsonify({"erro": f"Você já tem um pedido {pedido.estado} para esta tarefa.", "pedido": pedido.to_dict()}), 409
+        if pedido:
+            pedido.estado = 'PENDENTE'; pedido.criado_em = datetime.now(); pedido.decidido_em = None
+        else:
+            pedido = TarefaClaim(tarefa_id=id, aventureiro_id=current_user.id, estado='PENDENTE', criado_em=datetime.now())
+            db.session.add(pedido)
+        adicionar_informe(f"[TAREFA] {nome_aventureiro} marcou a tarefa '{tarefa.texto}' como PENDENTE DE APROVAÇÃO.", categoria='TAREFA', ator=nome_aventureiro)
         db.session.commit()
-        return jsonify(tarefa.to_dict()), 200
+        return jsonify(dict(tarefa.to_dict(), pedido=pedido.to_dict())), 200
+    except IntegrityError:
+        db.session.rollback() # Dois cliques ao mesmo tempo: o outro pedido já entrou
+        return jsonify({"erro": "Você já tem um pedido para esta tarefa."}), 409
     except Exception as e:
         db.session.rollback()
         return jsonify({"erro": str(e)}), 500
+@app.route('/api/tarefas/meus-pedidos', methods=['GET'])
+@jwt_required()
+@condicional('tarefa_claim', por_usuario=True)
+def get_meus_pedidos_tarefa():
+    pedidos = TarefaClaim.query.filter_by(aventureiro_id=current_user.id).order_by(TarefaClaim.criado_em.desc()).all()
+    return jsonify([p.to_dict() for p in pedidos])
 
 @app.route('/api/alertas', methods=['GET'])
 @jwt_required()
-def get_alertas(): return jsonify(ALERTAS_DB)
+def get_alertas():
+    # Sem parâmetros: textos dos 5 alertas vigentes (como antes). ?since=<id>: objetos com id > since, do mais antigo ao mais novo.
+    since = request.args.get('since', type=int)
+    if since is None:
+        return jsonify(secao_alertas(current_user.nome))
+    agora = datetime.now()
+    alertas = Alerta.query.filter(Alerta.id > since, db.or_(Alerta.expira_em.is_(None), Alerta.expira_em > agora)).order_by(Alerta.id).limit(50).all()
+    return jsonify([a.to_dict() for a in alertas])
 @app.route('/api/cronogramas', methods=['GET'])
 @jwt_required()
-def get_cronogramas(): return jsonify([crono.to_dict() for crono in Cronograma.query.order_by(Cronograma.hora, Cronograma.minuto).all()])
+@condicional('cronograma')
+def get_cronogramas(): return jsonify(secao_cronogramas(current_user.nome))
+@app.route('/api/cronogramas/proximos', methods=['GET'])
+@jwt_required()
+def get_proximos_cronogramas():
+    # ?apos=HH:MM (padrão: agora) &n=5 -> os N próximos eventos depois desse horário, com "em_minutos"
+    apos = request.args.get('apos')
+    try:
+        if apos:
+            h, m = apos.split(':'); minuto_do_dia = int(h) * 60 + int(m)
+            if not 0 <= minuto_do_dia < 1440: raise ValueError
+        else:
+            agora = datetime.now(); minuto_do_dia = agora.hour * 60 + agora.minute
+    except ValueError: return jsonify({"erro": "Formato de hora inválido. Use HH:MM"}), 400
+    quantidade = min(max(request.args.get('n', 5, type=int), 1), 50)
+    return jsonify(INDICE_CRONOGRAMA.proximos(minuto_do_dia, quantidade))
 @app.route('/api/time', methods=['GET'])
 @jwt_required()
 def get_time():
-    agora = datetime.now()
-    return jsonify({"data": agora.strftime("%d/%m"), "hora": agora.hour, "minuto": agora.minute})
+    return jsonify(secao_tempo(current_user.nome))
 @app.route('/api/status/eventos', methods=['GET'])
 @jwt_required()
 def get_current_events():
-    agora = datetime.now()
-    eventos_db = Cronograma.query.filter_by(hora=agora.hour, minuto=agora.minute).all()
-    return jsonify([evento.texto for evento in eventos_db])
+    return jsonify(secao_eventos(current_user.nome))
 @app.route('/api/rodizio/meu-horario', methods=['GET'])
 @jwt_required()
+@condicional('rodizio', 'lista_aventureiros', por_usuario=True, por_dia=True)
 def get_meu_rodizio_horario():
-    nome_aventureiro = get_jwt_identity()
-    jogadores = get_lista_nomes_jogadores()
-    if not jogadores: return jsonify({"hoje": [], "amanha": []})
-    tarefas = Rodizio.query.order_by(Rodizio.id).all()
-    hoje_date = datetime.now().date()
-    amanha_date = hoje_date + timedelta(days=1)
-    atribuicoes_hoje = calcular_atribuicao(hoje_date, jogadores, tarefas)
-    atribuicoes_amanha = calcular_atribuicao(amanha_date, jogadores, tarefas)
-    minhas_tarefas_hoje = [t for t in atribuicoes_hoje if t['atribuido_a'] == nome_aventureiro]
-    minhas_tarefas_amanha = [t for t in atribuicoes_amanha if t['atribuido_a'] == nome_aventureiro]
-    dia_semana_hoje = hoje_date.strftime('%A').capitalize()
-    dia_semana_amanha = amanha_date.strftime('%A').capitalize()
-    return jsonify({
-        "hoje": {"dia_semana": dia_semana_hoje, "tarefas": minhas_tarefas_hoje},
-        "amanha": {"dia_semana": dia_semana_amanha, "tarefas": minhas_tarefas_amanha}
-    })
+    return jsonify(secao_rodizio(current_user.nome))
 @app.route('/api/aventureiro/status', methods=['GET'])
 @jwt_required()
+@condicional('aventureiro', 'inventario_item', por_usuario=True)
 def get_aventureiro_status():
-    nome_aventureiro = get_jwt_identity()
-    aventureiro = Aventureiro.query.filter_by(nome_aventureiro=nome_aventureiro).first_or_404()
-    return jsonify(aventureiro.to_dict())
+    return jsonify(secao_status(current_user.nome))
 @app.route('/api/informes', methods=['GET'])
 @jwt_required()
+@condicional('registro_informes')
 def get_informes():
-    informes_db = RegistroInformes.query.order_by(RegistroInformes.timestamp.desc()).limit(20).all()
-    return jsonify([informe.to_dict() for informe in informes_db])
+    # Sem filtros: os 20 mais recentes (como antes). Com ?categoria=LOJA&ator=Fulano&before=<id>&limite=N
+    # devolve {"informes": [...], "proximo_before": <id|null>}, paginando por (timestamp, id) decrescentes.
+    filtros = {k: request.args.get(k) for k in ('categoria', 'ator', 'before', 'limite') if request.args.get(k)}
+    if not filtros:
+        return jsonify(secao_informes(current_user.nome))
+    consulta = RegistroInformes.query
+    if 'categoria' in filtros: consulta = consulta.filter(RegistroInformes.categoria == filtros['categoria'].upper())
+    if 'ator' in filtros: consulta = consulta.filter(RegistroInformes.ator == filtros['ator'])
+    if 'before' in filtros:
+        cursor = RegistroInformes.query.get(request.args.get('before', type=int))
+        if not cursor: return jsonify({"erro": "Cursor 'before' inválido."}), 400
+        consulta = consulta.filter(db.or_(
+            RegistroInformes.timestamp < cursor.timestamp,
+            db.and_(RegistroInformes.timestamp == cursor.timestamp, RegistroInformes.id < cursor.id)
+        ))
+    limite = min(max(request.args.get('limite', 20, type=int), 1), 100)
+    informes_db = consulta.order_by(RegistroInformes.timestamp.desc(), RegistroInformes.id.desc()).limit(limite).all()
+    proximo = informes_db[-1].id if len(informes_db) == limite else None
+    return jsonify({"informes": [informe.to_dict() for informe in informes_db], "proximo_before": proximo})
 @app.route('/api/aventureiros/lista', methods=['GET'])
 @jwt_required()
+@condicional('aventureiro', por_usuario=True)
 def get_lista_aventureiros_ativos():
-    nome_logado = get_jwt_identity()
-    aventureiros = Aventureiro.query.filter(Aventureiro.nome_aventureiro != nome_logado).all()
-    nomes = [a.nome_aventureiro for a in aventureiros]
-    return jsonify(nomes)
+    return jsonify(secao_rede(current_user.nome))
 @app.route('/api/transferir', methods=['POST'])
 @jwt_required()
 def transferir_kaicons():
-    nome_remetente = get_jwt_identity()
-    remetente = Aventureiro.query.filter_by(nome_aventureiro=nome_remetente).first_or_404()
+    nome_remetente = current_user.nome
+    remetente = aventureiro_logado()
     data = request.json
     nome_destinatario = data.get('destinatario')
     try: quantia = int(data.get('quantia'))
@@ -323,30 +1958,52 @@ def transferir_kaicons():
     if not nome_destinatario or quantia <= 0: return jsonify({"erro": "Destinatário ou quantia inválidos."}), 400
     destinatario = Aventureiro.query.filter_by(nome_aventureiro=nome_destinatario).first()
     if not destinatario: return jsonify({"erro": f"Aventureiro '{nome_destinatario}' não encontrado."}), 404
-    if remetente.kaicons < quantia: return jsonify({"erro": "Kaicons insuficientes para esta troca."}), 400
+    if destinatario.id == remetente.id: return jsonify({"erro": "Destinatário ou quantia inválidos."}), 400
     try:
-        remetente.kaicons -= quantia
-        destinatario.kaicons += quantia
-        db.session.commit()
+        with transacao_imediata():
+            if not mover_kaicons(remetente, -quantia, f"transferência para {nome_destinatario}"):
+                raise OperacaoRecusada("Kaicons insuficientes para esta troca.")
+            mover_kaicons(destinatario, quantia, f"transferência de {nome_remetente}")
         return jsonify({"message": "Transferência concluída com sucesso!"}), 200
+    except OperacaoRecusada as e:
+        return jsonify({"erro": str(e)}), 400
     except Exception as e:
-        db.session.rollback()
         return jsonify({"erro": "Uma falha interna impediu a troca."}), 500
 @app.route('/api/chat', methods=['GET'])
 @jwt_required()
 def get_chat_mensagens():
-    mensagens = ChatMensagem.query.order_by(ChatMensagem.timestamp.desc()).limit(50).all()
-    mensagens.reverse()
+    # Sem parâmetros: últimas 50 mensagens (como antes).
+    # ?since_id=N: só mensagens com id > N. &wait=25: segura a requisição até chegar mensagem nova (máx. 30 s).
+    # Com o worker já no limite de STREAM_MAX_CONEXOES o wait é ignorado e a resposta volta na hora.
+    since_id = request.args.get('since_id', type=int)
+    if since_id is None:
+        return jsonify(secao_chat(current_user.nome))
+    iniciar_tail_eventos()
+    espera = min(max(request.args.get('wait', 0, type=float), 0), 30)
+    if EVENTOS_HUB.ultimo_chat_id <= since_id:
+        if not espera or not EVENTOS_HUB.ocupar():
+            return jsonify([])
+        db.session.close() # Como no SSE: a espera não segura conexão do pool
+        try:
+            chegou = EVENTOS_HUB.esperar_chat(since_id, espera)
+        finally:
+            EVENTOS_HUB.liberar()
+        if not chegou:
+            return jsonify([])
+    mensagens = ChatMensagem.query.filter(ChatMensagem.id > since_id).order_by(ChatMensagem.id).limit(50).all()
     return jsonify([msg.to_dict() for msg in mensagens])
 @app.route('/api/chat', methods=['POST'])
 @jwt_required()
 def post_chat_mensagem():
-    nome_autor = get_jwt_identity()
+    nome_autor = current_user.nome
     texto = request.json.get('texto')
     if not texto: return jsonify({"erro": "A mensagem não pode estar vazia."}), 400
     try:
         nova_mensagem = ChatMensagem(nome_autor=nome_autor, texto=texto)
-        db.session.add(nova_mensagem); db.session.commit()
+        db.session.add(nova_mensagem); db.session.flush()
+        publicar_evento('chat', nova_mensagem.to_dict())
+        db.session.commit()
+        EVENTOS_HUB.marcar_chat(nova_mensagem.id)
         return jsonify(nova_mensagem.to_dict()), 201
     except Exception as e:
         db.session.rollback()
@@ -354,61 +2011,129 @@ def post_chat_mensagem():
 @app.route('/api/aventureiro/backup', methods=['POST'])
 @jwt_required()
 def backup_arquivos():
-    nome_aventureiro = get_jwt_identity()
-    aventureiro = Aventureiro.query.filter_by(nome_aventureiro=nome_aventureiro).first_or_404()
-    backup_data_string = request.json.get('backup_data')
-    if backup_data_string is None:
+    # Dois formatos:
+    #  {"backup_data": "<texto>"}: o servidor divide em blocos e só grava os que faltam.
+    #  {"manifesto": [sha256 dos blocos, em ordem], "blocos": {sha256: base64}}: upload incremental. O cliente
+    #  manda só os blocos que mudaram; se faltar algum, a resposta é 409 com {"faltantes": [...]} e ele reenvia.
+    nome_aventureiro = current_user.nome
+    aventureiro = aventureiro_logado()
+    backup_anterior = aventureiro.backup_hash
+    data = request.json or {}
+    backup_data_string = data.get('backup_data')
+    manifesto = data.get('manifesto')
+    if backup_data_string is None and manifesto is None:
         return jsonify({"erro": "Nenhum dado de backup enviado."}), 400
     try:
-        aventureiro.backup_arquivos = backup_data_string
+        if backup_data_string is not None:
+            gravado = gravar_backup_texto(aventureiro, backup_data_string)
+        else:
+            if not isinstance(manifesto, list) or not all(isinstance(h, str) for h in manifesto):
+                return jsonify({"erro": "'manifesto' deve ser uma lista de hashes."}), 400
+            blocos = {}
+            for h, conteudo in (data.get('blocos') or {}).items():
+                try: bruto = base64.b64decode(conteudo, validate=True)
+                except (ValueError, TypeError): return jsonify({"erro": f"Bloco {h} não está em base64."}), 400
+                if hash_bloco(bruto) != h: return jsonify({"erro": f"Bloco {h} não confere com o hash."}), 400
+                blocos[h] = bruto
+            guardar_blocos(blocos)
+            faltantes = sorted(set(manifesto) - set(blocos) - blocos_existentes(manifesto))
+            if faltantes:
+                db.session.commit() # Guarda o que já veio; o próximo envio só precisa dos faltantes
+                return jsonify({"erro": "Blocos faltando.", "faltantes": faltantes}), 409
+            gravado = apontar_backup(aventureiro, manifesto)
+        podar_backups_orfaos([backup_anterior]) # Só o backup substituído; o armazém inteiro fica para o 'podar-backups'
+        adicionar_informe(f"BKP do Kaipora de '{nome_aventureiro}' sincronizado com o Germinal.", ator=nome_aventureiro)
         db.session.commit()
-        adicionar_informe(f"BKP do Kaipora de '{nome_aventureiro}' sincronizado com o Germinal.")
-        return jsonify({"message": "Backup concluído com sucesso!"}), 200
+        return jsonify({"message": "Backup concluído com sucesso!", "backup_hash": gravado.hash, "backup_tamanho": gravado.tamanho}), 200
     except Exception as e:
         db.session.rollback()
         return jsonify({"erro": str(e)}), 500
+@app.route('/api/aventureiro/backup/manifesto', methods=['GET'])
+@jwt_required()
+def get_backup_manifesto():
+    # Para o upload incremental: o cliente compara com os seus blocos e manda só os diferentes
+    aventureiro = aventureiro_logado()
+    hashes = [h for (h,) in db.session.query(BackupManifestoBloco.bloco_hash).filter_by(manifesto_hash=aventureiro.backup_hash).order_by(BackupManifestoBloco.posicao)] if aventureiro.backup_hash else []
+    return jsonify({"backup_hash": aventureiro.backup_hash, "backup_tamanho": aventureiro.backup_tamanho or 0,
+                    "blocos": hashes, "tamanho_bloco": app.config["BACKUP_BLOCO_BYTES"], "divisao": parametros_divisao()})
+@app.route('/api/aventureiro/backup', methods=['GET'])
+@jwt_required()
+def download_backup():
+    # Devolve o backup original, montado bloco a bloco (sem carregar tudo na memória). ETag = hash do backup.
+    aventureiro = aventureiro_logado()
+    if not aventureiro.backup_hash:
+        return jsonify({"erro": "Nenhum backup encontrado."}), 404
+    if request.if_none_match.contains(aventureiro.backup_hash):
+        resposta = Response(status=304)
+        resposta.set_etag(aventureiro.backup_hash)
+        return resposta
+    hashes = [h for (h,) in db.session.query(BackupManifestoBloco.bloco_hash).filter_by(manifesto_hash=aventureiro.backup_hash).order_by(BackupManifestoBloco.posicao)]
+    def gerar():
+        for h in hashes:
+            bloco = db.session.get(BackupBloco, h)
+            yield descomprimir_bloco(bloco.compressao, bloco.dados)
+            db.session.expunge(bloco) # Não acumula blocos no identity map durante a stream
+    resposta = Response(stream_with_context(gerar()), mimetype='application/json')
+    resposta.headers['Content-Length'] = str(aventureiro.backup_tamanho or 0)
+    resposta.headers['Cache-Control'] = 'no-cache'
+    resposta.set_etag(aventureiro.backup_hash)
+    return resposta
 @app.route('/api/loja-itens', methods=['GET'])
 @jwt_required() 
+@condicional('loja_item')
 def get_loja_itens_jogador():
-    itens = LojaItem.query.order_by(LojaItem.nome).all()
-    return jsonify([item.to_dict() for item in itens])
+    return jsonify(secao_loja(current_user.nome))
 @app.route('/api/loja/comprar/<int:id>', methods=['POST'])
 @jwt_required()
 def comprar_item_loja(id):
-    nome_comprador = get_jwt_identity()
-    comprador = Aventureiro.query.filter_by(nome_aventureiro=nome_comprador).first_or_404()
-    item = LojaItem.query.get(id)
-    if not item:
+    # ?quantidade=N compra várias unidades de uma vez (padrão 1)
+    comprador = aventureiro_logado()
+    if not db.session.get(LojaItem, id):
         return jsonify({"erro": "Item não encontrado na loja."}), 404
-    if item.estoque <= 0:
-        return jsonify({"erro": "Item fora de estoque."}), 400
-    if comprador.kaicons < item.preco:
-        return jsonify({"erro": "Kaicons insuficientes."}), 400
+    quantidade = request.args.get('quantidade', 1, type=int)
+    if not 1 <= quantidade <= app.config["LOJA_MAX_QUANTIDADE"]:
+        return jsonify({"erro": f"Quantidade deve estar entre 1 e {app.config['LOJA_MAX_QUANTIDADE']}."}), 400
     try:
-        comprador.kaicons -= item.preco
-        item.estoque -= 1
-        try:
-            inventario = json.loads(comprador.inventario)
-        except json.JSONDecodeError:
-            inventario = {}
-        item_nome_norm = item.nome.strip().lower()
-        quantia_atual = inventario.get(item_nome_norm, 0)
-        inventario[item_nome_norm] = quantia_atual + 1
-        comprador.inventario = json.dumps(inventario)
-        adicionar_informe(f"[LOJA] {comprador.nome_aventureiro} comprou '{item.nome}' por {item.preco} KÇ.")
-        db.session.commit()
+        with transacao_imediata():
+            vender_itens(comprador, [(id, quantidade)])
         return jsonify(comprador.to_dict()), 200
+    except OperacaoRecusada as e:
+        return jsonify({"erro": str(e)}), 400
+    except Exception as e:
+        return jsonify({"erro": str(e)}), 500
+@app.route('/api/loja/comprar', methods=['POST'])
+@jwt_required()
+def comprar_carrinho():
+    # Carrinho: {"itens": [{"item_id": 1, "quantidade": 2}, ...]}. Tudo ou nada numa transação só.
+    comprador = aventureiro_logado()
+    linhas = (request.json or {}).get('itens')
+    if not isinstance(linhas, list) or not linhas or len(linhas) > LIMITE_OPERACOES_LOTE:
+        return jsonify({"erro": f"Envie 'itens' com 1 a {LIMITE_OPERACOES_LOTE} linhas."}), 400
+    maximo = app.config["LOJA_MAX_QUANTIDADE"]
+    try:
+        pedidos = [(int(linha['item_id']), int(linha.get('quantidade', 1))) for linha in linhas]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"erro": "Cada linha precisa de 'item_id' e 'quantidade' inteiros."}), 400
+    if any(not 1 <= quantidade <= maximo for _, quantidade in pedidos):
+        return jsonify({"erro": f"Quantidade deve estar entre 1 e {maximo}."}), 400
+    try:
+        with transacao_imediata():
+            vendas = vender_itens(comprador, pedidos)
+            resumo = [v.to_dict() for v in vendas]
+        return jsonify({"aventureiro": comprador.to_dict(), "vendas": resumo}), 200
+    except OperacaoRecusada as e:
+        return jsonify({"erro": str(e)}), 400
     except Exception as e:
-        db.session.rollback()
         return jsonify({"erro": str(e)}), 500
 @app.route('/api/mapa/esbocos', methods=['GET'])
+@condicional('esboco_mapa')
 def get_esbocos():
     esbocos_db = EsbocoMapa.query.order_by(EsbocoMapa.timestamp.desc()).limit(20).all()
     return jsonify([e.to_dict() for e in esbocos_db])
 @app.route('/api/mapa/esboco', methods=['POST'])
 @jwt_required()
 def submit_esboco():
-    nome_autor = get_jwt_identity()
+    nome_autor = current_user.nome
     data = request.json
     nome_setor = data.get('nome_setor')
     notas = data.get('notas')
@@ -417,7 +2142,7 @@ def submit_esboco():
     try:
         novo_esboco = EsbocoMapa(nome_autor=nome_autor, nome_setor=nome_setor, notas=notas)
         db.session.add(novo_esboco)
-        adicionar_informe(f"[MAPEAMENTO] {nome_autor} enviou um novo esboço 2D para o {nome_setor}.")
+        adicionar_informe(f"[MAPEAMENTO] {nome_autor} enviou um novo esboço 2D para o {nome_setor}.", categoria='MAPEAMENTO', ator=nome_autor)
         db.session.commit()
         return jsonify(novo_esboco.to_dict()), 201
     except Exception as e:
@@ -426,13 +2151,16 @@ def submit_esboco():
 @app.route('/api/aventureiro/localizacao', methods=['POST'])
 @jwt_required()
 def set_localizacao():
-    nome_aventureiro = get_jwt_identity()
-    aventureiro = Aventureiro.query.filter_by(nome_aventureiro=nome_aventureiro).first_or_404()
+    nome_aventureiro = current_user.nome
+    aventureiro = aventureiro_logado()
     local = request.json.get('localizacao')
     if not local:
         return jsonify({"erro": "Localização não fornecida."}), 400
+    setor = obter_setor(local)
+    if not setor:
+        return jsonify({"erro": f"Setor desconhecido: {local}"}), 400
     try:
-        aventureiro.localizacao_atual = local
+        registrar_movimento('jogador', aventureiro, setor)
         db.session.commit()
         return jsonify({"message": f"Localização atualizada para {local}"}), 200
     except Exception as e:
@@ -440,40 +2168,59 @@ def set_localizacao():
         return jsonify({"erro": str(e)}), 500
 @app.route('/api/receitas', methods=['GET'])
 @jwt_required()
+@condicional('receita')
 def get_receitas_jogador():
     receitas = Receita.query.order_by(Receita.nome_item_final).all()
     return jsonify([r.to_dict() for r in receitas])
 @app.route('/api/produzir/<int:id_receita>', methods=['POST'])
 @jwt_required()
 def produzir_item(id_receita):
-    nome_jogador = get_jwt_identity()
-    jogador = Aventureiro.query.filter_by(nome_aventureiro=nome_jogador).first_or_404()
-    receita = Receita.query.get(id_receita)
+    # ?vezes=N produz N lotes de uma vez (tudo ou nada, numa única transação)
+    jogador = aventureiro_logado()
+    receita = GRAFO_RECEITAS.receita(id_receita)
     if not receita:
         return jsonify({"erro": "Receita não encontrada."}), 404
+    vezes = request.args.get('vezes', 1, type=int)
+    if not 1 <= vezes <= 100:
+        return jsonify({"erro": "'vezes' deve estar entre 1 e 100."}), 400
     try:
-        inventario = json.loads(jogador.inventario)
-        ingredientes = json.loads(receita.ingredientes_json)
-        for item, quantia_necessaria in ingredientes.items():
-            item_norm = item.strip().lower()
-            quantia_no_inventario = inventario.get(item_norm, 0)
-            if quantia_no_inventario < quantia_necessaria:
-                return jsonify({"erro": f"Materiais insuficientes. Falta: {item_norm} (x{quantia_necessaria - quantia_no_inventario})."}), 400
-        for item, quantia_necessaria in ingredientes.items():
-            item_norm = item.strip().lower()
-            inventario[item_norm] -= quantia_necessaria
-            if inventario[item_norm] == 0:
-                del inventario[item_norm]
-        item_final_norm = receita.nome_item_final.strip().lower()
-        quantia_atual_final = inventario.get(item_final_norm, 0)
-        inventario[item_final_norm] = quantia_atual_final + receita.quantia_produzida
-        jogador.inventario = json.dumps(inventario)
-        adicionar_informe(f"[OFICINA] {jogador.nome_aventureiro} produziu {receita.quantia_produzida}x '{item_final_norm}'.")
-        db.session.commit()
+        with transacao_imediata():
+            for item_norm, quantia in receita.ingredientes:
+                quantia_necessaria = quantia * vezes
+                if not inventario_retirar(jogador, item_norm, quantia_necessaria, f"ingrediente da receita {receita.id}"):
+                    quantia_no_inventario = inventario_quantia(jogador, item_norm)
+                    raise OperacaoRecusada(f"Materiais insuficientes. Falta: {item_norm} (x{quantia_necessaria - quantia_no_inventario}).")
+            produzido = receita.quantia_produzida * vezes
+            inventario_somar(jogador, receita.item_final, produzido, f"produção da receita {receita.id}")
+            somar_estatistica_jogador(jogador.id, itens_produzidos=produzido)
+            somar_estatistica_global(itens_produzidos=produzido)
+            adicionar_informe(f"[OFICINA] {jogador.nome_aventureiro} produziu {produzido}x '{receita.item_final}'.", categoria='OFICINA', ator=jogador.nome_aventureiro)
         return jsonify(jogador.to_dict()), 200
+    except OperacaoRecusada as e:
+        return jsonify({"erro": str(e)}), 400
     except Exception as e:
-        db.session.rollback()
         return jsonify({"erro": str(e)}), 500
+@app.route('/api/produzir/possiveis', methods=['GET'])
+@jwt_required()
+@condicional('receita', 'inventario_item', por_usuario=True)
+def get_producoes_possiveis():
+    # O que o jogador consegue produzir agora (e quantas vezes). ?incluir_faltantes=1 traz também as outras, com o que falta.
+    inventario = dict(db.session.query(InventarioItem.item_norm, InventarioItem.quantidade).filter(
+        InventarioItem.aventureiro_id == current_user.id, InventarioItem.quantidade > 0))
+    incluir_faltantes = request.args.get('incluir_faltantes') == '1'
+    resultado = []
+    for receita, vezes, faltam in GRAFO_RECEITAS.possiveis(inventario):
+        if vezes or incluir_faltantes:
+            resultado.append({"id": receita.id, "nome_item_final": receita.item_final, "quantia_produzida": receita.quantia_produzida,
+                              "ingredientes": dict(receita.ingredientes), "max_vezes": vezes, "faltam": faltam})
+    return jsonify(resultado)
+@app.route('/api/receitas/usando/<item_nome>', methods=['GET'])
+@condicional('receita')
+def get_receitas_usando(item_nome):
+    # Receitas que levam o item como ingrediente
+    receitas = GRAFO_RECEITAS.que_usam(normalizar_item(urllib.parse.unquote(item_nome)))
+    return jsonify([{"id": r.id, "nome_item_final": r.item_final, "quantia_produzida": r.quantia_produzida,
+                     "ingredientes": dict(r.ingredientes)} for r in receitas])
 
 # --- ROTAS DO TERMINAL DO GM ---
 @app.route('/gm')
@@ -496,19 +2243,106 @@ def gm_mapa_dashboard():
 def gm_oficina_dashboard():
     try: return render_template('gm_oficina.html')
     except Exception as e: return f"Erro: 'gm_oficina.html' não encontrado. {e}", 404
+# Campos aceitos em /api/jogadores?fields=... (os mesmos do to_dict; "inventario" vem de inventario_item)
+CAMPOS_JOGADOR = ('id', 'username', 'nome_aventureiro', 'nome_jogador', 'classe_origem', 'motivacao', 'xp', 'kaicons',
+                  'nivel', 'habilidades', 'xp_total', 'backup_hash', 'backup_tamanho', 'inventario', 'localizacao_atual', 'setor_id')
+CAMPOS_CALCULADOS = ('inventario', 'xp_total') # Não são colunas de aventureiro
+VISOES_JOGADOR = {"roster": ('id', 'nome_aventureiro', 'nivel', 'localizacao_atual')}
+def projetar_jogadores(campos, apos=None, limite=None):
+    # SELECT só das colunas pedidas (tuplas, sem montar objetos ORM), ordenado por nome para a paginação keyset
+    nomes_colunas = [c for c in campos if c not in CAMPOS_CALCULADOS]
+    colunas = [getattr(Aventureiro, c) for c in nomes_colunas]
+    consulta = db.session.query(Aventureiro.id, Aventureiro.nome_aventureiro, Aventureiro.nivel, Aventureiro.xp, *colunas).order_by(Aventureiro.nome_aventureiro)
+    if apos is not None: consulta = consulta.filter(Aventureiro.nome_aventureiro > apos)
+    if limite is not None: consulta = consulta.limit(limite)
+    linhas = consulta.all()
+    inventarios = {}
+    if 'inventario' in campos and linhas:
+        itens = db.session.query(InventarioItem.aventureiro_id, InventarioItem.item_norm, InventarioItem.quantidade).filter(
+            InventarioItem.aventureiro_id.in_([linha[0] for linha in linhas]), InventarioItem.quantidade > 0
+        ).order_by(InventarioItem.id)
+        for aventureiro_id, item_norm, quantidade in itens:
+            inventarios.setdefault(aventureiro_id, {})[item_norm] = quantidade
+    jogadores = []
+    for linha in linhas:
+        valores = dict(zip(nomes_colunas, linha[4:]))
+        if 'inventario' in campos: valores['inventario'] = json.dumps(inventarios.get(linha[0], {}))
+        if 'xp_total' in campos: valores['xp_total'] = CURVA_XP.xp_total(linha[2], linha[3])
+        jogadores.append(valores)
+    ultimo = linhas[-1][1] if linhas else None
+    return jogadores, ultimo
 @app.route('/api/jogadores', methods=['GET'])
+@condicional('aventureiro', 'inventario_item')
 def get_jogadores():
-    aventureiros = Aventureiro.query.order_by(Aventureiro.nome_aventureiro).all()
-    return jsonify([a.to_dict() for a in aventureiros])
+    # Sem parâmetros: todos os campos de todos (como antes). ?fields=nome_aventureiro,nivel ou ?view=roster
+    # carregam só essas colunas. ?limite=N&apos=<nome> pagina por nome -> {"jogadores": [...], "proximo": <nome|null>}
+    if request.args.get('view'):
+        if request.args['view'] not in VISOES_JOGADOR:
+            return jsonify({"erro": f"Visão desconhecida. Use: {', '.join(VISOES_JOGADOR)}"}), 400
+        campos = VISOES_JOGADOR[request.args['view']]
+    elif request.args.get('fields'):
+        campos = tuple(dict.fromkeys(c.strip() for c in request.args['fields'].split(',') if c.strip()))
+        desconhecidos = [c for c in campos if c not in CAMPOS_JOGADOR]
+        if desconhecidos or not campos:
+            return jsonify({"erro": f"Campos desconhecidos: {', '.join(desconhecidos)}"}), 400
+    else:
+        campos = CAMPOS_JOGADOR
+    if 'limite' not in request.args and 'apos' not in request.args:
+        return jsonify(projetar_jogadores(campos)[0])
+    limite = min(max(request.args.get('limite', 50, type=int), 1), 200)
+    jogadores, ultimo = projetar_jogadores(campos, apos=request.args.get('apos'), limite=limite)
+    return jsonify({"jogadores": jogadores, "proximo": ultimo if len(jogadores) == limite else None})
+RANKINGS = {"xp": None, "kaicons": Aventureiro.kaicons,
+            "tarefas": EstatisticaJogador.tarefas_concluidas, "producao": EstatisticaJogador.itens_produzidos}
+def top_jogadores(por, limite):
+    # Lê só as primeiras linhas do índice da métrica. xp: (nivel, xp) desc equivale a ordenar pelo XP total.
+    if por == 'xp':
+        linhas = db.session.query(Aventureiro.nome_aventureiro, Aventureiro.nivel, Aventureiro.xp).order_by(
+            Aventureiro.nivel.desc(), Aventureiro.xp.desc(), Aventureiro.id).limit(limite)
+        return [{"nome_aventureiro": nome, "nivel": nivel, "valor": CURVA_XP.xp_total(nivel, xp)} for nome, nivel, xp in linhas]
+    coluna = RANKINGS[por]
+    consulta = db.session.query(Aventureiro.nome_aventureiro, Aventureiro.nivel, coluna)
+    if coluna.class_ is EstatisticaJogador:
+        consulta = consulta.select_from(EstatisticaJogador).join(Aventureiro, Aventureiro.id == EstatisticaJogador.aventureiro_id).filter(coluna > 0)
+    linhas = consulta.order_by(coluna.desc(), Aventureiro.id).limit(limite)
+    return [{"nome_aventureiro": nome, "nivel": nivel, "valor": valor} for nome, nivel, valor in linhas]
+@app.route('/api/ranking', methods=['GET'])
+@condicional('aventureiro', 'estatistica_jogador')
+def get_ranking():
+    # ?por=xp|kaicons|tarefas|producao &limite=10
+    por = request.args.get('por', 'xp')
+    if por not in RANKINGS:
+        return jsonify({"erro": f"Ranking desconhecido. Use: {', '.join(RANKINGS)}"}), 400
+    limite = min(max(request.args.get('limite', 10, type=int), 1), 100)
+    return jsonify([dict(linha, posicao=posicao) for posicao, linha in enumerate(top_jogadores(por, limite), 1)])
+@app.route('/api/estatisticas', methods=['GET'])
+@condicional('estatistica_global', 'estatistica_jogador', 'estatistica_item_loja', 'aventureiro') # Os tops levam o nível
+def get_estatisticas():
+    # Totais da economia, vendas da loja por item (?itens=20) e quem mais produz
+    limite_itens = min(max(request.args.get('itens', 20, type=int), 1), 200)
+    economia = dict(db.session.query(EstatisticaGlobal.chave, EstatisticaGlobal.valor))
+    vendas = db.session.query(EstatisticaItemLoja.item, EstatisticaItemLoja.quantidade, EstatisticaItemLoja.receita).order_by(
+        EstatisticaItemLoja.quantidade.desc(), EstatisticaItemLoja.item).limit(limite_itens)
+    return jsonify({
+        "economia": economia,
+        "vendas_por_item": [{"item": item, "quantidade": quantidade, "receita": receita} for item, quantidade, receita in vendas],
+        "top_produtores": top_jogadores('producao', 5),
+        "top_tarefas": top_jogadores('tarefas', 5),
+    })
 @app.route('/api/jogadores/<nome>', methods=['DELETE'])
 def delete_jogador(nome):
     try:
         nome_jogador = urllib.parse.unquote(nome)
         aventureiro_db = Aventureiro.query.filter_by(nome_aventureiro=nome_jogador).first()
         if aventureiro_db:
+            registrar_movimento('jogador', aventureiro_db, None)
+            somar_estatistica_global(jogadores=-1, kaicons_em_circulacao=-(aventureiro_db.kaicons or 0))
+            backup_removido = aventureiro_db.backup_hash
             db.session.delete(aventureiro_db)
-            db.session.commit()
+            db.session.flush()
+            podar_backups_orfaos([backup_removido])
             adicionar_informe(f"Aventureiro '{nome_jogador}' foi removido do Habitat.")
+            db.session.commit()
             return jsonify({"message": f"Jogador {nome_jogador} removido com sucesso."}), 200
         else:
             return jsonify({"erro": "Jogador não encontrado no DB"}), 404
@@ -517,17 +2351,153 @@ def delete_jogador(nome):
         return jsonify({"erro": str(e)}), 500
 
 # --- GERENCIAMENTO DE TAREFAS (Quests) ---
+TAREFA_ABERTA = ('ATIVA', 'PENDENTE') # Aceitam pedidos e recompensas
 @app.route('/api/tarefas/ativas', methods=['GET'])
+@condicional('tarefa')
 def get_tarefas_ativas():
     # Rota para o GM ver apenas tarefas que ele pode criar/deletar
     tarefas = Tarefa.query.filter_by(status='ATIVA').all()
     return jsonify([t.to_dict() for t in tarefas])
 
 @app.route('/api/tarefas/pendentes', methods=['GET'])
+@condicional('tarefa', 'tarefa_claim')
 def get_tarefas_pendentes():
-    # Rota para o GM ver tarefas que precisam de aprovação
-    tarefas = Tarefa.query.filter_by(status='PENDENTE').all()
-    return jsonify([t.to_dict() for t in tarefas])
+    # Rota para o GM ver tarefas que precisam de aprovação (com quantos pedidos cada uma tem na fila)
+    contagem = dict(db.session.query(TarefaClaim.tarefa_id, db.func.count(TarefaClaim.id)).filter(
+        TarefaClaim.estado == 'PENDENTE').group_by(TarefaClaim.tarefa_id))
+    tarefas = Tarefa.query.filter(db.or_(Tarefa.id.in_(list(contagem)), Tarefa.status == 'PENDENTE')).order_by(Tarefa.id).all()
+    return jsonify([dict(t.to_dict(), pedidos_pendentes=contagem.get(t.id, 0)) for t in tarefas])
+@app.route('/api/tarefas/fila', methods=['GET'])
+@condicional('tarefa_claim', 'tarefa', 'lista_aventureiros')
+def get_fila_aprovacao():
+    # Fila de aprovação do GM em ordem de chegada, paginada: ?limite=50&apos=<id do último pedido da página anterior>
+    limite = min(max(request.args.get('limite', 50, type=int), 1), 200)
+    consulta = db.session.query(TarefaClaim.id, TarefaClaim.criado_em, TarefaClaim.tarefa_id, Tarefa.texto, Tarefa.xp_reward,
+                                Tarefa.kc_reward, TarefaClaim.aventureiro_id, Aventureiro.nome_aventureiro).join(
+        Tarefa, Tarefa.id == TarefaClaim.tarefa_id).join(Aventureiro, Aventureiro.id == TarefaClaim.aventureiro_id).filter(
+        TarefaClaim.estado == 'PENDENTE')
+    apos = request.args.get('apos', type=int)
+    if apos is not None:
+        # Keyset por (criado_em, id): quem pede de novo volta para o fim da fila com o mesmo id
+        referencia = db.session.query(TarefaClaim.criado_em).filter(TarefaClaim.id == apos).scalar()
+        if referencia is None:
+            return jsonify({"erro": "Pedido 'apos' não encontrado."}), 400
+        consulta = consulta.filter(db.or_(TarefaClaim.criado_em > referencia,
+                                          db.and_(TarefaClaim.criado_em == referencia, TarefaClaim.id > apos)))
+    linhas = consulta.order_by(TarefaClaim.criado_em, TarefaClaim.id).limit(limite).all()
+    pedidos = [{"id": id_, "criado_em": criado_em.isoformat(timespec='seconds'), "tarefa_id": tarefa_id, "tarefa_texto": texto,
+                "xp_reward": xp, "kc_reward": kc, "aventureiro_id": aventureiro_id, "aventureiro_nome": nome}
+               for id_, criado_em, tarefa_id, texto, xp, kc, aventureiro_id, nome in linhas]
+    return jsonify({"pedidos": pedidos, "proximo": pedidos[-1]["id"] if len(pedidos) == limite else None})
+def pedidos_da_fila(data):
+    # {"ids": [...]} escolhe os pedidos; {"quantidade": N} pega os N primeiros da fila
+    consulta = TarefaClaim.query.filter(TarefaClaim.estado == 'PENDENTE')
+    if 'ids' in data:
+        ids = data['ids']
+        if not isinstance(ids, list) or not ids or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            raise OperacaoRecusada("'ids' deve ser uma lista de ids de pedidos.")
+        if len(ids) > LIMITE_OPERACOES_LOTE:
+            raise OperacaoRecusada(f"Máximo de {LIMITE_OPERACOES_LOTE} pedidos por vez.")
+        pedidos = consulta.filter(TarefaClaim.id.in_(ids)).all()
+        faltando = set(ids) - {p.id for p in pedidos}
+        if faltando:
+            raise OperacaoRecusada(f"Pedidos inexistentes ou já decididos: {sorted(faltando)}")
+        return sorted(pedidos, key=lambda p: (p.criado_em, p.id))
+    quantidade = data.get('quantidade')
+    if isinstance(quantidade, bool) or not isinstance(quantidade, int) or not 1 <= quantidade <= LIMITE_OPERACOES_LOTE:
+        raise OperacaoRecusada(f"Envie 'ids' ou 'quantidade' (1 a {LIMITE_OPERACOES_LOTE}).")
+    return consulta.order_by(TarefaClaim.criado_em, TarefaClaim.id).limit(quantidade).all()
+def decidir_pedidos(pedidos, estado):
+    # UPDATE condicional: se outro GM decidiu algum pedido no meio do caminho, nada é aplicado
+    ids = [p.id for p in pedidos]
+    resultado = db.session.execute(db.update(TarefaClaim).where(TarefaClaim.id.in_(ids), TarefaClaim.estado == 'PENDENTE').values(
+        estado=estado, decidido_em=datetime.now()))
+    if resultado.rowcount != len(ids):
+        raise OperacaoRecusada("Algum pedido já foi decidido. Recarregue a fila.")
+    for pedido in pedidos: db.session.expire(pedido, ['estado', 'decidido_em'])
+    marcar_alterado('tarefa_claim')
+def encerrar_tarefas(*tarefa_ids):
+    # Tarefa concluída não aceita mais pedidos; os que estavam na fila são cancelados
+    if not tarefa_ids: return
+    db.session.flush() # As alterações pendentes vão antes: os objetos carregados são expirados logo abaixo
+    db.session.execute(db.update(Tarefa).where(Tarefa.id.in_(tarefa_ids)).values(status='CONCLUIDA'))
+    db.session.execute(db.update(TarefaClaim).where(TarefaClaim.tarefa_id.in_(tarefa_ids), TarefaClaim.estado == 'PENDENTE').values(
+        estado='CANCELADA', decidido_em=datetime.now()))
+    for objeto in db.session.identity_map.values():
+        if isinstance(objeto, (Tarefa, TarefaClaim)): db.session.expire(objeto)
+    marcar_alterado('tarefa', 'tarefa_claim')
+def registrar_aprovacoes_diretas(planos):
+    # GM aprovou sem pedido (rotas /complete e lote): grava o pedido APROVADO para a tarefa não pagar duas vezes
+    existentes = {(p.tarefa_id, p.aventureiro_id): p for p in TarefaClaim.query.filter(
+        TarefaClaim.tarefa_id.in_({tarefa.id for _, tarefa in planos}))}
+    agora = datetime.now()
+    for aventureiro, tarefa in planos:
+        pedido = existentes.get((tarefa.id, aventureiro.id))
+        if pedido is None:
+            db.session.add(TarefaClaim(tarefa_id=tarefa.id, aventureiro_id=aventureiro.id, estado='APROVADA', criado_em=agora, decidido_em=agora))
+        else:
+            pedido.estado = 'APROVADA'; pedido.decidido_em = agora
+def ja_aprovados(pares):
+    # pares: {(tarefa_id, aventureiro_id)} -> os que já receberam a recompensa
+    if not pares: return set()
+    linhas = db.session.query(TarefaClaim.tarefa_id, TarefaClaim.aventureiro_id).filter(
+        TarefaClaim.tarefa_id.in_({t for t, _ in pares}), TarefaClaim.estado == 'APROVADA')
+    return {linha for linha in map(tuple, linhas) if linha in pares}
+def recompensar_tarefas(planos):
+    # planos: [(aventureiro, tarefa)] já validados. XP, KÇ (um UPDATE para todos os saldos) e level-up na mesma transação.
+    movimentos = []; com_xp = {}
+    for aventureiro, tarefa in planos:
+        aventureiro.xp += tarefa.xp_reward
+        com_xp[aventureiro.id] = aventureiro
+        contar_tarefa_concluida(aventureiro, tarefa)
+        movimentos.append((aventureiro, tarefa.kc_reward, f"recompensa da tarefa {tarefa.id}"))
+        adicionar_informe(f"[GM] aprovou a tarefa '{tarefa.texto}' para {aventureiro.nome_aventureiro} (+{tarefa.xp_reward} XP, +{tarefa.kc_reward} KÇ).")
+    for aventureiro in com_xp.values():
+        verificar_level_up(aventureiro)
+    mover_kaicons_em_lote(movimentos)
+@app.route('/api/tarefas/fila/aprovar', methods=['POST'])
+def aprovar_fila():
+    # {"ids": [...]} ou {"quantidade": N}: aprova tudo numa transação só (ou nada, se algum pedido não puder ser aprovado)
+    try:
+        with transacao_imediata():
+            pedidos = pedidos_da_fila(request.json or {})
+            tarefas = {t.id: t for t in Tarefa.query.filter(Tarefa.id.in_({p.tarefa_id for p in pedidos}))}
+            aventureiros = {a.id: a for a in Aventureiro.query.filter(Aventureiro.id.in_({p.aventureiro_id for p in pedidos}))}
+            fechadas = sorted({p.id for p in pedidos if tarefas[p.tarefa_id].status not in TAREFA_ABERTA})
+            if fechadas:
+                raise OperacaoRecusada(f"Pedidos de tarefas já concluídas: {fechadas}")
+            planos = [(aventureiros[p.aventureiro_id], tarefas[p.tarefa_id]) for p in pedidos]
+            resultados = [{"pedido_id": p.id, "tarefa_id": p.tarefa_id, "aventureiro_nome": aventureiros[p.aventureiro_id].nome_aventureiro,
+                           "xp": tarefas[p.tarefa_id].xp_reward, "kaicons": tarefas[p.tarefa_id].kc_reward} for p in pedidos]
+            decidir_pedidos(pedidos, 'APROVADA')
+            recompensar_tarefas(planos)
+            # Tarefas de reparo do Habitat valem uma vez só: a aprovação repara o sistema e encerra a tarefa
+            reparos = [id_ for (id_,) in db.session.query(HabitatSistema.tarefa_reparo_id).filter(
+                HabitatSistema.tarefa_reparo_id.in_(list(tarefas)))]
+            reparar_sistemas_da_tarefa(*reparos)
+            encerrar_tarefas(*reparos)
+        return jsonify({"aprovados": len(resultados), "resultados": resultados}), 200
+    except OperacaoRecusada as e:
+        return jsonify({"erro": str(e)}), 400
+    except Exception as e:
+        return jsonify({"erro": str(e)}), 500
+@app.route('/api/tarefas/fila/recusar', methods=['POST'])
+def recusar_fila():
+    try:
+        with transacao_imediata():
+            pedidos = pedidos_da_fila(request.json or {})
+            nomes = dict(db.session.query(Aventureiro.id, Aventureiro.nome_aventureiro).filter(
+                Aventureiro.id.in_({p.aventureiro_id for p in pedidos})))
+            textos = dict(db.session.query(Tarefa.id, Tarefa.texto).filter(Tarefa.id.in_({p.tarefa_id for p in pedidos})))
+            for pedido in pedidos:
+                adicionar_informe(f"[GM] recusou o pedido de {nomes[pedido.aventureiro_id]} para a tarefa '{textos[pedido.tarefa_id]}'.",
+                                  categoria='TAREFA', ator=nomes[pedido.aventureiro_id])
+            decidir_pedidos(pedidos, 'RECUSADA')
+        return jsonify({"recusados": len(pedidos)}), 200
+    except OperacaoRecusada as e:
+        return jsonify({"erro": str(e)}), 400
+    except Exception as e:
+        return jsonify({"erro": str(e)}), 500
 
 @app.route('/api/tarefas', methods=['POST'])
 def add_tarefa():
@@ -535,14 +2505,18 @@ def add_tarefa():
         data = request.json
         if not data or 'texto' not in data: return jsonify({"erro": "Texto da tarefa é obrigatório"}), 400
         nova_tarefa = Tarefa(texto=data['texto'], xp_reward=data.get('xp_reward', 10), kc_reward=data.get('kc_reward', 5), status='ATIVA')
-        db.session.add(nova_tarefa); db.session.commit()
+        db.session.add(nova_tarefa)
         adicionar_informe(f"Nova Tarefa (Quest) adicionada: {nova_tarefa.texto}")
+        db.session.commit()
         return jsonify(nova_tarefa.to_dict()), 201
     except Exception as e: return jsonify({"erro": str(e)}), 500
 @app.route('/api/tarefas/<int:id>', methods=['DELETE'])
 def delete_tarefa_simples(id):
     tarefa = Tarefa.query.get(id)
     if tarefa:
+        # A FK é ON DELETE SET NULL, mas o SQLite só a aplica com foreign_keys ligado (e colunas migradas nem têm a FK)
+        for sistema in HabitatSistema.query.filter_by(tarefa_reparo_id=tarefa.id):
+            sistema.tarefa_reparo_id = None
         db.session.delete(tarefa); db.session.commit()
         return jsonify({"message": "Tarefa removida"}), 200
     return jsonify({"erro": "Tarefa não encontrada"}), 404
@@ -557,16 +2531,21 @@ def complete_tarefa(id):
         aventureiro = Aventureiro.query.filter_by(nome_aventureiro=nome_aventureiro).first_or_404()
         tarefa = Tarefa.query.get_or_404(id)
         
-        # Só dá recompensa se a tarefa estava PENDENTE (ou ATIVA, caso o GM force)
-        if tarefa.status == 'PENDENTE' or tarefa.status == 'ATIVA':
+        # Só dá recompensa se a tarefa estava PENDENTE (ou ATIVA, caso o GM force). Encerra a tarefa para todos.
+        if tarefa.status in TAREFA_ABERTA:
+            if ja_aprovados({(tarefa.id, aventureiro.id)}):
+                return jsonify({"erro": f"{nome_aventureiro} já recebeu esta tarefa."}), 400
             xp_ganho = tarefa.xp_reward; kc_ganho = tarefa.kc_reward
-            aventureiro.xp += xp_ganho; aventureiro.kaicons += kc_ganho
+            aventureiro.xp += xp_ganho
+            mover_kaicons(aventureiro, kc_ganho, f"recompensa da tarefa {tarefa.id}")
             texto_tarefa = tarefa.texto
-            
-            tarefa.status = 'CONCLUIDA' # Marca como concluída
+            registrar_aprovacoes_diretas([(aventureiro, tarefa)])
+            contar_tarefa_concluida(aventureiro, tarefa)
             
             adicionar_informe(f"[GM] aprovou a tarefa '{texto_tarefa}' para {nome_aventureiro} (+{xp_ganho} XP, +{kc_ganho} KÇ).")
             verificar_level_up(aventureiro)
+            reparar_sistemas_da_tarefa(tarefa.id)
+            encerrar_tarefas(tarefa.id) # Marca como concluída
             db.session.commit()
             return jsonify({"message": f"Recompensa dada a {nome_aventureiro}."}), 200
         else:
@@ -577,19 +2556,22 @@ def complete_tarefa(id):
         return jsonify({"erro": str(e)}), 500
 
 # --- GERENCIAMENTO DE ALERTAS ---
-# (POST, DELETE - Sem alterações)
 @app.route('/api/alertas', methods=['POST'])
 def add_alerta():
     try:
         data = request.json
         if not data or 'texto' not in data: return jsonify({"erro": "Texto do alerta é obrigatório"}), 400
-        adicionar_alerta_global(data['texto'])
-        return jsonify({"message": "Alerta enviado"}), 201
+        try: ttl = int(data['ttl']) if data.get('ttl') is not None else None
+        except (ValueError, TypeError): return jsonify({"erro": "ttl inválido (segundos)."}), 400
+        alerta = adicionar_alerta_global(data['texto'], ttl=ttl)
+        db.session.commit()
+        return jsonify({"message": "Alerta enviado", "id": alerta.id}), 201
     except Exception as e: return jsonify({"erro": str(e)}), 500
 @app.route('/api/alertas', methods=['DELETE'])
 def clear_alertas():
-    global ALERTAS_DB
-    ALERTAS_DB.clear()
+    Alerta.query.delete()
+    marcar_alterado('alerta')
+    db.session.commit()
     return jsonify({"message": "Alertas limpos"}), 200
 
 # --- GERENCIAMENTO DE CRONOGRAMAS (Eventos) ---
@@ -618,13 +2600,32 @@ def delete_cronograma(id):
 # --- GERENCIAMENTO DE RODÍZIO (Tarefas Comunitárias) ---
 # (GET, POST, DELETE - Sem alterações)
 @app.route('/api/rodizio', methods=['GET'])
+@condicional('rodizio', 'lista_aventureiros', por_dia=True)
 def get_rodizio():
     hoje = datetime.now().date()
-    jogadores = get_lista_nomes_jogadores()
-    tarefas = Rodizio.query.order_by(Rodizio.id).all()
-    atribuicoes_hoje = calcular_atribuicao(hoje, jogadores, tarefas)
-    tarefas_lista = [t.to_dict() for t in tarefas]
+    atribuicoes_hoje = ESCALA_RODIZIO.dia(hoje)["atribuicoes"]
+    tarefas_lista = [t._asdict() for t in ESCALA_RODIZIO.tarefas()]
     return jsonify({"atribuicoes_hoje": atribuicoes_hoje, "tipos_de_tarefa": tarefas_lista})
+@app.route('/api/rodizio/calendario', methods=['GET'])
+@condicional('rodizio', 'lista_aventureiros', por_dia=True)
+def get_rodizio_calendario():
+    # ?de=2024-05-01&ate=2024-05-31 (padrão: a semana a partir de hoje, máx. 62 dias) &jogador=Fulano (opcional)
+    try:
+        de = datetime.strptime(request.args['de'], '%Y-%m-%d').date() if request.args.get('de') else datetime.now().date()
+        ate = datetime.strptime(request.args['ate'], '%Y-%m-%d').date() if request.args.get('ate') else de + timedelta(days=6)
+    except ValueError:
+        return jsonify({"erro": "Datas inválidas. Use AAAA-MM-DD."}), 400
+    if ate < de or (ate - de).days > 61:
+        return jsonify({"erro": "Intervalo inválido (máximo de 62 dias)."}), 400
+    jogador = request.args.get('jogador')
+    dias = []
+    dia = de
+    while dia <= ate:
+        escala = ESCALA_RODIZIO.dia(dia)
+        atribuicoes = escala["por_jogador"].get(jogador, []) if jogador else escala["atribuicoes"]
+        dias.append({"data": dia.isoformat(), "dia_semana": dia.strftime('%A').capitalize(), "atribuicoes": atribuicoes})
+        dia += timedelta(days=1)
+    return jsonify({"de": de.isoformat(), "ate": ate.isoformat(), "dias": dias})
 @app.route('/api/rodizio', methods=['POST'])
 def add_rodizio():
     try:
@@ -633,8 +2634,9 @@ def add_rodizio():
         if not nome or not desc:
             return jsonify({"erro": "Nome da tarefa e descrição são obrigatórios"}), 400
         nova_tarefa_rodizio = Rodizio(nome_tarefa=nome, descricao=desc)
-        db.session.add(nova_tarefa_rodizio); db.session.commit()
+        db.session.add(nova_tarefa_rodizio)
         adicionar_informe(f"Nova tarefa comunitária criada: {nome}")
+        db.session.commit()
         return jsonify(nova_tarefa_rodizio.to_dict()), 201
     except Exception as e: return jsonify({"erro": str(e)}), 500
 @app.route('/api/rodizio/<int:id>', methods=['DELETE'])
@@ -642,8 +2644,9 @@ def delete_rodizio_tarefa(id):
     tarefa_rodizio = Rodizio.query.get(id)
     if tarefa_rodizio:
         nome_tarefa = tarefa_rodizio.nome_tarefa
-        db.session.delete(tarefa_rodizio); db.session.commit()
+        db.session.delete(tarefa_rodizio)
         adicionar_informe(f"Tarefa comunitária removida: {nome_tarefa}")
+        db.session.commit()
         return jsonify({"message": "Tipo de tarefa de rodízio removida"}), 200
     return jsonify({"erro": "Tipo de tarefa de rodízio não encontrada"}), 404
 
@@ -654,6 +2657,7 @@ def add_informe_manual():
     texto = data.get('texto')
     if not texto: return jsonify({"erro": "Texto do informe é obrigatório"}), 400
     adicionar_informe(f"[INFORME MANUAL] {texto}")
+    db.session.commit()
     return jsonify({"message": "Informe adicionado ao registro."}), 201
 
 # (POST /api/aventureiro/ajustar-stats - Sem alterações)
@@ -667,8 +2671,9 @@ def adjust_stats():
         log_msgs = []; xp_adicionado = False
         if data.get('kaicons') is not None:
             quantia = int(data.get('kaicons'))
-            if (aventureiro.kaicons + quantia) < 0: return jsonify({"erro": "Ajuste de KÇ deixaria o saldo negativo."}), 400
-            aventureiro.kaicons += quantia
+            if not mover_kaicons(aventureiro, quantia, "ajuste do GM"):
+                db.session.rollback()
+                return jsonify({"erro": "Ajuste de KÇ deixaria o saldo negativo."}), 400
             log_msgs.append(f"{quantia} KÇ")
         if data.get('xp') is not None:
             quantia = int(data.get('xp'))
@@ -679,6 +2684,7 @@ def adjust_stats():
         if data.get('nivel') is not None:
             aventureiro.nivel = int(data.get('nivel'))
             log_msgs.append(f"Nível para {data.get('nivel')}")
+            xp_adicionado = True # O XP atual pode não caber no novo nível
         if data.get('habilidades') is not None:
             aventureiro.habilidades = data.get('habilidades')
             log_msgs.append(f"Habilidades atualizadas")
@@ -705,27 +2711,216 @@ def adjust_inventario():
         return jsonify({"erro": "Nome, item e quantia (não-zero) são obrigatórios."}), 400
     aventureiro = Aventureiro.query.filter_by(nome_aventureiro=nome_aventureiro).first()
     if not aventureiro: return jsonify({"erro": "Aventureiro não encontrado."}), 404
-    try:
-        inventario = json.loads(aventureiro.inventario)
-    except json.JSONDecodeError: inventario = {}
-    nome_item_normalizado = item_nome.strip().lower()
-    quantia_atual = inventario.get(nome_item_normalizado, 0)
-    nova_quantia = quantia_atual + quantia
-    if nova_quantia < 0:
+    nome_item_normalizado = normalizar_item(item_nome)
+    if quantia > 0:
+        inventario_somar(aventureiro, nome_item_normalizado, quantia, "ajuste do GM")
+    elif not inventario_retirar(aventureiro, nome_item_normalizado, abs(quantia), "ajuste do GM"):
+        db.session.rollback()
+        quantia_atual = inventario_quantia(aventureiro, nome_item_normalizado)
         return jsonify({"erro": f"Não é possível remover {abs(quantia)}. O jogador só tem {quantia_atual}."}), 400
-    elif nova_quantia == 0:
-        if nome_item_normalizado in inventario:
-            del inventario[nome_item_normalizado]
-    else:
-        inventario[nome_item_normalizado] = nova_quantia
-    aventureiro.inventario = json.dumps(inventario)
     acao = "adicionado(s)" if quantia > 0 else "removido(s)"
     adicionar_informe(f"[GM] {abs(quantia)}x '{nome_item_normalizado}' {acao} do inventário de {nome_aventureiro}.")
     db.session.commit()
     return jsonify(aventureiro.to_dict()), 200
 
+@app.route('/api/inventario/<item_nome>/donos', methods=['GET'])
+@condicional('inventario_item', 'aventureiro')
+def get_donos_item(item_nome):
+    # "Quem tem X?" via índice em inventario_item.item_norm
+    donos = db.session.query(Aventureiro.nome_aventureiro, InventarioItem.quantidade).join(InventarioItem).filter(
+        InventarioItem.item_norm == normalizar_item(urllib.parse.unquote(item_nome)), InventarioItem.quantidade > 0
+    ).order_by(InventarioItem.quantidade.desc()).all()
+    return jsonify([{"nome_aventureiro": nome, "quantidade": quantidade} for nome, quantidade in donos])
+
+# --- OPERAÇÕES EM LOTE (GM) ---
+# Mesmo formato nas três rotas: {"operacoes": [{...}, ...]}. Tudo é validado antes de escrever, dentro de uma
+# única transação (BEGIN IMMEDIATE); se qualquer operação for inválida nada é aplicado e a resposta 400 traz o
+# resultado de cada item. Os informes vão juntos no commit (buffer de adicionar_informe).
+LIMITE_OPERACOES_LOTE = 500
+class LoteInvalido(Exception):
+    def __init__(self, resultados):
+        super().__init__("Operações inválidas no lote.")
+        self.resultados = resultados
+def ler_operacoes_lote():
+    operacoes = (request.json or {}).get('operacoes')
+    if not isinstance(operacoes, list) or not operacoes:
+        raise OperacaoRecusada("Envie 'operacoes' como uma lista não vazia.")
+    if len(operacoes) > LIMITE_OPERACOES_LOTE:
+        raise OperacaoRecusada(f"Máximo de {LIMITE_OPERACOES_LOTE} operações por lote.")
+    if not all(isinstance(op, dict) for op in operacoes):
+        raise OperacaoRecusada("Cada operação deve ser um objeto.")
+    return operacoes
+def aventureiros_por_nome(nomes):
+    nomes = {n for n in nomes if isinstance(n, str)}
+    if not nomes: return {}
+    return {a.nome_aventureiro: a for a in Aventureiro.query.filter(Aventureiro.nome_aventureiro.in_(nomes))}
+def mover_kaicons_em_lote(movimentos):
+    # movimentos: [(aventureiro, delta, motivo)] já validados. Um UPDATE com CASE para todos os saldos.
+    # A validação em Python não basta sob READ COMMITTED (Postgres): como em mover_kaicons, o próprio UPDATE
+    # só aceita as linhas que não ficam negativas, e qualquer linha recusada desfaz o lote inteiro.
+    totais = {}
+    for aventureiro, delta, motivo in movimentos:
+        if delta: totais[aventureiro.id] = totais.get(aventureiro.id, 0) + delta
+    if not totais: return
+    delta_por_id = db.case(totais, value=Aventureiro.id, else_=0)
+    resultado = db.session.execute(
+        db.update(Aventureiro).where(Aventureiro.id.in_(list(totais)), db.or_(delta_por_id >= 0, Aventureiro.kaicons >= -delta_por_id))
+        .values(kaicons=Aventureiro.kaicons + delta_por_id)
+    )
+    if resultado.rowcount != len(totais):
+        raise OperacaoRecusada("Kaicons insuficientes (o saldo mudou durante a operação).")
+    for aventureiro, delta, motivo in movimentos:
+        if delta: registrar_ledger('kaicons', delta, motivo, aventureiro_id=aventureiro.id)
+        db.session.expire(aventureiro, ['kaicons'])
+    marcar_alterado('aventureiro')
+    anotar_aventureiros_alterados(*totais)
+def responder_lote(executar):
+    try:
+        with transacao_imediata():
+            resultados = executar(ler_operacoes_lote())
+        return jsonify({"aplicado": True, "resultados": resultados}), 200
+    except LoteInvalido as e:
+        return jsonify({"aplicado": False, "erro": str(e), "resultados": e.resultados}), 400
+    except OperacaoRecusada as e:
+        return jsonify({"aplicado": False, "erro": str(e)}), 400
+    except Exception as e:
+        return jsonify({"aplicado": False, "erro": str(e)}), 500
+
+@app.route('/api/gm/lote/ajustar-stats', methods=['POST'])
+def lote_ajustar_stats():
+    # Operação: {"nome_aventureiro", "kaicons"?, "xp"?, "nivel"?, "habilidades"?} (como /api/aventureiro/ajustar-stats)
+    def executar(operacoes):
+        aventureiros = aventureiros_por_nome(op.get('nome_aventureiro') for op in operacoes)
+        saldos = {a.id: a.kaicons for a in aventureiros.values()}
+        resultados = []; planos = []
+        for indice, op in enumerate(operacoes):
+            nome = op.get('nome_aventureiro')
+            resultado = {"indice": indice, "nome_aventureiro": nome, "ok": False}
+            resultados.append(resultado)
+            aventureiro = aventureiros.get(nome)
+            if not aventureiro:
+                resultado["erro"] = "Aventureiro não encontrado."; continue
+            try:
+                ajuste = {campo: int(op[campo]) for campo in ('kaicons', 'xp', 'nivel') if op.get(campo) is not None}
+            except (ValueError, TypeError):
+                resultado["erro"] = "kaicons, xp e nivel devem ser inteiros."; continue
+            if op.get('habilidades') is not None: ajuste['habilidades'] = op['habilidades']
+            if not ajuste:
+                resultado["erro"] = "Nenhum dado válido enviado para ajuste."; continue
+            if saldos[aventureiro.id] + ajuste.get('kaicons', 0) < 0:
+                resultado["erro"] = "Ajuste de KÇ deixaria o saldo negativo."; continue
+            saldos[aventureiro.id] += ajuste.get('kaicons', 0)
+            resultado["ok"] = True
+            planos.append((aventureiro, ajuste))
+        if not all(r["ok"] for r in resultados): raise LoteInvalido(resultados)
+        movimentos = []; com_xp = {}
+        for aventureiro, ajuste in planos:
+            log_msgs = []
+            if 'kaicons' in ajuste:
+                movimentos.append((aventureiro, ajuste['kaicons'], "ajuste do GM (lote)"))
+                log_msgs.append(f"{ajuste['kaicons']} KÇ")
+            if 'xp' in ajuste:
+                aventureiro.xp = max(aventureiro.xp + ajuste['xp'], 0)
+                com_xp[aventureiro.id] = aventureiro
+                log_msgs.append(f"{ajuste['xp']} XP")
+            if 'nivel' in ajuste:
+                aventureiro.nivel = ajuste['nivel']
+                com_xp[aventureiro.id] = aventureiro
+                log_msgs.append(f"Nível para {ajuste['nivel']}")
+            if 'habilidades' in ajuste:
+                aventureiro.habilidades = ajuste['habilidades']
+                log_msgs.append("Habilidades atualizadas")
+            adicionar_informe(f"[GM] ajustou {aventureiro.nome_aventureiro}: " + ", ".join(log_msgs))
+        for aventureiro in com_xp.values():
+            verificar_level_up(aventureiro)
+        mover_kaicons_em_lote(movimentos)
+        return resultados
+    return responder_lote(executar)
+
+@app.route('/api/gm/lote/ajustar-inventario', methods=['POST'])
+def lote_ajustar_inventario():
+    # Operação: {"nome_aventureiro", "item_nome", "quantia"} (negativa remove), como /api/aventureiro/ajustar-inventario
+    def executar(operacoes):
+        aventureiros = aventureiros_por_nome(op.get('nome_aventureiro') for op in operacoes)
+        linhas = {}
+        if aventureiros:
+            for linha in InventarioItem.query.filter(InventarioItem.aventureiro_id.in_([a.id for a in aventureiros.values()])):
+                linhas[(linha.aventureiro_id, linha.item_norm)] = linha
+        quantias = {chave: linha.quantidade for chave, linha in linhas.items()}
+        resultados = []; planos = []
+        for indice, op in enumerate(operacoes):
+            nome = op.get('nome_aventureiro')
+            resultado = {"indice": indice, "nome_aventureiro": nome, "ok": False}
+            resultados.append(resultado)
+            aventureiro = aventureiros.get(nome)
+            if not aventureiro:
+                resultado["erro"] = "Aventureiro não encontrado."; continue
+            try: quantia = int(op.get('quantia'))
+            except (ValueError, TypeError):
+                resultado["erro"] = "Quantia inválida."; continue
+            if not op.get('item_nome') or quantia == 0:
+                resultado["erro"] = "Item e quantia (não-zero) são obrigatórios."; continue
+            chave = (aventureiro.id, normalizar_item(op['item_nome']))
+            atual = quantias.get(chave, 0)
+            if atual + quantia < 0:
+                resultado["erro"] = f"Não é possível remover {abs(quantia)}. O jogador só tem {atual}."; continue
+            quantias[chave] = atual + quantia
+            resultado.update(ok=True, item=chave[1], quantidade_final=quantias[chave])
+            planos.append((aventureiro, chave[1], quantia))
+        if not all(r["ok"] for r in resultados): raise LoteInvalido(resultados)
+        # Aplica as quantidades finais: UPDATE por chave primária, INSERT das linhas novas e DELETE das zeradas
+        atualizar = [{"id": linhas[c].id, "quantidade": q} for c, q in quantias.items() if c in linhas and q > 0 and q != linhas[c].quantidade]
+        remover = [linhas[c].id for c, q in quantias.items() if c in linhas and q <= 0]
+        inserir = [{"aventureiro_id": c[0], "item_norm": c[1], "quantidade": q} for c, q in quantias.items() if c not in linhas and q > 0]
+        if atualizar: db.session.execute(db.update(InventarioItem), atualizar)
+        if remover: db.session.execute(db.delete(InventarioItem).where(InventarioItem.id.in_(remover)))
+        if inserir: db.session.execute(db.insert(InventarioItem), inserir)
+        for linha in linhas.values(): db.session.expire(linha)
+        for aventureiro, item_norm, quantia in planos:
+            registrar_ledger(f'item:{item_norm}', quantia, "ajuste do GM (lote)", aventureiro_id=aventureiro.id)
+            acao = "adicionado(s)" if quantia > 0 else "removido(s)"
+            adicionar_informe(f"[GM] {abs(quantia)}x '{item_norm}' {acao} do inventário de {aventureiro.nome_aventureiro}.")
+        for aventureiro in aventureiros.values(): db.session.expire(aventureiro, ['itens'])
+        marcar_alterado('inventario_item')
+        return resultados
+    return responder_lote(executar)
+
+@app.route('/api/gm/lote/completar-tarefas', methods=['POST'])
+def lote_completar_tarefas():
+    # Operação: {"tarefa_id", "aventureiro_nome"} (como /api/tarefas/<id>/complete)
+    def executar(operacoes):
+        aventureiros = aventureiros_por_nome(op.get('aventureiro_nome') for op in operacoes)
+        ids = [op.get('tarefa_id') for op in operacoes if isinstance(op.get('tarefa_id'), int)]
+        tarefas = {t.id: t for t in Tarefa.query.filter(Tarefa.id.in_(ids))} if ids else {}
+        resultados = []; planos = []; vistas = set()
+        for indice, op in enumerate(operacoes):
+            nome = op.get('aventureiro_nome'); tarefa = tarefas.get(op.get('tarefa_id'))
+            resultado = {"indice": indice, "tarefa_id": op.get('tarefa_id'), "aventureiro_nome": nome, "ok": False}
+            resultados.append(resultado)
+            aventureiro = aventureiros.get(nome)
+            if not aventureiro:
+                resultado["erro"] = "Aventureiro não encontrado."; continue
+            if not tarefa:
+                resultado["erro"] = "Tarefa não encontrada."; continue
+            if tarefa.status not in TAREFA_ABERTA or tarefa.id in vistas:
+                resultado["erro"] = "Esta tarefa já foi concluída."; continue
+            vistas.add(tarefa.id)
+            resultado.update(ok=True, xp=tarefa.xp_reward, kaicons=tarefa.kc_reward)
+            planos.append((aventureiro, tarefa))
+        repetidos = ja_aprovados({(tarefa.id, aventureiro.id) for aventureiro, tarefa in planos})
+        for resultado, (aventureiro, tarefa) in zip([r for r in resultados if r["ok"]], planos):
+            if (tarefa.id, aventureiro.id) in repetidos:
+                resultado.update(ok=False, erro=f"{aventureiro.nome_aventureiro} já recebeu esta tarefa.")
+        if not all(r["ok"] for r in resultados): raise LoteInvalido(resultados)
+        registrar_aprovacoes_diretas(planos)
+        recompensar_tarefas(planos)
+        reparar_sistemas_da_tarefa(*vistas)
+        encerrar_tarefas(*vistas)
+        return resultados
+    return responder_lote(executar)
+
 # --- GERENCIAMENTO DA LOJA (GM) ---
-# (POST /api/loja-item, DELETE /api/loja-item/<id>, POST /api/loja/ajustar, GET /api/informes/loja - Sem alterações)
+# (POST /api/loja-item, DELETE /api/loja-item/<id>, POST /api/loja/ajustar - Sem alterações)
 @app.route('/api/loja-item', methods=['POST'])
 def add_loja_item():
     try:
@@ -737,8 +2932,10 @@ def add_loja_item():
         if LojaItem.query.filter_by(nome=nome).first():
             return jsonify({"erro": "Um item com este nome já existe na loja."}), 400
         novo_item = LojaItem(nome=nome, descricao=desc, preco=preco, estoque=estoque)
-        db.session.add(novo_item); db.session.commit()
+        db.session.add(novo_item); db.session.flush()
+        registrar_ledger('estoque', estoque, 'estoque inicial', loja_item_id=novo_item.id)
         adicionar_informe(f"[LOJA] Novo item à venda: {nome} por {preco} KÇ (Estoque: {estoque}).")
+        db.session.commit()
         return jsonify(novo_item.to_dict()), 201
     except Exception as e:
         db.session.rollback()
@@ -748,8 +2945,9 @@ def delete_loja_item(id):
     item = LojaItem.query.get(id)
     if item:
         nome_item = item.nome
-        db.session.delete(item); db.session.commit()
+        db.session.delete(item)
         adicionar_informe(f"[LOJA] Item removido da loja: {nome_item}.")
+        db.session.commit()
         return jsonify({"message": "Item removido da loja"}), 200
     return jsonify({"erro": "Item não encontrado"}), 404
 @app.route('/api/loja/ajustar', methods=['POST'])
@@ -766,10 +2964,9 @@ def adjust_loja_item():
             log_msgs.append(f"preço ajustado para {item.preco} KÇ")
         if data.get('adicionar_estoque') is not None:
             quantia = int(data.get('adicionar_estoque'))
-            if (item.estoque + quantia) < 0:
-                item.estoque = 0
-            else:
-                item.estoque += quantia
+            # Remoção maior que o estoque zera o item (como antes), registrando só o que saiu de fato
+            delta = max(quantia, -item.estoque)
+            if delta: mover_estoque(item, delta, "ajuste do GM")
             log_msgs.append(f"estoque ajustado em {quantia} (Total: {item.estoque})")
         if not log_msgs:
             return jsonify({"erro": "Nenhum dado válido enviado."}), 400
@@ -780,35 +2977,398 @@ def adjust_loja_item():
         db.session.rollback()
         return jsonify({"erro": str(e)}), 500
 @app.route('/api/informes/loja', methods=['GET'])
+@condicional('loja_venda', 'registro_informes')
 def get_informes_loja():
-    informes_db = RegistroInformes.query.filter(RegistroInformes.texto.like('%[LOJA]%')).order_by(RegistroInformes.timestamp.desc()).limit(50).all()
-    return jsonify([informe.to_dict() for informe in informes_db])
+    # Log da loja do GM: vendas de loja_venda + os demais informes [LOJA] (reposições, edições de itens, ajustes de estoque),
+    # ambos pelo índice de timestamp. Informes de compra antigos ficam de fora: já foram migrados para loja_venda.
+    vendas = LojaVenda.query.order_by(LojaVenda.timestamp.desc(), LojaVenda.id.desc()).limit(50).all()
+    outros = RegistroInformes.query.filter(
+        RegistroInformes.categoria == 'LOJA', ~RegistroInformes.texto.like('[LOJA]% comprou %')
+    ).order_by(RegistroInformes.timestamp.desc()).limit(50).all()
+    linhas = sorted(vendas + outros, key=lambda linha: linha.timestamp, reverse=True)[:50]
+    return jsonify([linha.to_dict() for linha in linhas])
+@app.route('/api/loja/vendas', methods=['GET'])
+@condicional('loja_venda')
+def get_vendas_loja():
+    # ?item_id=3 (índice (item, tempo)) &desde=2024-05-01T10:00 &antes_de=<id> (página anterior) &limite=100. Mais recentes primeiro.
+    consulta = LojaVenda.query
+    if request.args.get('item_id') is not None:
+        consulta = consulta.filter(LojaVenda.loja_item_id == request.args.get('item_id', type=int))
+    if request.args.get('desde'):
+        try: desde = datetime.fromisoformat(request.args['desde'])
+        except ValueError: return jsonify({"erro": "'desde' inválido. Use AAAA-MM-DDTHH:MM."}), 400
+        consulta = consulta.filter(LojaVenda.timestamp >= desde)
+    if request.args.get('antes_de') is not None:
+        consulta = consulta.filter(LojaVenda.id < request.args.get('antes_de', type=int))
+    limite = min(max(request.args.get('limite', 100, type=int), 1), 1000)
+    vendas = consulta.order_by(LojaVenda.timestamp.desc(), LojaVenda.id.desc()).limit(limite).all()
+    return jsonify([venda.to_dict() for venda in vendas])
+@app.route('/api/loja/vendas/resumo', methods=['GET'])
+@condicional('loja_venda')
+def get_resumo_vendas_loja():
+    # Vendas por item numa janela (?desde=&ate=, ISO). Sem janela, o total histórico vem de /api/estatisticas.
+    consulta = db.session.query(
+        LojaVenda.item_nome, db.func.sum(LojaVenda.quantidade), db.func.sum(LojaVenda.total),
+        db.func.count(db.distinct(LojaVenda.aventureiro_nome)), db.func.max(LojaVenda.timestamp))
+    try:
+        if request.args.get('desde'): consulta = consulta.filter(LojaVenda.timestamp >= datetime.fromisoformat(request.args['desde']))
+        if request.args.get('ate'): consulta = consulta.filter(LojaVenda.timestamp < datetime.fromisoformat(request.args['ate']))
+    except ValueError:
+        return jsonify({"erro": "Data inválida. Use AAAA-MM-DDTHH:MM."}), 400
+    linhas = consulta.group_by(LojaVenda.item_nome).order_by(db.func.sum(LojaVenda.quantidade).desc()).all()
+    return jsonify([{
+        "item": item, "quantidade": quantidade, "receita": receita, "compradores": compradores,
+        "ultima_venda": ultima.strftime("%d/%m %H:%M")
+    } for item, quantidade, receita, compradores, ultima in linhas])
+@app.route('/api/loja/reposicoes', methods=['GET'])
+@condicional('reposicao_loja', 'loja_item')
+def get_reposicoes_loja():
+    reposicoes = ReposicaoLoja.query.order_by(ReposicaoLoja.proxima_em).all()
+    return jsonify([r.to_dict() for r in reposicoes])
+@app.route('/api/loja/reposicoes', methods=['POST'])
+def add_reposicao_loja():
+    # {"item_id": 3, "quantidade": 5, "intervalo_minutos": 60, "maximo": 20}; a primeira reposição sai depois de um intervalo
+    data = request.json or {}
+    item = db.session.get(LojaItem, data.get('item_id'))
+    if not item:
+        return jsonify({"erro": "Item da loja não encontrado."}), 404
+    try:
+        quantidade = int(data.get('quantidade')); intervalo = int(data.get('intervalo_minutos'))
+        maximo = int(data['maximo']) if data.get('maximo') is not None else None
+    except (TypeError, ValueError):
+        return jsonify({"erro": "'quantidade' e 'intervalo_minutos' (inteiros) são obrigatórios."}), 400
+    if quantidade < 1 or intervalo < 1 or (maximo is not None and maximo < 1):
+        return jsonify({"erro": "Quantidade, intervalo e máximo devem ser positivos."}), 400
+    try:
+        reposicao = ReposicaoLoja(item=item, quantidade=quantidade, intervalo_minutos=intervalo, maximo=maximo,
+                                  proxima_em=datetime.now() + timedelta(minutes=intervalo))
+        db.session.add(reposicao)
+        limite = f", até {maximo}" if maximo is not None else ""
+        adicionar_informe(f"[LOJA] Reposição automática de '{item.nome}': +{quantidade} a cada {intervalo} min{limite}.")
+        db.session.commit()
+        return jsonify(reposicao.to_dict()), 201
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"erro": str(e)}), 500
+@app.route('/api/loja/reposicoes/<int:id>', methods=['DELETE'])
+def delete_reposicao_loja(id):
+    reposicao = db.session.get(ReposicaoLoja, id)
+    if not reposicao:
+        return jsonify({"erro": "Reposição não encontrada."}), 404
+    db.session.delete(reposicao)
+    db.session.commit()
+    return jsonify({"message": "Reposição removida"}), 200
+
+@app.route('/api/ledger/auditoria', methods=['GET'])
+def get_auditoria_ledger():
+    # Compara o saldo de kaicons de cada aventureiro com a soma do ledger
+    saldos = saldos_pelo_ledger('kaicons')
+    divergencias = []
+    for aventureiro_id, nome, kaicons in db.session.query(Aventureiro.id, Aventureiro.nome_aventureiro, Aventureiro.kaicons).all():
+        esperado = saldos.get(aventureiro_id, 0)
+        if esperado != kaicons:
+            divergencias.append({"aventureiro_id": aventureiro_id, "nome_aventureiro": nome, "kaicons": kaicons, "ledger": esperado})
+    return jsonify({"contas_verificadas": len(saldos), "divergencias": divergencias})
+@app.route('/api/ledger', methods=['GET'])
+def get_ledger():
+    # ?aventureiro=<nome>&recurso=kaicons&before=<id> — paginação por id decrescente
+    consulta = LedgerEntry.query
+    nome = request.args.get('aventureiro')
+    if nome:
+        aventureiro = Aventureiro.query.filter_by(nome_aventureiro=nome).first_or_404()
+        consulta = consulta.filter(LedgerEntry.aventureiro_id == aventureiro.id)
+    if request.args.get('recurso'): consulta = consulta.filter(LedgerEntry.recurso == request.args['recurso'])
+    if request.args.get('before', type=int): consulta = consulta.filter(LedgerEntry.id < request.args.get('before', type=int))
+    entradas = consulta.order_by(LedgerEntry.id.desc()).limit(min(request.args.get('limite', 50, type=int), 200)).all()
+    return jsonify([e.to_dict() for e in entradas])
 
 # --- MÓDULO DE CONTROLE DO HABITAT ---
-# (GET /api/habitat/sistemas, PUT /api/habitat/sistemas/<id>/status - Sem alterações)
+# Simulação: sistemas funcionando se desgastam; a chance de falha por hora cresce com o desgaste; a falha de um
+# sistema deixa INOPERANTE quem depende dele (e, com HABITAT_PROB_CASCATA, danifica esses também). A tarefa de
+# reparo fica ligada ao sistema (tarefa_reparo_id) e concluí-la repara o sistema.
+DEPENDENCIAS_HABITAT_PADRAO = [("Rede de Comunicação", "Sistema Elétrico"), ("Sistema Hidráulico", "Sistema Elétrico"),
+                               ("Rotas de Autônomos", "Rede de Comunicação")]
+class SimuladorHabitat:
+    # Só memória, sem banco: usado pelo tick ao vivo, pelas ações do GM e pelo "flask simular-habitat".
+    # sistemas: {id: {"status", "desgaste", "taxa_desgaste", "prob_falha"}}; dependencias: {id: [ids de que depende]}
+    def __init__(self, sistemas, dependencias, prob_cascata=0.25, rng=None):
+        self.sistemas = sistemas
+        self.ordem = sorted(sistemas)
+        self.dependencias = {id_: [d for d in dependencias.get(id_, ()) if d in sistemas] for id_ in self.ordem}
+        self.dependentes = {id_: [] for id_ in self.ordem}
+        for id_ in self.ordem:
+            for dependencia in self.dependencias[id_]: self.dependentes[dependencia].append(id_)
+        self.prob_cascata = prob_cascata
+        self.rng = rng or random.Random()
+    @staticmethod
+    def risco_por_hora(sistema):
+        # O desgaste multiplica a chance base de falha (até 10x no desgaste máximo)
+        return min(1.0, sistema["prob_falha"] * (1 + 9 * sistema["desgaste"] ** 2))
+    def avancar(self, horas):
+        # Avança o relógio e devolve os eventos [(tipo, id)]: 'falha', 'falha_cascata', 'inoperante', 'restaurado'
+        eventos = []
+        for id_ in self.ordem:
+            sistema = self.sistemas[id_]
+            if sistema["status"] != 'FUNCIONAL': continue
+            sistema["desgaste"] = min(1.0, sistema["desgaste"] + sistema["taxa_desgaste"] * horas)
+            if self.rng.random() < 1 - (1 - self.risco_por_hora(sistema)) ** horas:
+                eventos += self.danificar(id_)
+        return eventos
+    def danificar(self, id_, evento='falha', cascata=True):
+        sistema = self.sistemas[id_]
+        if sistema["status"] == 'DANIFICADO': return []
+        sistema["status"] = 'DANIFICADO'
+        eventos = [(evento, id_)]
+        if cascata:
+            for dependente in self.dependentes[id_]:
+                if self.sistemas[dependente]["status"] == 'FUNCIONAL' and self.rng.random() < self.prob_cascata:
+                    eventos += self.danificar(dependente, 'falha_cascata')
+        return eventos + self.propagar()
+    def reparar(self, id_):
+        sistema = self.sistemas[id_]
+        if sistema["status"] != 'DANIFICADO': return []
+        sistema["desgaste"] = 0.0
+        sistema["status"] = 'FUNCIONAL' if self.dependencias_ok(id_) else 'INOPERANTE'
+        return [('reparado', id_)] + self.propagar()
+    def dependencias_ok(self, id_):
+        return all(self.sistemas[d]["status"] == 'FUNCIONAL' for d in self.dependencias[id_])
+    def propagar(self):
+        # Quem não tem falha própria fica INOPERANTE enquanto algo de que depende (direta ou indiretamente) estiver parado
+        eventos = []
+        for _ in range(len(self.ordem) + 1):
+            mudou = False
+            for id_ in self.ordem:
+                sistema = self.sistemas[id_]
+                if sistema["status"] == 'DANIFICADO': continue
+                novo = 'FUNCIONAL' if self.dependencias_ok(id_) else 'INOPERANTE'
+                if novo != sistema["status"]:
+                    sistema["status"] = novo; mudou = True
+                    eventos.append(('restaurado' if novo == 'FUNCIONAL' else 'inoperante', id_))
+            if not mudou: break
+        return eventos
+    def temporada(self, dias, passo_horas, horas_reparo):
+        # Modo sem banco para calibrar taxas: cada sistema danificado é reparado horas_reparo depois da falha
+        estatisticas = {id_: {"falhas": 0, "falhas_cascata": 0, "horas_parado": 0.0} for id_ in self.ordem}
+        reparo_em = {}
+        relogio = 0.0; fim = dias * 24
+        while relogio < fim:
+            passo = min(passo_horas, fim - relogio)
+            for evento, id_ in self.avancar(passo):
+                if evento in ('falha', 'falha_cascata'):
+                    estatisticas[id_]["falhas" if evento == 'falha' else "falhas_cascata"] += 1
+                    reparo_em[id_] = relogio + passo + horas_reparo
+            relogio += passo
+            for id_ in self.ordem:
+                if self.sistemas[id_]["status"] != 'FUNCIONAL': estatisticas[id_]["horas_parado"] += passo
+            for id_, momento in sorted(reparo_em.items()):
+                if momento <= relogio:
+                    del reparo_em[id_]
+                    self.reparar(id_)
+        return estatisticas
+def montar_simulador_habitat(rng=None, zerado=False):
+    # zerado=True: começa a temporada com tudo FUNCIONAL e sem desgaste (modo sem banco)
+    sistemas = {s.id: {"status": 'FUNCIONAL' if zerado else s.status, "desgaste": 0.0 if zerado else (s.desgaste or 0.0),
+                       "taxa_desgaste": s.taxa_desgaste or 0.0, "prob_falha": s.prob_falha or 0.0}
+                for s in HabitatSistema.query}
+    dependencias = {}
+    for sistema_id, depende_de_id in db.session.query(HabitatDependencia.sistema_id, HabitatDependencia.depende_de_id):
+        dependencias.setdefault(sistema_id, []).append(depende_de_id)
+    return SimuladorHabitat(sistemas, dependencias, app.config["HABITAT_PROB_CASCATA"], rng)
+def abrir_tarefa_reparo(sistema):
+    # Reaproveita a tarefa ligada ao sistema enquanto ela não tiver sido concluída
+    tarefa = db.session.get(Tarefa, sistema.tarefa_reparo_id) if sistema.tarefa_reparo_id else None
+    if tarefa and tarefa.status != 'CONCLUIDA': return tarefa
+    tarefa = Tarefa(texto=f"Reparar o {sistema.nome} ({sistema.setor})", xp_reward=100, kc_reward=50, status='ATIVA')
+    db.session.add(tarefa); db.session.flush()
+    sistema.tarefa_reparo_id = tarefa.id
+    adicionar_informe(f"Nova Tarefa (Quest) gerada por falha no sistema: {tarefa.texto}")
+    return tarefa
+def aplicar_simulacao_habitat(simulador, eventos):
+    # Grava status/desgaste do simulador e gera os efeitos de cada evento (alerta, tarefa, informe, evento SSE)
+    sistemas = {s.id: s for s in HabitatSistema.query}
+    for id_, estado in simulador.sistemas.items():
+        sistema = sistemas.get(id_)
+        if not sistema: continue
+        sistema.status = estado["status"]
+        sistema.desgaste = round(estado["desgaste"], 6)
+    for evento, id_ in eventos:
+        sistema = sistemas.get(id_)
+        if not sistema: continue
+        local = f"{sistema.nome} ({sistema.setor})"
+        if evento in ('falha', 'falha_cascata'):
+            causa = " Efeito cascata de outra falha." if evento == 'falha_cascata' else ""
+            adicionar_alerta_global(f"ALERTA: Falha crítica detectada no {local}!{causa}")
+            abrir_tarefa_reparo(sistema)
+        elif evento == 'inoperante':
+            adicionar_informe(f"[SISTEMA] O {local} está INOPERANTE: depende de um sistema danificado.")
+        elif evento == 'reparado' and sistema.status != 'FUNCIONAL':
+            adicionar_informe(f"[SISTEMA] O {local} foi reparado, mas segue INOPERANTE até as suas dependências voltarem.")
+        elif evento in ('reparado', 'restaurado'):
+            adicionar_informe(f"[SISTEMA] O {local} foi reparado e está FUNCIONAL." if evento == 'reparado'
+                              else f"[SISTEMA] O {local} voltou a funcionar.")
+    for id_ in sorted({id_ for _, id_ in eventos if id_ in sistemas}):
+        publicar_evento('habitat', sistemas[id_].to_dict())
+def reparar_sistemas_da_tarefa(*tarefa_ids):
+    # Concluir a tarefa de reparo repara o sistema ligado a ela
+    if not tarefa_ids: return
+    danificados = db.session.query(HabitatSistema.id).filter(
+        HabitatSistema.tarefa_reparo_id.in_(tarefa_ids), HabitatSistema.status == 'DANIFICADO').all()
+    if not danificados: return
+    simulador = montar_simulador_habitat()
+    eventos = []
+    for (id_,) in danificados: eventos += simulador.reparar(id_)
+    aplicar_simulacao_habitat(simulador, eventos)
+def encerrar_tarefa_reparo(sistema):
+    # Reparo manual do GM: a quest de reparo é encerrada sem recompensa (os pedidos na fila são cancelados)
+    tarefa = db.session.get(Tarefa, sistema.tarefa_reparo_id) if sistema.tarefa_reparo_id else None
+    sistema.tarefa_reparo_id = None
+    if tarefa is None or tarefa.status not in TAREFA_ABERTA: return
+    texto = tarefa.texto
+    encerrar_tarefas(tarefa.id)
+    adicionar_informe(f"[SISTEMA] Tarefa '{texto}' encerrada: o GM reparou o {sistema.nome} manualmente.")
+def avancar_habitat(agora):
+    with transacao_imediata():
+        relogio = db.session.get(HabitatRelogio, 1)
+        if relogio is None:
+            db.session.add(HabitatRelogio(id=1, simulado_ate=agora)); return
+        anterior = relogio.simulado_ate
+        if agora <= anterior: return
+        # Reivindica o trecho [anterior, agora]; outro worker que leu o mesmo "anterior" não atualiza nada
+        tomado = db.session.execute(db.update(HabitatRelogio).where(
+            HabitatRelogio.id == 1, HabitatRelogio.simulado_ate == anterior).values(simulado_ate=agora)).rowcount
+        if tomado != 1: return
+        # Depois de uma pausa longa (servidor parado) não simula dias de uma vez
+        decorrido = min(agora - anterior, timedelta(minutes=10))
+        simulador = montar_simulador_habitat()
+        horas = decorrido.total_seconds() / 3600 * app.config["HABITAT_ACELERACAO"]
+        aplicar_simulacao_habitat(simulador, simulador.avancar(horas))
+def loop_simulacao_habitat():
+    intervalo = app.config["HABITAT_TICK_INTERVALO"]
+    with app.app_context():
+        while True:
+            try:
+                avancar_habitat(datetime.now())
+            except Exception as e:
+                print(f"Erro na simulação do Habitat: {e}")
+                db.session.rollback()
+            finally:
+                db.session.remove()
+            time.sleep(intervalo)
+HABITAT_INICIADO = threading.Event()
+@app.before_request
+def iniciar_simulacao_habitat():
+    if HABITAT_INICIADO.is_set() or not app.config["HABITAT_SIMULACAO"]: return
+    with EVENTOS_HUB.condicao:
+        if HABITAT_INICIADO.is_set(): return
+        HABITAT_INICIADO.set()
+    threading.Thread(target=loop_simulacao_habitat, name='simulacao-habitat', daemon=True).start()
+def migrar_habitat():
+    # Parâmetros de simulação nas linhas antigas; na primeira vez (sem relógio) cria as dependências padrão
+    for sistema in HabitatSistema.query:
+        if sistema.desgaste is None: sistema.desgaste = 0.0
+        if sistema.taxa_desgaste is None: sistema.taxa_desgaste = 0.002
+        if sistema.prob_falha is None: sistema.prob_falha = 0.001
+    if db.session.get(HabitatRelogio, 1) is None:
+        por_nome = {nome: id_ for id_, nome in db.session.query(HabitatSistema.id, HabitatSistema.nome)}
+        for sistema, depende_de in DEPENDENCIAS_HABITAT_PADRAO:
+            if sistema in por_nome and depende_de in por_nome:
+                db.session.add(HabitatDependencia(sistema_id=por_nome[sistema], depende_de_id=por_nome[depende_de]))
+        db.session.add(HabitatRelogio(id=1, simulado_ate=datetime.now()))
+    db.session.commit()
+@app.cli.command('simular-habitat')
+@click.option('--dias', default=90, show_default=True, help="Duração da temporada simulada.")
+@click.option('--passo-minutos', default=10.0, show_default=True, help="Tamanho do tick.")
+@click.option('--reparo-horas', default=12.0, show_default=True, help="Tempo até um sistema danificado ser reparado.")
+@click.option('--execucoes', default=20, show_default=True, help="Temporadas simuladas (a média é reportada).")
+@click.option('--fator-desgaste', default=1.0, show_default=True, help="Multiplica a taxa de desgaste de todos os sistemas.")
+@click.option('--fator-falha', default=1.0, show_default=True, help="Multiplica a chance de falha de todos os sistemas.")
+@click.option('--semente', default=None, type=int, help="Semente aleatória (resultados reproduzíveis).")
+def comando_simular_habitat(dias, passo_minutos, reparo_horas, execucoes, fator_desgaste, fator_falha, semente):
+    # Roda temporadas inteiras só em memória com os parâmetros do banco, sem alterar nada (calibragem pelo GM)
+    rng = random.Random(semente)
+    nomes = dict(db.session.query(HabitatSistema.id, HabitatSistema.nome))
+    totais = {id_: {"falhas": 0, "falhas_cascata": 0, "horas_parado": 0.0} for id_ in nomes}
+    inicio = time.perf_counter()
+    for _ in range(execucoes):
+        simulador = montar_simulador_habitat(rng, zerado=True)
+        for estado in simulador.sistemas.values():
+            estado["taxa_desgaste"] *= fator_desgaste; estado["prob_falha"] *= fator_falha
+        for id_, estatisticas in simulador.temporada(dias, passo_minutos / 60, reparo_horas).items():
+            for chave, valor in estatisticas.items(): totais[id_][chave] += valor
+    duracao = time.perf_counter() - inicio
+    print(f"{execucoes} temporada(s) de {dias} dias, tick de {passo_minutos:g} min, reparo em {reparo_horas:g} h ({duracao:.2f}s)")
+    print(f"{'sistema':28} {'falhas':>8} {'cascata':>8} {'disponível':>11}")
+    for id_, total in sorted(totais.items()):
+        disponivel = 100 * (1 - total["horas_parado"] / (execucoes * dias * 24))
+        print(f"{nomes[id_][:28]:28} {total['falhas'] / execucoes:8.1f} {total['falhas_cascata'] / execucoes:8.1f} {disponivel:10.1f}%")
+
 @app.route('/api/habitat/sistemas', methods=['GET'])
+@condicional('habitat_sistema', 'habitat_dependencia')
 def get_habitat_sistemas():
     sistemas = HabitatSistema.query.order_by(HabitatSistema.id).all()
     return jsonify([s.to_dict() for s in sistemas])
 @app.route('/api/habitat/sistemas/<int:id>/status', methods=['PUT'])
 def set_habitat_sistema_status(id):
-    sistema = HabitatSistema.query.get(id)
+    # GM alterna FUNCIONAL <-> DANIFICADO. A falha manual não rola cascata, mas os dependentes ficam INOPERANTES.
+    sistema = db.session.get(HabitatSistema, id)
     if not sistema:
         return jsonify({"erro": "Sistema do Habitat não encontrado."}), 404
+    if sistema.status == 'INOPERANTE':
+        return jsonify({"erro": f"O {sistema.nome} está INOPERANTE porque depende de um sistema danificado. Repare-o primeiro."}), 409
     try:
-        if sistema.status == 'FUNCIONAL':
-            sistema.status = 'DANIFICADO'
-            alerta_texto = f"ALERTA: Falha crítica detectada no {sistema.nome} ({sistema.setor})!"
-            adicionar_alerta_global(alerta_texto)
-            tarefa_texto = f"Reparar o {sistema.nome} ({sistema.setor})"
-            tarefa_existente = Tarefa.query.filter_by(texto=tarefa_texto).first()
-            if not tarefa_existente:
-                nova_tarefa = Tarefa(texto=tarefa_texto, xp_reward=100, kc_reward=50, status='ATIVA')
-                db.session.add(nova_tarefa)
-                adicionar_informe(f"Nova Tarefa (Quest) gerada por falha no sistema: {tarefa_texto}")
+        simulador = montar_simulador_habitat()
+        reparando = sistema.status != 'FUNCIONAL'
+        if reparando:
+            eventos = simulador.reparar(id)
         else:
-            sistema.status = 'FUNCIONAL'
-            adicionar_informe(f"[SISTEMA] O {sistema.nome} ({sistema.setor}) foi reparado e está FUNCIONAL.")
+            eventos = simulador.danificar(id, cascata=False)
+        aplicar_simulacao_habitat(simulador, eventos)
+        if reparando: encerrar_tarefa_reparo(sistema)
+        db.session.commit()
+        return jsonify(sistema.to_dict()), 200
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"erro": str(e)}), 500
+@app.route('/api/habitat/sistemas/<int:id>/config', methods=['PUT'])
+def set_habitat_sistema_config(id):
+    # {"taxa_desgaste": 0.002, "prob_falha": 0.001, "depende_de": [1, 2]} (todos opcionais)
+    sistema = db.session.get(HabitatSistema, id)
+    if not sistema:
+        return jsonify({"erro": "Sistema do Habitat não encontrado."}), 404
+    data = request.json or {}
+    for campo in ('taxa_desgaste', 'prob_falha'):
+        if campo not in data: continue
+        valor = data[campo]
+        if isinstance(valor, bool) or not isinstance(valor, (int, float)) or not 0 <= valor <= 1:
+            return jsonify({"erro": f"'{campo}' deve ser um número entre 0 e 1."}), 400
+        setattr(sistema, campo, float(valor))
+    if 'depende_de' in data:
+        ids = data['depende_de']
+        if not isinstance(ids, list) or not all(isinstance(d, int) and not isinstance(d, bool) for d in ids):
+            return jsonify({"erro": "'depende_de' deve ser uma lista de ids."}), 400
+        ids = set(ids)
+        grafo = {}
+        for sistema_id, depende_de_id in db.session.query(HabitatDependencia.sistema_id, HabitatDependencia.depende_de_id):
+            if sistema_id != id: grafo.setdefault(sistema_id, set()).add(depende_de_id)
+        existentes = {i for (i,) in db.session.query(HabitatSistema.id).filter(HabitatSistema.id.in_(ids))} if ids else set()
+        if ids - existentes:
+            return jsonify({"erro": f"Sistemas não encontrados: {sorted(ids - existentes)}"}), 404
+        # Recusa ciclos: nenhum dos novos pré-requisitos pode depender (mesmo indiretamente) deste sistema
+        visitar = list(ids); vistos = set()
+        while visitar:
+            atual = visitar.pop()
+            if atual == id:
+                return jsonify({"erro": "Dependência circular entre sistemas."}), 400
+            if atual in vistos: continue
+            vistos.add(atual); visitar.extend(grafo.get(atual, ()))
+        HabitatDependencia.query.filter_by(sistema_id=id).delete()
+        marcar_alterado('habitat_dependencia')
+        db.session.add_all([HabitatDependencia(sistema_id=id, depende_de_id=d) for d in sorted(ids)])
+        db.session.flush()
+        db.session.expire(sistema, ['dependencias'])
+    try:
+        simulador = montar_simulador_habitat()
+        aplicar_simulacao_habitat(simulador, simulador.propagar())
         db.session.commit()
         return jsonify(sistema.to_dict()), 200
     except Exception as e:
@@ -818,6 +3378,7 @@ def set_habitat_sistema_status(id):
 # --- ROTAS DE GERENCIAMENTO DE NPCs E MAPA DE RASTREAMENTO ---
 # (GET /api/npcs, POST /api/npcs, DELETE /api/npcs/<id>, PUT /api/npcs/<id>/localizacao, GET /api/mapa/localizacoes - Sem alterações)
 @app.route('/api/npcs', methods=['GET'])
+@condicional('npc')
 def get_npcs():
     npcs = NPC.query.order_by(NPC.nome).all()
     return jsonify([npc.to_dict() for npc in npcs])
@@ -831,8 +3392,10 @@ def add_npc():
         if NPC.query.filter_by(nome=nome).first():
             return jsonify({"erro": "Um NPC com este nome já existe."}), 400
         novo_npc = NPC(nome=nome, descricao=desc, localizacao_atual=local)
-        db.session.add(novo_npc); db.session.commit()
+        db.session.add(novo_npc)
+        registrar_movimento('npc', novo_npc, obter_setor(local, criar=True))
         adicionar_informe(f"[SISTEMA] NPC '{nome}' foi adicionado ao Habitat.")
+        db.session.commit()
         return jsonify(novo_npc.to_dict()), 201
     except Exception as e:
         db.session.rollback()
@@ -842,8 +3405,10 @@ def delete_npc(id):
     npc = NPC.query.get(id)
     if npc:
         nome_npc = npc.nome
-        db.session.delete(npc); db.session.commit()
+        registrar_movimento('npc', npc, None)
+        db.session.delete(npc)
         adicionar_informe(f"[SISTEMA] NPC '{nome_npc}' foi removido do Habitat.")
+        db.session.commit()
         return jsonify({"message": "NPC removido"}), 200
     return jsonify({"erro": "NPC não encontrado"}), 404
 @app.route('/api/npcs/<int:id>/localizacao', methods=['PUT'])
@@ -855,27 +3420,60 @@ def move_npc(id):
     if not local:
         return jsonify({"erro": "Localização não fornecida."}), 400
     try:
-        npc.localizacao_atual = local
+        registrar_movimento('npc', npc, obter_setor(local, criar=True))
         db.session.commit()
         return jsonify(npc.to_dict()), 200
     except Exception as e:
         db.session.rollback()
         return jsonify({"erro": str(e)}), 500
 @app.route('/api/mapa/localizacoes', methods=['GET'])
+@condicional('movimento_historico', 'setor')
 def get_mapa_localizacoes():
+    # Montada a partir do índice de ocupantes (sem ler as tabelas de jogadores e NPCs)
     try:
-        aventureiros = Aventureiro.query.all()
-        loc_jogadores = [{"nome": a.nome_aventureiro, "local": a.localizacao_atual, "tipo": "jogador"} for a in aventureiros]
-        npcs = NPC.query.all()
-        loc_npcs = [{"nome": n.nome, "local": n.localizacao_atual, "tipo": "npc"} for n in npcs]
-        return jsonify(loc_jogadores + loc_npcs)
+        nomes_setores = dict(db.session.query(Setor.id, Setor.nome))
+        ocupantes = sorted(INDICE_OCUPANTES.todos(), key=lambda o: (o[0] != 'jogador', o[1]))
+        return jsonify([{"nome": nome, "local": nomes_setores.get(setor_id), "tipo": tipo} for tipo, _, setor_id, nome in ocupantes])
     except Exception as e:
         return jsonify({"erro": str(e)}), 500
+@app.route('/api/mapa/setores', methods=['GET'])
+@condicional('movimento_historico', 'setor')
+def get_setores():
+    contagem = {}
+    for _, _, setor_id, _ in INDICE_OCUPANTES.todos():
+        contagem[setor_id] = contagem.get(setor_id, 0) + 1
+    return jsonify([dict(s.to_dict(), ocupantes=contagem.get(s.id, 0)) for s in Setor.query.order_by(Setor.id)])
+@app.route('/api/mapa/setor/<int:id>', methods=['GET'])
+@condicional('movimento_historico', 'setor')
+def get_ocupantes_setor(id):
+    setor = db.session.get(Setor, id)
+    if not setor:
+        return jsonify({"erro": "Setor não encontrado."}), 404
+    return jsonify(dict(setor.to_dict(), ocupantes=INDICE_OCUPANTES.no_setor(id)))
+@app.route('/api/mapa/historico', methods=['GET'])
+@condicional('movimento_historico')
+def get_historico_movimentos():
+    # Replay para o GM: ?tipo=npc&id=3 (uma entidade, pelo índice (tipo, entidade, tempo)) ou todos;
+    # &desde=2024-05-01T10:00 &limite=200. Ordem cronológica.
+    consulta = MovimentoHistorico.query
+    tipo = request.args.get('tipo'); entidade_id = request.args.get('id', type=int)
+    if (tipo is None) != (entidade_id is None):
+        return jsonify({"erro": "Informe 'tipo' e 'id' juntos."}), 400
+    if tipo:
+        consulta = consulta.filter(MovimentoHistorico.tipo == tipo, MovimentoHistorico.entidade_id == entidade_id)
+    if request.args.get('desde'):
+        try: desde = datetime.fromisoformat(request.args['desde'])
+        except ValueError: return jsonify({"erro": "'desde' inválido. Use AAAA-MM-DDTHH:MM."}), 400
+        consulta = consulta.filter(MovimentoHistorico.timestamp >= desde)
+    limite = min(max(request.args.get('limite', 200, type=int), 1), 1000)
+    movimentos = consulta.order_by(MovimentoHistorico.timestamp, MovimentoHistorico.id).limit(limite).all()
+    return jsonify([m.to_dict() for m in movimentos])
 
 # --- ROTAS DE GERENCIAMENTO DE PRODUÇÃO (GM) ---
 # (GET /api/receitas, POST /api/receitas, DELETE /api/receitas/<id> - Sem alterações)
 @app.route('/api/receitas', methods=['GET'])
 @jwt_required()
+@condicional('receita')
 def get_receitas():
     receitas = Receita.query.order_by(Receita.nome_item_final).all()
     return jsonify([r.to_dict() for r in receitas])
@@ -890,8 +3488,8 @@ def add_receita():
         if not nome_item_final or not ingredientes_json:
             return jsonify({"erro": "Nome do item e ingredientes (JSON) são obrigatórios."}), 400
         try:
-            json.loads(ingredientes_json)
-        except json.JSONDecodeError:
+            ler_ingredientes(ingredientes_json)
+        except (ValueError, TypeError):
             return jsonify({"erro": "Formato de Ingredientes JSON inválido. Use {'item1': 1, 'item2': 2}"}), 400
             
         nova_receita = Receita(
@@ -900,9 +3498,8 @@ def add_receita():
             ingredientes_json=ingredientes_json
         )
         db.session.add(nova_receita)
-        db.session.commit()
-        
         adicionar_informe(f"[OFICINA] Nova receita criada: {nova_receita.nome_item_final}")
+        db.session.commit()
         return jsonify(nova_receita.to_dict()), 201
     except Exception as e:
         db.session.rollback()
@@ -913,11 +3510,77 @@ def delete_receita(id):
     if receita:
         nome_receita = receita.nome_item_final
         db.session.delete(receita)
-        db.session.commit()
         adicionar_informe(f"[OFICINA] Receita removida: {nome_receita}.")
+        db.session.commit()
         return jsonify({"message": "Receita removida"}), 200
     return jsonify({"erro": "Receita não encontrada"}), 404
 
+# --- PLANOS DE CONSULTA ---
+# Consultas que rodam a cada poll. verificar_planos_de_consulta() roda EXPLAIN QUERY PLAN em cada uma e
+# acusa "SCAN <tabela>" sem índice; rode "flask --app app verificar-planos" antes de publicar mudanças no banco.
+CONSULTAS_MONITORADAS = {
+    "aventureiro por nome": lambda: Aventureiro.query.filter_by(nome_aventureiro='x'),
+    "tarefas do jogador": lambda: Tarefa.query.filter(Tarefa.status.in_(['ATIVA', 'PENDENTE'])),
+    "tarefas pendentes (GM)": lambda: Tarefa.query.filter_by(status='PENDENTE'),
+    "fila de aprovação": lambda: TarefaClaim.query.filter_by(estado='PENDENTE').order_by(TarefaClaim.criado_em, TarefaClaim.id),
+    "pedidos do jogador": lambda: TarefaClaim.query.filter_by(aventureiro_id=1),
+    "ranking de XP": lambda: Aventureiro.query.order_by(Aventureiro.nivel.desc(), Aventureiro.xp.desc()).limit(10),
+    "ranking de KÇ": lambda: Aventureiro.query.order_by(Aventureiro.kaicons.desc()).limit(10),
+    "ranking de produção": lambda: EstatisticaJogador.query.order_by(EstatisticaJogador.itens_produzidos.desc()).limit(10),
+    "log de vendas da loja": lambda: LojaVenda.query.order_by(LojaVenda.timestamp.desc(), LojaVenda.id.desc()).limit(50),
+    "vendas de um item": lambda: LojaVenda.query.filter(LojaVenda.loja_item_id == 1).order_by(LojaVenda.timestamp.desc(), LojaVenda.id.desc()).limit(100),
+    "reposições vencidas": lambda: ReposicaoLoja.query.filter(ReposicaoLoja.proxima_em <= datetime(2000, 1, 1)),
+    "vendas por item": lambda: EstatisticaItemLoja.query.order_by(EstatisticaItemLoja.quantidade.desc()).limit(20),
+    "eventos do minuto": lambda: Cronograma.query.filter_by(hora=7, minuto=0),
+    "informes recentes": lambda: RegistroInformes.query.order_by(RegistroInformes.timestamp.desc()).limit(20),
+    "informes por categoria": lambda: RegistroInformes.query.filter(RegistroInformes.categoria == 'LOJA').order_by(RegistroInformes.timestamp.desc()).limit(50),
+    "informes por ator": lambda: RegistroInformes.query.filter(RegistroInformes.ator == 'x').order_by(RegistroInformes.timestamp.desc()),
+    "chat recente": lambda: ChatMensagem.query.order_by(ChatMensagem.timestamp.desc()).limit(50),
+    "chat desde id": lambda: ChatMensagem.query.filter(ChatMensagem.id > 1).order_by(ChatMensagem.id).limit(50),
+    "esboços recentes": lambda: EsbocoMapa.query.order_by(EsbocoMapa.timestamp.desc()).limit(20),
+    "inventário do aventureiro": lambda: InventarioItem.query.filter_by(aventureiro_id=1),
+    "donos de um item": lambda: InventarioItem.query.filter_by(item_norm='x'),
+    "ledger do aventureiro": lambda: LedgerEntry.query.filter_by(aventureiro_id=1, recurso='kaicons').order_by(LedgerEntry.id.desc()),
+    "fila de eventos": lambda: EventoStream.query.filter(EventoStream.id > 1).order_by(EventoStream.id),
+    "movimentos de uma entidade": lambda: MovimentoHistorico.query.filter_by(tipo='npc', entidade_id=1).order_by(MovimentoHistorico.timestamp),
+    "movimentos novos": lambda: MovimentoHistorico.query.filter(MovimentoHistorico.id > 1).order_by(MovimentoHistorico.id),
+}
+def verificar_planos_de_consulta():
+    if db.engine.dialect.name != 'sqlite':
+        print("[PLANOS] Verificação disponível só no SQLite; ignorada.")
+        return []
+    problemas = []
+    with db.engine.connect() as conexao:
+        for nome, fabrica in CONSULTAS_MONITORADAS.items():
+            compilada = fabrica().statement.compile(dialect=db.engine.dialect, compile_kwargs={"render_postcompile": True})
+            parametros = compilada.construct_params()
+            valores = tuple(parametros[chave] for chave in compilada.positiontup)
+            try:
+                plano = [linha[-1] for linha in conexao.exec_driver_sql("EXPLAIN QUERY PLAN " + str(compilada), valores)]
+            except Exception as e:
+                problemas.append((nome, [str(e)]))
+                print(f"[PLANOS] ERRO ao analisar '{nome}': {e}")
+                continue
+            varreduras = [p for p in plano if p.startswith('SCAN') and 'INDEX' not in p]
+            if varreduras:
+                problemas.append((nome, varreduras))
+                print(f"[PLANOS] ALERTA: '{nome}' faz varredura completa: {'; '.join(varreduras)}")
+            else:
+                print(f"[PLANOS] ok: '{nome}': {'; '.join(plano)}")
+    return problemas
+@app.cli.command('podar-backups')
+def comando_podar_backups():
+    # Varredura completa do armazém de backups (as requisições só podam o backup que substituíram). Bom para um cron diário.
+    apagados = podar_backups_orfaos()
+    db.session.commit()
+    print(f"Blocos de backup órfãos removidos: {apagados}")
+
+@app.cli.command('verificar-planos')
+def comando_verificar_planos():
+    # Sai com código 1 se alguma consulta monitorada fizer varredura completa (útil no CI/deploy)
+    if verificar_planos_de_consulta():
+        raise SystemExit(1)
+
 # --- FUNÇÃO DE INICIALIZAÇÃO DO BANCO DE DADOS ---
 def create_initial_data():
     if Tarefa.query.first() is None:
@@ -950,12 +3613,15 @@ def create_initial_data():
         )
     if LojaItem.query.first() is None:
         print("Abastecendo a loja da Guilda...")
-        db.session.add_all([
+        itens_iniciais = [
             LojaItem(nome="Ração de Viagem", descricao="Uma barra de nutrientes compactada.", preco=10, estoque=100),
             LojaItem(nome="Kit Médico Básico", descricao="Contém ataduras e antisséptico.", preco=50, estoque=20),
             LojaItem(nome="tecido", descricao="Retalho de tecido limpo.", preco=5, estoque=100),
             LojaItem(nome="antisseptico", descricao="Frasco de líquido esterilizante.", preco=30, estoque=100)
-        ])
+        ]
+        db.session.add_all(itens_iniciais); db.session.flush()
+        for item in itens_iniciais: # Mesma entrada de abertura do item criado pelo GM
+            registrar_ledger('estoque', item.estoque, 'estoque inicial', loja_item_id=item.id)
     if HabitatSistema.query.first() is None:
         print("Registrando sistemas do Habitat...")
         db.session.add_all([
@@ -986,16 +3652,61 @@ def create_initial_data():
         
     db.session.commit()
 
+def adicionar_colunas_faltantes():
+    # create_all() também não altera tabelas existentes: acrescenta as colunas novas (só colunas anuláveis)
+    inspetor = db.inspect(db.engine)
+    tabelas_existentes = set(inspetor.get_table_names())
+    with db.engine.begin() as conexao:
+        for tabela in db.metadata.sorted_tables:
+            if tabela.name not in tabelas_existentes: continue
+            existentes = {c['name'] for c in inspetor.get_columns(tabela.name)}
+            for coluna in tabela.columns:
+                if coluna.name in existentes: continue
+                tipo = coluna.type.compile(dialect=db.engine.dialect)
+                print(f"Migração: adicionando coluna {tabela.name}.{coluna.name}")
+                conexao.exec_driver_sql(f'ALTER TABLE {tabela.name} ADD COLUMN {coluna.name} {tipo}')
+def criar_indices_faltantes():
+    # create_all() não cria índices novos em tabelas que já existem: cria um a um (idempotente)
+    for tabela in db.metadata.sorted_tables:
+        for indice in tabela.indexes:
+            indice.create(db.engine, checkfirst=True)
+def inicializar_banco():
+    # db.drop_all() # CUIDADO: Descomente para resetar o DB
+    db.create_all()
+    adicionar_colunas_faltantes()
+    criar_indices_faltantes()
+    garantir_versoes_tabelas()
+    abrir_ledger_existente()
+    migrar_inventarios()
+    migrar_backups()
+    classificar_informes_antigos()
+    create_initial_data()
+    migrar_setores() # Depois dos dados iniciais: liga também os NPCs recém-criados
+    migrar_habitat()
+    migrar_estatisticas()
+    migrar_vendas_loja()
+    if app.config["VERIFICAR_PLANOS"]:
+        verificar_planos_de_consulta()
+
+@app.cli.command('inicializar-banco')
+def comando_inicializar_banco():
+    # Tabelas, migrações e preenchimentos (idempotente). Sai com erro se alguma etapa falhar.
+    if not app.config["INICIALIZAR_BANCO"]: # Com INICIALIZAR_BANCO=1 o import do app já rodou tudo
+        inicializar_banco()
+    print("Banco de dados inicializado.")
+
+# Falha aqui não é engolida: um processo com o banco migrado pela metade não deve subir
+if app.config["INICIALIZAR_BANCO"]:
+    with app.app_context():
+        inicializar_banco()
+
 # --- Executa o Servidor ---
 if __name__ == '__main__':
     if not os.path.exists('templates'): os.makedirs('templates')
     if not os.path.exists('static'): os.makedirs('static')
-    with app.app_context():
-        # db.drop_all() # CUIDADO: Descomente para resetar o DB (necessário desta vez)
-        db.create_all()
-        create_initial_data()
     print("Servidor do Mestre Kaibora iniciado.")
-    print(f"Banco de dados está em: {os.path.join(base_dir, 'kaibora.db')}")
+    with app.app_context():
+        print(f"Banco de dados está em: {db.engine.url.render_as_string(hide_password=True)}")
     print("Acesse o painel do GM em: http://127.0.0.1:5000/gm")
     app.run(debug=True, port=5000)
 
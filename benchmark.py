@@ -0,0 +1,117 @@
+# Benchmark de serialização e compressão das rotas de listagem.
+# Monta uma campanha sintética grande num SQLite temporário e, para cada rota, mede:
+#   - tempo de serialização do JSON com o provedor padrão do Flask e com o ProvedorJSON (orjson, se instalado)
+#   - tempo total da requisição (cliente de teste, sem rede)
+#   - tamanho da resposta sem compressão, em gzip e em brotli (se instalado)
+# Uso: python benchmark.py [--jogadores 300] [--repeticoes 20] [--saida bench_output.txt]
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROTAS = [
+    '/api/jogadores',
+    '/api/jogadores?view=roster',
+    '/api/chat',
+    '/api/informes?limite=100',
+    '/api/mapa/localizacoes',
+    '/api/aventureiro/status',
+    '/api/loja-itens',
+    '/api/sync',
+]
+
+def montar_campanha(m, jogadores, rng):
+    db = m.db
+    itens = [f"item {i}" for i in range(60)]
+    db.session.execute(db.insert(m.Aventureiro), [{
+        "username": f"user{i}", "password_hash": "x", "nome_aventureiro": f"Aventureiro {i:04d}",
+        "nome_jogador": f"Jogador {i}", "classe_origem": rng.choice(["Batedor", "Engenheira", "Médico", "Cozinheira"]),
+        "motivacao": "Sobreviver ao Habitat e descobrir o que há além do Setor 9. " * 4,
+        "xp": rng.randint(0, 900), "kaicons": rng.randint(0, 500), "nivel": rng.randint(1, 12),
+        "habilidades": "Reparos, Navegação, Cozinha", "backup_arquivos": '{}', "inventario": '{}',
+        "localizacao_atual": f"Setor {rng.randint(1, 9)}",
+    } for i in range(jogadores)])
+    ids = [i for (i,) in db.session.query(m.Aventureiro.id)]
+    db.session.execute(db.insert(m.InventarioItem), [
+        {"aventureiro_id": a, "item_norm": item, "quantidade": rng.randint(1, 20)}
+        for a in ids for item in rng.sample(itens, 8)
+    ])
+    agora = datetime.now()
+    db.session.execute(db.insert(m.RegistroInformes), [{
+        "timestamp": agora - timedelta(minutes=i), "texto": f"[LOJA] Aventureiro {i % jogadores:04d} comprou 'Ração de Viagem' por 10 KÇ.",
+        "categoria": "LOJA", "ator": f"Aventureiro {i % jogadores:04d}",
+    } for i in range(jogadores * 10)])
+    db.session.execute(db.insert(m.ChatMensagem), [{
+        "timestamp": agora - timedelta(seconds=i), "nome_autor": f"Aventureiro {i % jogadores:04d}",
+        "texto": "Alguém viu o reator do Setor 3? Está fazendo um barulho estranho de novo, acho que precisamos de ajuda.",
+    } for i in range(500)])
+    db.session.execute(db.insert(m.NPC), [
+        {"nome": f"NPC {i}", "localizacao_atual": f"Setor {rng.randint(1, 9)}"} for i in range(80)
+    ])
+    m.marcar_alterado(*[t.name for t in db.metadata.sorted_tables])
+    db.session.commit()
+    m.migrar_setores() # Os inserts em massa não passam por registrar_movimento
+
+def medir(funcao, repeticoes):
+    inicio = time.perf_counter()
+    for _ in range(repeticoes): funcao()
+    return (time.perf_counter() - inicio) / repeticoes * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de serialização e compressão das rotas de listagem")
+    parser.add_argument('--jogadores', type=int, default=300)
+    parser.add_argument('--repeticoes', type=int, default=20)
+    parser.add_argument('--saida', help="Também grava o relatório neste arquivo (ex.: bench_output.txt)")
+    args = parser.parse_args()
+
+    pasta = tempfile.mkdtemp(prefix='kaibora-bench-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(pasta, 'bench.db')
+    os.environ.setdefault('AGENDADOR_CRONOGRAMA', '0')
+    os.environ.setdefault('COMPRESSAO_MIN_BYTES', str(10 ** 9)) # Mede o corpo cru; a compressão é medida à parte
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as m
+    from flask.json.provider import DefaultJSONProvider
+
+    with m.app.app_context():
+        montar_campanha(m, args.jogadores, random.Random(42))
+        cliente = m.app.test_client()
+        cliente.post('/api/register', json={'username': 'bench', 'password': 'x', 'nome_aventureiro': 'Bench'})
+        token = cliente.post('/api/login', json={'username': 'bench', 'password': 'x'}).json['access_token']
+    cabecalhos = {'Authorization': f'Bearer {token}'}
+
+    padrao = DefaultJSONProvider(m.app)
+    rapido = m.ProvedorJSON(m.app)
+    linhas = [
+        f"Campanha sintética: {args.jogadores} jogadores, {args.jogadores * 10} informes, 500 mensagens de chat",
+        f"orjson: {'sim' if m.orjson else 'não'} | brotli: {'sim' if m.brotli else 'não'} | repetições: {args.repeticoes}",
+        "",
+        f"{'rota':32} {'stdlib ms':>10} {'provedor ms':>12} {'requisição ms':>14} {'bytes':>9} {'gzip':>8} {'br':>8}",
+    ]
+    for rota in ROTAS:
+        resposta = cliente.get(rota, headers=cabecalhos)
+        if resposta.status_code != 200:
+            linhas.append(f"{rota:32} erro {resposta.status_code}")
+            continue
+        corpo = resposta.get_data()
+        dados = json.loads(corpo)
+        with m.app.app_context():
+            t_padrao = medir(lambda: padrao.dumps(dados, separators=(',', ':')), args.repeticoes)
+            t_rapido = medir(lambda: rapido.dumps(dados), args.repeticoes)
+        t_requisicao = medir(lambda: cliente.get(rota, headers=cabecalhos), args.repeticoes)
+        tamanho_gzip = len(gzip.compress(corpo, compresslevel=m.app.config["COMPRESSAO_NIVEL_GZIP"]))
+        tamanho_br = len(m.brotli.compress(corpo, quality=m.app.config["COMPRESSAO_NIVEL_BROTLI"])) if m.brotli else '-'
+        linhas.append(f"{rota:32} {t_padrao:10.2f} {t_rapido:12.2f} {t_requisicao:14.2f} {len(corpo):9} {tamanho_gzip:8} {tamanho_br:>8}")
+
+    relatorio = "\n".join(linhas)
+    print(relatorio)
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as arquivo:
+            arquivo.write(relatorio + "\n")
+
+if __name__ == '__main__':
+    main()
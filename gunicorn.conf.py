@@ -0,0 +1,18 @@
+# Lido automaticamente pelo gunicorn quando ele é iniciado nesta pasta ("gunicorn app:app").
+# O /api/stream (SSE) e o long-poll do chat (?wait=) seguram a requisição enquanto esperam: com o worker síncrono
+# padrão cada jogador ocioso ocuparia um worker inteiro. Com gthread uma conexão ociosa custa só uma thread parada
+# no HubEventos (memória da pilha), e STREAM_MAX_CONEXOES (app.py) reserva threads para as requisições comuns.
+# O número de workers continua vindo de WEB_CONCURRENCY (padrão do gunicorn) e a porta de PORT.
+import os
+import subprocess
+import sys
+
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "64"))
+
+def on_starting(server):
+    # Migra o banco uma vez só, antes de criar os workers, num processo à parte (o mestre não importa o app).
+    # Os workers herdam INICIALIZAR_BANCO=0; se a migração falhar, o gunicorn não sobe.
+    os.environ["INICIALIZAR_BANCO"] = "0"
+    subprocess.run([sys.executable, "-m", "flask", "--app", "app", "inicializar-banco"],
+                   cwd=os.path.dirname(os.path.abspath(__file__)), check=True)